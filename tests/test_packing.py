@@ -0,0 +1,51 @@
+"""Checks that packed examples have the same losses as the examples unpacked"""
+import numpy as np
+import pytest
+import torch
+
+from uio2.config import Config, T5Config
+from uio2.model import UnifiedIOModel
+from uio2.packing import pack_examples
+from uio2.preprocessing import build_batch
+
+
+def _build_model():
+  t5 = T5Config(emb_dim=64, num_heads=4, head_dim=16, mlp_dim=96, num_encoder_layers=2,
+                num_decoder_layers=2)
+  config = Config(t5_config=t5, input_modalities=["text"], target_modalities=["text"],
+                  use_image_vit=False, use_audio_vit=False, use_image_history_vit=False,
+                  use_audio_history_vit=False)
+  torch.manual_seed(0)
+  return UnifiedIOModel(config).eval()
+
+
+def _build_example(rng, input_len, target_len):
+  tokens = rng.integers(2, 1000, input_len).astype(np.int32)
+  targets = rng.integers(2, 1000, target_len).astype(np.int32)
+  return {
+    "/inputs/text/tokens": tokens,
+    "/inputs/text/mask": np.ones(input_len, dtype=np.int32),
+    "/targets/text/inputs": np.concatenate([[0], targets[:-1]]).astype(np.int32),
+    "/targets/text/targets": targets,
+    "/targets/text/mask": np.ones(target_len, dtype=np.int32),
+  }
+
+
+@pytest.mark.parametrize("lengths", [
+  [(5, 5), (9, 4)],
+  [(7, 5), (9, 4)],
+  [(3, 8), (9, 2), (6, 6)],
+])
+def test_packed_loss(lengths):
+  """Packs examples with the given (input, target) lengths"""
+  model = _build_model()
+  rng = np.random.default_rng(0)
+  examples = [_build_example(rng, *length) for length in lengths]
+  with torch.no_grad():
+    packed_batch = build_batch([pack_examples(examples)], device="cpu")
+    packed = model.compute_loss(packed_batch)["text"].item()
+    losses = [model.compute_loss(build_batch([example], device="cpu"))["text"].item()
+              for example in examples]
+  n_targets = [target_len for _, target_len in lengths]
+  expected = np.dot(losses, n_targets) / sum(n_targets)
+  assert packed == pytest.approx(expected, rel=1e-5)
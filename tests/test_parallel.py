@@ -0,0 +1,94 @@
+"""Checks that tensor-parallel models match the unsharded model
+
+Spawns gloo processes on CPU, run with `python -m pytest tests/test_parallel.py` or
+`python tests/test_parallel.py`.
+"""
+import socket
+import tempfile
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from uio2.config import Config, T5Config
+from uio2.model import UnifiedIOModel
+
+
+def _build_model():
+  t5 = T5Config(emb_dim=64, num_heads=4, head_dim=16, mlp_dim=96, num_encoder_layers=2,
+                num_decoder_layers=2)
+  config = Config(t5_config=t5, input_modalities=["text"], target_modalities=["text"],
+                  use_image_vit=False, use_audio_vit=False, use_image_history_vit=False,
+                  use_audio_history_vit=False)
+  torch.manual_seed(0)
+  model = UnifiedIOModel(config)
+  with torch.no_grad():
+    # Larger weights so greedy generation does not just repeat one token
+    for param in model.parameters():
+      param.mul_(3)
+  return model
+
+
+def _build_batch():
+  generator = torch.Generator().manual_seed(1)
+  tokens = torch.randint(2, 1000, (2, 7), dtype=torch.int32, generator=generator)
+  tokens[1, -2:] = 0
+  targets = torch.randint(2, 1000, (2, 5), dtype=torch.int32, generator=generator)
+  return {
+    "/inputs/text/tokens": tokens,
+    "/inputs/text/mask": (tokens > 0).to(torch.int32),
+    "/targets/text/inputs": torch.cat([torch.zeros_like(targets[:, :1]), targets[:, :-1]], 1),
+    "/targets/text/targets": targets,
+    "/targets/text/mask": torch.ones_like(targets),
+  }
+
+
+def _run(model):
+  batch = _build_batch()
+  with torch.no_grad():
+    loss = model.compute_loss(batch)["text"].item()
+    inputs = {k: v for k, v in batch.items() if k.startswith("/inputs")}
+    tokens = model.generate(inputs, modality="text", max_new_tokens=12, do_sample=False)
+  return loss, tokens.tolist()
+
+
+def _worker(rank, world_size, port, checkpoint_dir, queue):
+  dist.init_process_group(
+    "gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+  try:
+    torch.set_num_threads(1)
+    model = UnifiedIOModel.from_pretrained(
+      checkpoint_dir, tensor_parallel_group=dist.group.WORLD).eval()
+    queue.put((rank, _run(model)))
+  finally:
+    dist.destroy_process_group()
+
+
+def _get_free_port():
+  with socket.socket() as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+
+@pytest.mark.parametrize("world_size", [2, 4])
+def test_tensor_parallel(world_size):
+  with tempfile.TemporaryDirectory() as checkpoint_dir:
+    _build_model().save_pretrained(checkpoint_dir)
+    expected_loss, expected_tokens = _run(UnifiedIOModel.from_pretrained(checkpoint_dir).eval())
+
+    queue = mp.get_context("spawn").Queue()
+    mp.spawn(_worker, args=(world_size, _get_free_port(), checkpoint_dir, queue),
+             nprocs=world_size)
+    results = dict(queue.get() for _ in range(world_size))
+
+  for rank in range(world_size):
+    loss, tokens = results[rank]
+    assert loss == pytest.approx(expected_loss, rel=1e-5)
+    assert tokens == expected_tokens
+
+
+if __name__ == '__main__':
+  for n in [2, 4]:
+    test_tensor_parallel(n)
+    print(f"world_size={n}: ok")
@@ -0,0 +1,118 @@
+"""Tokenized answer options for scoring with `UnifiedIOModel.score_answer_options`"""
+from typing import Dict, List, NamedTuple, Sequence
+
+import numpy as np
+import torch
+
+from uio2.config import BOS_ID
+from uio2.utils import pad_and_stack
+
+
+class OptionTrie(NamedTuple):
+  """Prefix trie over a chunk of answer options, packed as a single decoder sequence
+
+  Each node is one decoder input token, attending to itself and its ancestors, so tokens shared
+  by several options are only decoded once.
+  """
+
+  option_ixs: np.ndarray
+  """[n_options] indices of the options in this trie"""
+
+  node_tokens: np.ndarray
+  """[n_nodes] input token of each node, the root is BOS"""
+
+  node_pos: np.ndarray
+  """[n_nodes] position of each node's token in its options"""
+
+  node_mask: np.ndarray
+  """[n_nodes, n_nodes] True if a node (first axis) can attend to a node (second axis)"""
+
+  option_nodes: np.ndarray
+  """[n_options, len] node whose output predicts each option token"""
+
+
+def build_option_trie(tokens: np.ndarray, option_ixs: Sequence[int]) -> OptionTrie:
+  """Builds an `OptionTrie` over tokens[option_ixs]
+
+  Args:
+    tokens: [n, len] options, includes EOS but not BOS and padded with 0
+    option_ixs: options to include
+  """
+  node_tokens = [BOS_ID]
+  node_pos = [0]
+  parents = [-1]
+  children: List[Dict[int, int]] = [{}]
+  option_nodes = np.zeros((len(option_ixs), tokens.shape[1]), dtype=np.int64)
+  for row, ix in enumerate(option_ixs):
+    seq = tokens[ix]
+    seq_len = int(np.sum(seq > 0))
+    node = 0
+    for pos in range(seq_len):
+      option_nodes[row, pos] = node
+      if pos == seq_len - 1:
+        # The last token is only a target, not an input
+        break
+      token = int(seq[pos])
+      child = children[node].get(token)
+      if child is None:
+        child = len(node_tokens)
+        node_tokens.append(token)
+        node_pos.append(pos + 1)
+        parents.append(node)
+        children.append({})
+        children[node][token] = child
+      node = child
+
+  n_nodes = len(node_tokens)
+  node_mask = np.zeros((n_nodes, n_nodes), dtype=bool)
+  for node in range(n_nodes):
+    if parents[node] >= 0:
+      node_mask[node] = node_mask[parents[node]]
+    node_mask[node, node] = True
+  return OptionTrie(
+    np.asarray(option_ixs), np.asarray(node_tokens), np.asarray(node_pos), node_mask,
+    option_nodes)
+
+
+class AnswerOptions:
+  """Tokenized answer options, with cached prefix tries
+
+  Building these once and re-using them across `score_answer_options` calls avoids
+  re-tokenizing the options and re-building the tries every call.
+  """
+
+  def __init__(self, tokens: torch.Tensor):
+    """
+    Args:
+      tokens: [n, len] options, includes EOS but not BOS and padded with 0
+    """
+    self.tokens = tokens
+    self._tries: Dict[int, List[OptionTrie]] = {}
+
+  @classmethod
+  def from_text(cls, tokenizer, options: Sequence[str]) -> 'AnswerOptions':
+    return cls(pad_and_stack([tokenizer.encode(x) + [1] for x in options], add_eos=True))
+
+  def __len__(self):
+    return len(self.tokens)
+
+  def to(self, device) -> 'AnswerOptions':
+    """Moves the tokens to `device`, the tries are shared with the returned options"""
+    out = AnswerOptions(self.tokens.to(device))
+    out._tries = self._tries
+    return out
+
+  def get_tries(self, max_options=None) -> List[OptionTrie]:
+    """Returns tries that each cover at most `max_options` options
+
+    Options are sorted before being split up so options with shared prefixes tend to end up
+    in the same trie.
+    """
+    n = len(self.tokens)
+    max_options = n if max_options is None else min(max_options, n)
+    if max_options not in self._tries:
+      tokens = self.tokens.cpu().numpy()
+      order = sorted(range(n), key=lambda i: tuple(tokens[i]))
+      self._tries[max_options] = [
+        build_option_trie(tokens, order[i:i+max_options]) for i in range(0, n, max_options)]
+    return self._tries[max_options]
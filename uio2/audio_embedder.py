@@ -39,12 +39,13 @@ class MultiHeadDotProductAttention(nn.Module):
     self.dropout_rate = dropout_rate
     self.float32_logits = float32_logits
 
-    self.query_in_proj_weight = nn.Parameter(torch.randn(emb_dim, emb_dim) * self.scale)
-    self.query_in_proj_bias = nn.Parameter(torch.zeros(emb_dim))
-    self.key_in_proj_weight = nn.Parameter(torch.randn(emb_dim, emb_dim) * self.scale)
-    self.key_in_proj_bias = nn.Parameter(torch.zeros(emb_dim))
-    self.value_in_proj_weight = nn.Parameter(torch.randn(emb_dim, emb_dim) * self.scale)
-    self.value_in_proj_bias = nn.Parameter(torch.zeros(emb_dim))
+    # Built from `torch.empty` so `checkpoint_utils.init_empty_parameters` can skip them
+    self.query_in_proj_weight = nn.Parameter(torch.empty(emb_dim, emb_dim).normal_(std=self.scale))
+    self.query_in_proj_bias = nn.Parameter(torch.empty(emb_dim).zero_())
+    self.key_in_proj_weight = nn.Parameter(torch.empty(emb_dim, emb_dim).normal_(std=self.scale))
+    self.key_in_proj_bias = nn.Parameter(torch.empty(emb_dim).zero_())
+    self.value_in_proj_weight = nn.Parameter(torch.empty(emb_dim, emb_dim).normal_(std=self.scale))
+    self.value_in_proj_bias = nn.Parameter(torch.empty(emb_dim).zero_())
 
     self.attn_drop = layers.Dropout(dropout_rate, broadcast_dims=(-2, ))
     self.out_proj = nn.Linear(emb_dim, emb_dim, bias=True)
@@ -149,9 +150,9 @@ class VisionTransformer(nn.Module):
 
     input_dim = config.patch_size * config.patch_size * 1
     self.embedding = nn.Linear(input_dim, config.emb_dim, bias=True)
-    self.cls_token = nn.Parameter(torch.zeros(config.emb_dim))
-    self.dist_token = nn.Parameter(torch.zeros(config.emb_dim))
-    self.positional_embedding = nn.Parameter(torch.zeros(514, config.emb_dim))
+    self.cls_token = nn.Parameter(torch.empty(config.emb_dim).zero_())
+    self.dist_token = nn.Parameter(torch.empty(config.emb_dim).zero_())
+    self.positional_embedding = nn.Parameter(torch.empty(514, config.emb_dim).zero_())
     self.transformer = Transformer(config)
 
   def add_pos_emb(self, x, pos_ids):
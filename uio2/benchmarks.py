@@ -0,0 +1,48 @@
+"""Micro-benchmarks of individual layers
+
+Run `python -m uio2.benchmarks` to print the results on this machine.
+"""
+import time
+from typing import Dict, Sequence, Tuple
+
+import torch
+
+from uio2.layers import _rms_norm_reference, rms_norm
+
+
+def benchmark_rms_norm(widths: Sequence[int] = (1024, 2048, 3072), n_tokens: int = 512,
+                       dtype=torch.float32, device=None,
+                       n_iters: int = 50) -> Dict[int, Tuple[float, float]]:
+  """Times `layers.rms_norm` against the un-fused implementation
+
+  The default widths are those of the LARGE, XL and XXL models.
+
+  Returns:
+    Width to the seconds per call of the un-fused and the fused implementation
+  """
+  out = {}
+  for width in widths:
+    x = torch.randn(n_tokens, width, dtype=dtype, device=device)
+    scale = torch.rand(width, dtype=dtype, device=device) + 0.5
+    times = []
+    for fn in [_rms_norm_reference, rms_norm]:
+      with torch.no_grad():
+        fn(x, scale, 1e-6)
+        if x.device.type == "cuda":
+          torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        for _ in range(n_iters):
+          fn(x, scale, 1e-6)
+        if x.device.type == "cuda":
+          torch.cuda.synchronize()
+        times.append((time.perf_counter() - t0) / n_iters)
+    out[width] = tuple(times)
+  return out
+
+
+if __name__ == '__main__':
+  for dtype in [torch.float32, torch.bfloat16]:
+    for n_tokens in [1, 512]:
+      for width, (reference, fused) in benchmark_rms_norm(n_tokens=n_tokens, dtype=dtype).items():
+        print(f"rms_norm {dtype} tokens={n_tokens} width={width}: "
+              f"{reference*1e6:.0f}us -> {fused*1e6:.0f}us")
@@ -0,0 +1,132 @@
+"""Groups pre-processed examples with similar lengths into batches to reduce padding
+
+`build_batch` pads each feature to the longest example in the batch, and gives every example
+the features of any modality one of the examples has, so batching examples with similar
+lengths and the same modalities avoids spending compute on padding.
+"""
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+# Default bucket boundaries for the variable-length text modalities, other modalities, such as
+# the number of history frames, are bucketed by their exact length
+DEFAULT_BOUNDARIES = {
+  "inputs/text": [16, 32, 64, 128, 256],
+  "targets/text": [8, 16, 32, 64, 128],
+}
+
+
+def get_modality_lengths(example: Dict[str, np.ndarray]) -> Dict[str, int]:
+  """Returns the length of each modality of a pre-processed example
+
+  The length is the first dimension of the modality's mask, the number of tokens for text,
+  patches for images and audio, and frames for histories. Modalities are named without the
+  leading "/" of the `UnifiedIOPreprocessor` keys, e.g., "inputs/text".
+  """
+  lengths = {}
+  for key, val in example.items():
+    parts = key.lstrip("/").split("/")
+    if parts[0] in ["inputs", "targets"] and len(parts) == 3 and parts[2] == "mask":
+      lengths[f"{parts[0]}/{parts[1]}"] = len(val)
+  return lengths
+
+
+def get_padding_efficiency(batches: Sequence[Sequence[Dict[str, int]]]) -> Dict[str, float]:
+  """Returns the fraction of non-padding elements of each modality after batching
+
+  Args:
+    batches: the `get_modality_lengths` of the examples in each batch
+  """
+  used, padded = {}, {}
+  for batch in batches:
+    for modality in set(k for lengths in batch for k in lengths):
+      batch_lengths = [lengths.get(modality, 0) for lengths in batch]
+      used[modality] = used.get(modality, 0) + sum(batch_lengths)
+      padded[modality] = padded.get(modality, 0) + max(batch_lengths) * len(batch_lengths)
+  return {k: used[k] / padded[k] if padded[k] else 1.0 for k in used}
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+  """Batch sampler that only batches examples in the same length bucket
+
+  Examples are bucketed by which modalities they have and the bucketed length of each
+  modality. Can be used as the `batch_sampler` of a `DataLoader`, or iterated over directly to
+  group a list of requests.
+  """
+
+  def __init__(
+      self,
+      lengths: Sequence[Dict[str, int]],
+      batch_size: int,
+      boundaries: Optional[Dict[str, Sequence[int]]] = None,
+      shuffle: bool = False,
+      drop_last: bool = False,
+      seed: int = 0
+  ):
+    """
+    Args:
+      lengths: `get_modality_lengths` of each example
+      batch_size: max examples per batch
+      boundaries: sorted upper bounds of the length buckets for each modality, modalities
+                  without boundaries are bucketed by their exact length
+      shuffle: shuffle the examples in each bucket and the order of the batches every epoch
+      drop_last: drop the last incomplete batch of each bucket
+      seed: seed used for shuffling, combined with the epoch set by `set_epoch`
+    """
+    super().__init__()
+    self.lengths = list(lengths)
+    self.batch_size = batch_size
+    self.boundaries = DEFAULT_BOUNDARIES if boundaries is None else boundaries
+    self.shuffle = shuffle
+    self.drop_last = drop_last
+    self.seed = seed
+    self.epoch = 0
+
+    buckets: Dict[tuple, List[int]] = {}
+    for ix, example_lengths in enumerate(self.lengths):
+      buckets.setdefault(self.get_bucket(example_lengths), []).append(ix)
+    self.buckets = buckets
+
+  def get_bucket(self, lengths: Dict[str, int]) -> tuple:
+    key = []
+    for modality, length in sorted(lengths.items()):
+      modality_boundaries = self.boundaries.get(modality)
+      if modality_boundaries is not None:
+        length = int(np.searchsorted(modality_boundaries, length))
+      key.append((modality, length))
+    return tuple(key)
+
+  def set_epoch(self, epoch: int):
+    self.epoch = epoch
+
+  def get_batches(self) -> List[List[int]]:
+    rng = np.random.RandomState(self.seed + self.epoch) if self.shuffle else None
+    batches = []
+    for key in sorted(self.buckets):
+      ixs = list(self.buckets[key])
+      if rng is not None:
+        rng.shuffle(ixs)
+      else:
+        # Sort so the batches in the bucket are as tight as possible
+        ixs.sort(key=lambda ix: [self.lengths[ix][k] for k, _ in key])
+      for start in range(0, len(ixs), self.batch_size):
+        batch = ixs[start:start+self.batch_size]
+        if len(batch) == self.batch_size or not self.drop_last:
+          batches.append(batch)
+    if rng is not None:
+      rng.shuffle(batches)
+    return batches
+
+  def padding_efficiency(self) -> Dict[str, float]:
+    """Returns the per-modality padding efficiency of the batches, see `get_padding_efficiency`"""
+    return get_padding_efficiency(
+      [[self.lengths[ix] for ix in batch] for batch in self.get_batches()])
+
+  def __iter__(self) -> Iterator[List[int]]:
+    return iter(self.get_batches())
+
+  def __len__(self):
+    if self.drop_last:
+      return sum(len(x) // self.batch_size for x in self.buckets.values())
+    return sum((len(x) + self.batch_size - 1) // self.batch_size for x in self.buckets.values())
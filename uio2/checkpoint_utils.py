@@ -0,0 +1,185 @@
+"""Memory-mapped loading of safetensors checkpoints"""
+import json
+import logging
+import os
+from contextlib import contextmanager
+from os.path import join
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError
+from safetensors import safe_open
+from torch import nn
+from torch.overrides import TorchFunctionMode
+
+SAFETENSORS_NAME = "model.safetensors"
+SAFETENSORS_INDEX_NAME = "model.safetensors.index.json"
+
+
+class _EmptyParameterMode(TorchFunctionMode):
+  """Creates tensors from `torch.empty` on the meta device, unless a device is given"""
+
+  def __torch_function__(self, func, types, args=(), kwargs=None):
+    kwargs = {} if kwargs is None else kwargs
+    if func is torch.empty and kwargs.get("device") is None:
+      kwargs["device"] = "meta"
+    return func(*args, **kwargs)
+
+
+@contextmanager
+def init_empty_parameters():
+  """Context manager that creates the parameters of `torch.nn` layers on the meta device
+
+  Parameters built from `torch.empty`, which includes the parameters of the `torch.nn` layers,
+  are created on the meta device so their initializers become no-ops and they are only
+  allocated once they are loaded from a checkpoint. Tensors built with other functions, such as
+  buffers, are still built normally. The context only applies to the current thread.
+  """
+  with _EmptyParameterMode():
+    yield
+
+
+def materialize_missing(model: nn.Module, checkpoint: 'SafetensorsCheckpoint', device="cpu"):
+  """Allocates and initializes the tensors of `model` that are on the meta device and are not
+  in `checkpoint`, using the `reset_parameters` method of the modules that own them
+
+  Returns: False if a missing tensor belongs to a module without `reset_parameters`
+  """
+  modules = {}
+  for name in get_missing(model, checkpoint):
+    module_name, _, tensor_name = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    if getattr(module, tensor_name).device.type == "meta":
+      modules[module_name] = module
+  if not all(hasattr(module, "reset_parameters") for module in modules.values()):
+    return False
+  for module in modules.values():
+    for tensors in [module._parameters, module._buffers]:
+      for name, tensor in tensors.items():
+        if tensor is not None and tensor.device.type == "meta":
+          empty = torch.empty_like(tensor, device=device)
+          tensors[name] = nn.Parameter(empty, tensor.requires_grad) \
+            if isinstance(tensor, nn.Parameter) else empty
+    module.reset_parameters()
+  return True
+
+
+class SafetensorsCheckpoint:
+  """Reads tensors from a single or a sharded safetensors checkpoint
+
+  Files are memory-mapped and only opened, or downloaded, once a tensor in them is requested,
+  so reading a subset of the tensors only reads the bytes of that subset.
+  """
+
+  def __init__(self, weight_map: Dict[str, str], get_file: Callable[[str], str]):
+    """
+    Args:
+      weight_map: maps tensor names to the name of the file that contains them
+      get_file: returns the local path of a file in `weight_map`
+    """
+    self.weight_map = weight_map
+    self._get_file = get_file
+    self._handles = {}
+
+  @staticmethod
+  def from_file(filename) -> 'SafetensorsCheckpoint':
+    with safe_open(filename, framework="pt") as f:
+      weight_map = {k: filename for k in f.keys()}
+    return SafetensorsCheckpoint(weight_map, lambda x: x)
+
+  @staticmethod
+  def from_pretrained(model_id, **hub_kwargs) -> Optional['SafetensorsCheckpoint']:
+    """Load from a local directory or a hub repo, returns None if there are no safetensors"""
+    if os.path.isdir(model_id):
+      if os.path.exists(join(model_id, SAFETENSORS_INDEX_NAME)):
+        with open(join(model_id, SAFETENSORS_INDEX_NAME)) as f:
+          weight_map = json.load(f)["weight_map"]
+        return SafetensorsCheckpoint(weight_map, lambda x: join(model_id, x))
+      if os.path.exists(join(model_id, SAFETENSORS_NAME)):
+        return SafetensorsCheckpoint.from_file(join(model_id, SAFETENSORS_NAME))
+      return None
+
+    def _download(filename):
+      return hf_hub_download(repo_id=model_id, filename=filename, **hub_kwargs)
+
+    try:
+      with open(_download(SAFETENSORS_INDEX_NAME)) as f:
+        weight_map = json.load(f)["weight_map"]
+      return SafetensorsCheckpoint(weight_map, _download)
+    except EntryNotFoundError:
+      pass
+    try:
+      return SafetensorsCheckpoint.from_file(_download(SAFETENSORS_NAME))
+    except EntryNotFoundError:
+      return None
+
+  def __contains__(self, name):
+    return name in self.weight_map
+
+  def _get_handle(self, name):
+    filename = self.weight_map[name]
+    if filename not in self._handles:
+      self._handles[filename] = safe_open(self._get_file(filename), framework="pt")
+    return self._handles[filename]
+
+  def get_tensor(self, name) -> torch.Tensor:
+    return self._get_handle(name).get_tensor(name)
+
+  def get_slice(self, name, dim: int, start: int, end: int) -> torch.Tensor:
+    """Returns `start:end` of dimension `dim` of a tensor, without reading the rest of it"""
+    index = (slice(None),) * dim + (slice(start, end),)
+    return self._get_handle(name).get_slice(name)[index].contiguous()
+
+
+def get_missing(model: nn.Module, checkpoint: SafetensorsCheckpoint):
+  """Returns the names of tensors in `model` that are not in `checkpoint`"""
+  return [name for name in model.state_dict(keep_vars=True) if name not in checkpoint]
+
+
+def load_safetensors_checkpoint(
+    model: nn.Module, checkpoint: SafetensorsCheckpoint,
+    get_dtype: Callable[[str], Optional[torch.dtype]] = lambda name: None,
+    device="cpu", strict=True, shards: Optional[Dict[str, Tuple[int, int, int]]] = None):
+  """Loads the parameters and persistent buffers of `model` from `checkpoint`
+
+  Tensors are read one at a time, converted to their target device and dtype, and then
+  replace the model's tensor, so at most one extra tensor is held in memory at a time.
+  Tensors in the checkpoint that `model` does not have are never read. `model` can have been
+  built with `init_empty_parameters`, in which case the tensors that are not in the checkpoint
+  must have been initialized with `materialize_missing`.
+
+  Args:
+    model: model to load into
+    checkpoint: checkpoint to load from
+    get_dtype: maps tensor names to the dtype to load them as, or None to keep the
+               checkpoint's dtype
+    device: device to load to
+    strict: raise an error if the checkpoint is missing a tensor
+    shards: maps tensor names to the (dim, start, end) slice of the checkpoint's tensor to
+            load, see `parallel.shard_model`
+  """
+  names = list(model.state_dict(keep_vars=True).keys())
+  missing = get_missing(model, checkpoint)
+  if missing:
+    tensors = model.state_dict(keep_vars=True)
+    if strict or any(tensors[name].device.type == "meta" for name in missing):
+      raise ValueError(f"Checkpoint is missing {len(missing)} tensors, e.g., {missing[0]}")
+    logging.warning(f"Checkpoint is missing {len(missing)} tensors, e.g., {missing[0]}")
+
+  for name in names:
+    if name not in checkpoint:
+      continue
+    if shards is not None and name in shards:
+      tensor = checkpoint.get_slice(name, *shards[name])
+    else:
+      tensor = checkpoint.get_tensor(name)
+    dtype = get_dtype(name) if tensor.is_floating_point() else None
+    tensor = tensor.to(device=device, dtype=dtype)
+    module_name, _, tensor_name = name.rpartition(".")
+    module = model.get_submodule(module_name)
+    if tensor_name in module._parameters:
+      old = module._parameters[tensor_name]
+      module._parameters[tensor_name] = nn.Parameter(tensor, requires_grad=old.requires_grad)
+    else:
+      module._buffers[tensor_name] = tensor
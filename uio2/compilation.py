@@ -0,0 +1,91 @@
+"""Utilities to run generation with `torch.compile`
+
+Compiled graphs are specialized to the shapes of their inputs, so encoder inputs are padded to
+a few length buckets and decoding steps use a `StaticCache` with a fixed number of positions.
+Each decoding step then has the same shapes, and the encoder is only compiled once per bucket
+and batch size.
+"""
+from typing import Optional, Sequence, Tuple
+
+import torch
+from torch.nn import functional as F
+from transformers import DynamicCache
+
+from uio2.seq_features import InputSequence
+
+DEFAULT_LENGTH_BUCKETS = (64, 128, 256, 512, 1024, 2048)
+
+
+def get_bucket(length: int, buckets: Sequence[int]) -> int:
+  """Returns the smallest bucket that fits `length`, or a multiple of the largest bucket"""
+  for bucket in sorted(buckets):
+    if length <= bucket:
+      return bucket
+  largest = max(buckets)
+  return (length + largest - 1) // largest * largest
+
+
+def pad_input_sequence(seq: InputSequence, length: int) -> InputSequence:
+  """Pads `seq` with masked tokens to `length`
+
+  Dtypes are also made consistent, so sequences from different modalities do not trigger
+  re-compilation.
+  """
+  n = length - seq.seq_len
+  if n < 0:
+    raise ValueError(f"Cannot pad a sequence of length {seq.seq_len} to {length}")
+  bs = seq.batch_size
+  position_ids = seq.position_ids.expand(bs, -1).to(torch.long)
+  return InputSequence(
+    embed=F.pad(seq.embed, [0, 0, 0, n]),
+    mask=F.pad(seq.mask.to(torch.int32), [0, n]),
+    segment_ids=None if seq.segment_ids is None else F.pad(seq.segment_ids, [0, n]),
+    position_ids=F.pad(position_ids, [0, n]),
+  )
+
+
+class StaticCache(DynamicCache):
+  """Key/value cache with a fixed number of positions
+
+  Keys and values are written in-place to tensors allocated with `allocate`, so every decoding
+  step sees the same shapes. The position to write to is set outside of the compiled step with
+  `set_position`, and the attention layers need the mask from `get_mask` to hide the positions
+  that have not been written yet.
+  """
+
+  def __init__(self, max_length: int) -> None:
+    super().__init__()
+    self.max_length = max_length
+    self.position: Optional[torch.Tensor] = None
+
+  def allocate(self, num_layers: int, batch_size: int, num_heads: int, head_dim: int, dtype,
+               device=None):
+    """Allocates the keys and values of every layer"""
+    shape = (batch_size, num_heads, self.max_length, head_dim)
+    self.key_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+    self.value_cache = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+
+  def set_position(self, position: int, device=None):
+    """Sets the position the next keys and values are written to"""
+    self.position = torch.tensor([position], device=device)
+    self.seen_tokens = position
+
+  def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+    return self.seen_tokens
+
+  def get_max_length(self) -> Optional[int]:
+    return self.max_length
+
+  def get_mask(self, batch_size: int, device=None) -> torch.Tensor:
+    """Returns the [batch, 1, 1, max_length] mask of the positions written by the next step"""
+    ixs = torch.arange(self.max_length, device=device)
+    return (ixs <= self.position.to(device))[None, None, None, :].expand(batch_size, -1, -1, -1)
+
+  def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int,
+             cache_kwargs=None) -> Tuple[torch.Tensor, torch.Tensor]:
+    if key_states.shape[-2] != 1:
+      raise ValueError("StaticCache only supports decoding one token at a time")
+    position = self.position.to(key_states.device)
+    self.key_cache[layer_idx].index_copy_(-2, position, key_states)
+    self.value_cache[layer_idx].index_copy_(-2, position, value_states)
+    return self.key_cache[layer_idx], self.value_cache[layer_idx]
@@ -1,7 +1,7 @@
 """Configuration settings used in UIO2"""
 import dataclasses
 from dataclasses import dataclass, field
-from typing import Any, Sequence, Dict, Tuple
+from typing import Any, Sequence, Dict, Tuple, Optional
 
 import torch
 import math
@@ -112,6 +112,8 @@ class T5Config:
   logits_via_embedding: bool = True
   # Whether to accumulate attention logits in float32 regardless of dtype.
   float32_attention_logits: bool = True
+  # If set, compute attention this many queries at a time to reduce memory
+  attention_chunk_size: Optional[int] = None
   decoder_xattention_internval: int = 1
   qk_norm: bool = True
   dalle_attn_mask: bool = True
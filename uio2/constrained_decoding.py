@@ -0,0 +1,304 @@
+"""Token-level automata for constrained decoding of structured outputs
+
+An automaton can be passed to `UnifiedIOModel.generate` as a `constraint`, in which case the
+model is only allowed to generate tokens the automaton accepts. Outputs are then guaranteed to
+be well-formed and can be parsed with the automaton's `parse` method, no regex parsing or
+retries needed.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from uio2 import config
+from uio2.utils import token_to_float
+
+LOCATION_START = 32000
+LOCATION_END = 33000
+LOCATION_TOKENS = np.arange(LOCATION_START, LOCATION_END)
+
+# Tokens that can be used to write text, excludes PAD/EOS, locations and the modality tokens
+TEXT_TOKENS = np.arange(config.EOS_ID + 1, LOCATION_START)
+
+
+class TokenAutomaton:
+  """Deterministic automaton over token ids
+
+  Each state has a set of allowed tokens, and transitions for those tokens. Transitions are
+  looked up in the per-token edges, then the per-range edges, and then fall back to the
+  state's default transition. Subclasses build the states and implement `parse`.
+  """
+
+  def __init__(self, vocab_size: int = 33280):
+    self.vocab_size = vocab_size
+    self.start = None
+    self._allowed: List[np.ndarray] = []
+    self._edges: List[Dict[int, int]] = []
+    self._range_edges: List[List[Tuple[int, int, int]]] = []
+    self._default: List[Optional[int]] = []
+    self._masks: Dict[Tuple[int, torch.device], torch.Tensor] = {}
+    self._forced_spans: Dict[int, Tuple[List[int], int]] = {}
+    self._token_ids: Dict[Tuple[frozenset, torch.device], torch.Tensor] = {}
+
+  @property
+  def num_states(self):
+    return len(self._allowed)
+
+  def add_state(self, allowed: Sequence[int], default: Optional[int] = None) -> int:
+    self._allowed.append(np.unique(np.asarray(allowed, dtype=np.int64)))
+    self._edges.append({})
+    self._range_edges.append([])
+    self._default.append(default)
+    return len(self._allowed) - 1
+
+  def add_edge(self, state: int, token: int, next_state: int):
+    self._edges[state][int(token)] = next_state
+
+  def add_range_edge(self, state: int, start: int, end: int, next_state: int):
+    self._range_edges[state].append((start, end, next_state))
+
+  def set_default(self, state: int, next_state: int):
+    self._default[state] = next_state
+
+  def extend_state(self, state: int, other: int):
+    """Make `state` also accept the tokens `other` accepts, with the same transitions"""
+    self._allowed[state] = np.union1d(self._allowed[state], self._allowed[other])
+    for token, next_state in self._edges[other].items():
+      assert token not in self._edges[state]
+      self._edges[state][token] = next_state
+    self._range_edges[state] += self._range_edges[other]
+    if self._default[other] is not None:
+      assert self._default[state] is None
+      self._default[state] = self._default[other]
+
+  def allowed_tokens(self, state: int) -> np.ndarray:
+    return self._allowed[state]
+
+  def step(self, state: int, token: int) -> int:
+    """Returns the state after generating `token` in `state`"""
+    token = int(token)
+    next_state = self._edges[state].get(token)
+    if next_state is not None:
+      return next_state
+    for start, end, range_state in self._range_edges[state]:
+      if start <= token < end:
+        return range_state
+    if self._default[state] is None:
+      raise ValueError(f"No transition for token {token} in state {state}")
+    return self._default[state]
+
+  def forced_span(self, state: int) -> Tuple[List[int], int]:
+    """Returns the tokens that must be generated starting from `state`, and the state after
+    generating them
+
+    The span is cut after EOS, so the tokens are empty if generation can stop in `state`
+    """
+    if state not in self._forced_spans:
+      tokens = []
+      cur = state
+      while len(self._allowed[cur]) == 1:
+        token = int(self._allowed[cur][0])
+        tokens.append(token)
+        cur = self.step(cur, token)
+        if token == config.EOS_ID:
+          break
+      self._forced_spans[state] = (tokens, cur)
+    return self._forced_spans[state]
+
+  def get_mask(self, state: int, device=None) -> torch.Tensor:
+    """Returns a [vocab_size] boolean mask of the tokens allowed in `state`"""
+    device = torch.device("cpu") if device is None else torch.device(device)
+    key = (state, device)
+    if key not in self._masks:
+      mask = torch.zeros(self.vocab_size, dtype=torch.bool)
+      mask[torch.as_tensor(self._allowed[state])] = True
+      self._masks[key] = mask.to(device)
+    return self._masks[key]
+
+  def get_masks(self, states: Sequence[int], device=None) -> torch.Tensor:
+    return torch.stack([self.get_mask(state, device) for state in states])
+
+  def get_token_ids(self, states: Sequence[int], device=None) -> torch.Tensor:
+    """Returns the sorted ids of the tokens allowed in any of `states`"""
+    device = torch.device("cpu") if device is None else torch.device(device)
+    key = (frozenset(states), device)
+    if key not in self._token_ids:
+      ids = np.unique(np.concatenate([self._allowed[state] for state in key[0]]))
+      self._token_ids[key] = torch.as_tensor(ids).to(device)
+    return self._token_ids[key]
+
+  def precompute_masks(self, device=None):
+    """Build the allowed-token masks for every state ahead of time"""
+    for state in range(self.num_states):
+      self.get_mask(state, device)
+
+  def parse(self, tokens):
+    """Parse generated tokens, excluding the BOS, into a structured output"""
+    raise NotImplementedError()
+
+  def _add_end_state(self) -> int:
+    # EOS leads here, and we keep generating EOS as padding once in this state
+    end = self.add_state([config.EOS_ID])
+    self.set_default(end, end)
+    return end
+
+  def _add_trie(self, sequences: Sequence[Sequence[int]], exit_state: int) -> int:
+    """Adds states accepting exactly one token sequence in `sequences`, followed by whatever
+    `exit_state` accepts. Returns the root state"""
+    children: Dict[int, Dict] = {}
+    for seq in sequences:
+      assert len(seq) > 0
+      node = children
+      for token in seq:
+        node = node.setdefault(int(token), {})
+      node[None] = {}  # Marks the end of a sequence
+
+    def _build(node):
+      state = self.add_state([x for x in node if x is not None])
+      for token, child in node.items():
+        if token is not None:
+          self.add_edge(state, token, _build(child))
+      if None in node:
+        self.extend_state(state, exit_state)
+      return state
+    return _build(children)
+
+
+class BoxAutomaton(TokenAutomaton):
+  """Constrains the output to a sequence of boxes followed by EOS
+
+  Each box is four location tokens, optionally followed by a label. Labels are either one of
+  `class_names`, or free text if `class_names` is None and `labelled` is True.
+  """
+
+  def __init__(self, tokenizer=None, class_names: Optional[Sequence[str]] = None,
+               labelled: bool = False, min_boxes: int = 0, max_boxes: Optional[int] = None,
+               vocab_size: int = 33280):
+    super().__init__(vocab_size)
+    if max_boxes is not None and max_boxes < min_boxes:
+      raise ValueError("max_boxes < min_boxes")
+    if class_names is not None:
+      if tokenizer is None:
+        raise ValueError("Need a tokenizer to use class names")
+      labelled = True
+      self._class_names = {tuple(tokenizer.encode(name)): name for name in class_names}
+    else:
+      self._class_names = None
+    self.tokenizer = tokenizer
+    self.labelled = labelled
+    end = self._add_end_state()
+
+    # One group of states for each box that is required or limited, if the number of boxes
+    # is unbounded the last group loops back to itself
+    n_groups = min_boxes + 1 if max_boxes is None else max_boxes
+    box_starts = [self.add_state(
+      LOCATION_TOKENS if ix < min_boxes else np.append(LOCATION_TOKENS, config.EOS_ID))
+      for ix in range(n_groups)]
+    if max_boxes is None:
+      box_starts.append(box_starts[-1])
+    else:
+      box_starts.append(end)
+
+    last_locations = []
+    for start in box_starts[:n_groups]:
+      self.add_edge(start, config.EOS_ID, end)
+      prev = start
+      for _ in range(3):
+        loc = self.add_state(LOCATION_TOKENS)
+        self.add_range_edge(prev, LOCATION_START, LOCATION_END, loc)
+        prev = loc
+      last_locations.append(prev)
+
+    # Labels are built once all the box start states are complete, since the label states
+    # copy the transitions of the next start state
+    for ix, prev in enumerate(last_locations):
+      next_start = box_starts[ix+1]
+      if self._class_names is not None:
+        label = self._add_trie(list(self._class_names), next_start)
+      elif labelled:
+        label = self.add_state(TEXT_TOKENS)
+        label_rest = self.add_state(TEXT_TOKENS)
+        self.extend_state(label_rest, next_start)
+        self.add_range_edge(label_rest, TEXT_TOKENS[0], LOCATION_START, label_rest)
+        self.set_default(label, label_rest)
+      else:
+        label = next_start
+      self.add_range_edge(prev, LOCATION_START, LOCATION_END, label)
+    self.start = box_starts[0]
+
+  def parse(self, tokens):
+    """Returns [n_boxes, 4] yxyx boxes in [0, 1] coordinates and a list of labels
+
+    Labels are empty strings if the automaton is not labelled. Boxes that were cut off by the
+    generation length limit are skipped.
+    """
+    boxes, labels = [], []
+    box, label = [], []
+
+    def _flush():
+      if len(box) != 4:
+        return
+      if self._class_names is not None:
+        name = self._class_names.get(tuple(label))
+        if name is None:
+          return
+      elif self.labelled:
+        if not label:
+          return
+        name = self.tokenizer.decode(label).strip() if self.tokenizer is not None else label
+      else:
+        name = ""
+      boxes.append(token_to_float(np.array(box)))
+      labels.append(name)
+
+    for token in tokens:
+      token = int(token)
+      if token == config.EOS_ID:
+        break
+      if LOCATION_START <= token < LOCATION_END:
+        if len(box) == 4:
+          _flush()
+          box, label = [], []
+        box.append(token)
+      else:
+        label.append(token)
+    _flush()
+    boxes = np.array(boxes) if boxes else np.zeros((0, 4))
+    return boxes, labels
+
+
+class KeypointAutomaton(TokenAutomaton):
+  """Constrains the output to two location tokens followed by the part name, for each part
+
+  All part names are forced, so decoding with this automaton only samples location tokens
+  """
+
+  def __init__(self, tokenizer, part_names: Sequence[str], vocab_size: int = 33280):
+    super().__init__(vocab_size)
+    self.part_names = list(part_names)
+    prev = None
+    for part in self.part_names:
+      for token_set in [LOCATION_TOKENS, LOCATION_TOKENS] + [[x] for x in tokenizer.encode(part)]:
+        state = self.add_state(token_set)
+        if prev is None:
+          self.start = state
+        else:
+          self.set_default(prev, state)
+        prev = state
+    end = self._add_end_state()
+    eos = self.add_state([config.EOS_ID])
+    self.add_edge(eos, config.EOS_ID, end)
+    self.set_default(prev, eos)
+
+  def parse(self, tokens):
+    """Returns [n_parts, 2] yx points in [0, 1] coordinates and a [n_parts] array that is 2
+    for parts with a predicted point, and 0 for parts cut off by the generation length limit"""
+    locations = [int(x) for x in tokens if LOCATION_START <= int(x) < LOCATION_END]
+    n = len(self.part_names)
+    points = np.zeros([n, 2])
+    labels = np.zeros([n])
+    n_complete = min(len(locations) // 2, n)
+    if n_complete:
+      points[:n_complete] = token_to_float(np.array(locations[:n_complete*2])).reshape(-1, 2)
+      labels[:n_complete] = 2
+    return points, labels
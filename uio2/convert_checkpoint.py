@@ -1,8 +1,16 @@
 """Maps jax parameters to pytorch ones"""
-from typing import Tuple, Dict
+import json
+import multiprocessing
+import os
+from os.path import join
+from typing import Tuple, Dict, List
 
 import numpy as np
 import torch
+from safetensors.torch import save_file
+from transformers.utils import CONFIG_NAME
+
+from uio2.checkpoint_utils import SAFETENSORS_INDEX_NAME
 
 
 def convert_param(name: str, param: np.ndarray) -> Tuple[str, np.ndarray]:
@@ -150,8 +158,8 @@ def flatten_checkpoint(src, prefix, out):
   return {k.lstrip("."): v for k, v in out.items()}
 
 
-def load_uio2_checkpoint(checkpoint, input_modalities=("text",), target_modalities=("text",)):
-  """Load UIO2 parameters stored in a npz file as a torch compatible state dict"""
+def get_checkpoint_prefixes(input_modalities=("text",), target_modalities=("text",)) -> List[str]:
+  """Prefixes of the jax parameters needed for the given modalities"""
   prefixes = [
     'decoder', 'encoder',
     'audio_token_embedder', 'image_token_embedder', 'text_token_embedder',
@@ -171,7 +179,12 @@ def load_uio2_checkpoint(checkpoint, input_modalities=("text",), target_modaliti
     prefixes.append('target_encoders_text')
   if "audio" in target_modalities:
     prefixes.append('target_encoders_audio')
+  return prefixes
+
 
+def load_uio2_checkpoint(checkpoint, input_modalities=("text",), target_modalities=("text",)):
+  """Load UIO2 parameters stored in a npz file as a torch compatible state dict"""
+  prefixes = get_checkpoint_prefixes(input_modalities, target_modalities)
   if checkpoint.endswith(".npz"):
     params = np.load(checkpoint, allow_pickle=True)
     params = {k: params[k] for k in params if any(k.startswith(x) for x in prefixes)}
@@ -182,3 +195,79 @@ def load_uio2_checkpoint(checkpoint, input_modalities=("text",), target_modaliti
   return mapped_params
 
 
+def _convert_members(checkpoint, members, output_dir, max_shard_size, shard_prefix):
+  """Converts npz `members` into safetensors shards, returns the shard names and the
+  parameters names and byte sizes in each shard"""
+  npz = np.load(checkpoint, allow_pickle=True)
+  shards = []
+  shard, shard_size = {}, 0
+
+  def _flush():
+    name = f"{shard_prefix}-{len(shards):05d}.safetensors"
+    save_file(shard, join(output_dir, name))
+    shards.append((name, {k: v.numel()*v.element_size() for k, v in shard.items()}))
+
+  for member in members:
+    # Only one member, which might be a nested dictionary of parameters, is loaded at a time
+    params = flatten_checkpoint({member: npz[member]}, '', {})
+    for k in list(params):
+      k, v = convert_param(k, params.pop(k))
+      v = torch.as_tensor(np.ascontiguousarray(v))
+      size = v.numel()*v.element_size()
+      if shard and shard_size + size > max_shard_size:
+        _flush()
+        shard, shard_size = {}, 0
+      shard[k] = v
+      shard_size += size
+  if shard:
+    _flush()
+  return shards
+
+
+def convert_uio2_checkpoint(
+    checkpoint, output_dir, input_modalities=("text",), target_modalities=("text",),
+    max_shard_size=5*2**30, num_workers=0, config=None):
+  """Converts a UIO2 npz checkpoint into sharded safetensors files with an index
+
+  Unlike `load_uio2_checkpoint` the parameters are never all in memory at once, npz members are
+  read one at a time and written out as soon as a shard is full. The output directory can be
+  loaded with `UnifiedIOModel.from_pretrained` if `config` is given.
+
+  Args:
+    checkpoint: npz file to convert
+    output_dir: directory to save the shards to
+    input_modalities: input modalities to convert parameters for
+    target_modalities: target modalities to convert parameters for
+    max_shard_size: max size of a shard in bytes
+    num_workers: convert with this many processes, each one writes its own shards
+    config: `Config` of the model to save as well
+  """
+  npz = np.load(checkpoint, allow_pickle=True)
+  prefixes = get_checkpoint_prefixes(input_modalities, target_modalities)
+  members = [k for k in npz.files if any(k.startswith(x) for x in prefixes)]
+  os.makedirs(output_dir, exist_ok=True)
+
+  if num_workers:
+    groups = [members[i::num_workers] for i in range(num_workers)]
+    with multiprocessing.Pool(num_workers) as pool:
+      results = pool.starmap(_convert_members, [
+        (checkpoint, group, output_dir, max_shard_size, f"tmp-{i}")
+        for i, group in enumerate(groups) if group])
+    shards = [shard for result in results for shard in result]
+  else:
+    shards = _convert_members(checkpoint, members, output_dir, max_shard_size, "tmp-0")
+
+  # Rename the shards to the standard huggingface names now we know how many there are
+  weight_map = {}
+  total_size = 0
+  for ix, (tmp_name, sizes) in enumerate(shards):
+    name = f"model-{ix+1:05d}-of-{len(shards):05d}.safetensors"
+    os.rename(join(output_dir, tmp_name), join(output_dir, name))
+    for k, size in sizes.items():
+      weight_map[k] = name
+      total_size += size
+  with open(join(output_dir, SAFETENSORS_INDEX_NAME), "w") as f:
+    json.dump(dict(metadata=dict(total_size=total_size), weight_map=weight_map), f, indent=2)
+  if config is not None:
+    with open(join(output_dir, CONFIG_NAME), "w") as f:
+      json.dump(config.to_dict(), f)
@@ -0,0 +1,215 @@
+"""Export the encoder and single decoding steps as graphs with `torch.export`
+
+`UnifiedIOModel.generate` relies on `GenerationMixin` and Python callbacks, so for other
+runtimes we export two graphs instead:
+
+- `ExportableEncoder` embeds and encodes the inputs, and also computes the keys and values of
+  every cross-attention layer of the decoder.
+- `ExportableDecoderStep` decodes one token with the self-attention keys and values of the
+  previous tokens and the cross-attention keys and values as explicit inputs.
+
+`generate_with_exported` is a reference decoding loop that runs the two graphs. RoPE is traced
+with real arithmetic since exporters such as ONNX do not support complex tensors.
+"""
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+from torch import nn
+from transformers import DynamicCache
+
+from uio2 import layers
+from uio2.config import BOS_ID, EOS_ID, T5Config
+from uio2.utils import unflatten_dict
+
+
+@contextmanager
+def real_rotary(model: nn.Module):
+  """Applies RoPE with real arithmetic inside this context, see `layers.RotaryTable`"""
+  model.rotary.use_complex = False
+  try:
+    yield
+  finally:
+    model.rotary.use_complex = True
+
+
+class ExportableEncoder(nn.Module):
+  """Encodes the inputs of a batch, inputs are the "inputs" features of an un-flattened batch
+
+  Returns the [batch, length] encoder mask, and the [n_cross_attention_layers, batch, length,
+  num_heads, head_dim] keys and values of the cross-attention layers.
+  """
+
+  def __init__(self, model):
+    super().__init__()
+    self.model = model
+
+  def forward(self, features: Dict[str, Dict[str, torch.Tensor]]):
+    model = self.model
+    input_seq = model.encode_batch(features)
+    encoded = model.encoder(input_seq)
+    key_values = model.decoder.project_cross_key_values(encoded, input_seq.position_ids)
+    keys, values = zip(*[kv for kv in key_values if kv is not None])
+    return input_seq.mask, torch.stack(keys), torch.stack(values)
+
+
+class _StepCache(DynamicCache):
+  """Cache that writes the new keys and values of one step out-of-place, so the exported graph
+  does not mutate its inputs"""
+
+  def __init__(self, keys: torch.Tensor, values: torch.Tensor, position: torch.Tensor):
+    super().__init__()
+    self.key_cache = list(keys.unbind(0))
+    self.value_cache = list(values.unbind(0))
+    self.position = position
+    self.new_keys, self.new_values = [], []
+
+  def update(self, key_states, value_states, layer_idx, cache_kwargs=None):
+    self.new_keys.append(key_states)
+    self.new_values.append(value_states)
+    self.key_cache[layer_idx] = self.key_cache[layer_idx].index_copy(-2, self.position, key_states)
+    self.value_cache[layer_idx] = self.value_cache[layer_idx].index_copy(
+      -2, self.position, value_states)
+    return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+
+class ExportableDecoderStep(nn.Module):
+  """Decodes one token of `modality`
+
+  Inputs are the [batch, 1] token ids, the position of the tokens as a [1] tensor, the encoder
+  mask and cross-attention keys and values from `ExportableEncoder`, and the [n_layers, batch,
+  num_heads, cache_length, head_dim] keys and values of the previous positions.
+  Returns the [batch, vocab_size] logits and the [n_layers, batch, num_heads, 1, head_dim] keys
+  and values of the tokens, which callers write into the cache at `position`.
+  """
+
+  def __init__(self, model, modality: str):
+    super().__init__()
+    self.model = model
+    self.modality = modality
+
+  def forward(self, tokens, position, encoder_mask, keys, values, cross_keys, cross_values):
+    model = self.model
+    decoder = model.decoder
+    bs = tokens.shape[0]
+    # Embed as position 0 and shift the position ids, so `position` can stay a tensor
+    seq = model.target_embedders[self.modality](
+      tokens, mask=torch.ones_like(tokens, dtype=torch.int32), cur_index=0,
+      shared_embed=model.shared_embedding[self.modality])
+    cache = _StepCache(keys, values, position)
+
+    cross_key_values = []
+    cross_ix = 0
+    for lyr_ix in range(decoder.config.num_decoder_layers):
+      if decoder.get_submodule(f"layers_{lyr_ix}").enable_xattention:
+        cross_key_values.append((cross_keys[cross_ix], cross_values[cross_ix]))
+        cross_ix += 1
+      else:
+        cross_key_values.append(None)
+
+    decoder_mask = torch.arange(keys.shape[-2], device=tokens.device) <= position
+    out = decoder(
+      decoder_embedding=seq.input_embedding,
+      decoder_position_ids=seq.position_ids + position,
+      decoder_attn_mask=decoder_mask[None, None, None, :].expand(bs, -1, -1, -1),
+      encoder_decoder_mask=layers.make_attention_mask(
+        torch.ones((bs, 1), device=tokens.device), encoder_mask),
+      past_key_values=cache,
+      cross_key_values=cross_key_values,
+      return_dict=True,
+      logit_weights=model.shared_embedding[self.modality].weight,
+    )
+    return out.logits[:, -1], torch.stack(cache.new_keys), torch.stack(cache.new_values)
+
+
+def export_encoder(model, batch: Dict[str, torch.Tensor], **export_kwargs):
+  """Exports `ExportableEncoder` for inputs with the modalities and shapes of `batch`
+
+  Args:
+    model: `UnifiedIOModel` in eval mode
+    batch: example batch of pre-processed features, target features are ignored
+    **export_kwargs: arguments for `torch.export.export`, such as `dynamic_shapes`
+
+  Returns: `torch.export.ExportedProgram` that takes the "inputs" features of the un-flattened
+           batch
+  """
+  features = unflatten_dict(batch)["inputs"]
+  with real_rotary(model), torch.no_grad():
+    return torch.export.export(ExportableEncoder(model), (features,), **export_kwargs)
+
+
+def get_step_inputs(config: T5Config, tokens, position: int, encoder_outputs, cache_length):
+  """Returns inputs for `ExportableDecoderStep` with an empty cache"""
+  encoder_mask, cross_keys, cross_values = encoder_outputs
+  _, bs, _, num_heads, head_dim = cross_keys.shape
+  shape = (config.num_decoder_layers, bs, num_heads, cache_length, head_dim)
+  keys = torch.zeros(shape, dtype=cross_keys.dtype, device=cross_keys.device)
+  position = torch.tensor([position], device=tokens.device)
+  return tokens, position, encoder_mask, keys, torch.zeros_like(keys), cross_keys, cross_values
+
+
+def export_decoder_step(model, modality: str, encoder_outputs, cache_length: int,
+                        **export_kwargs):
+  """Exports `ExportableDecoderStep`
+
+  Args:
+    model: `UnifiedIOModel` in eval mode
+    modality: modality to decode
+    encoder_outputs: example outputs of the exported encoder
+    cache_length: number of cached positions, the max number of tokens to decode
+    **export_kwargs: arguments for `torch.export.export`, such as `dynamic_shapes`
+
+  Returns: `torch.export.ExportedProgram` of the decoding step
+  """
+  bs = encoder_outputs[0].shape[0]
+  tokens = torch.zeros((bs, 1), dtype=torch.long, device=encoder_outputs[0].device)
+  args = get_step_inputs(model.config, tokens, 0, encoder_outputs, cache_length)
+  with real_rotary(model), torch.no_grad():
+    return torch.export.export(ExportableDecoderStep(model, modality), args, **export_kwargs)
+
+
+def generate_with_exported(
+    encoder: Callable, decoder_step: Callable, batch: Dict[str, torch.Tensor], config: T5Config,
+    max_new_tokens: int, cache_length: Optional[int] = None, eos_token_id: Optional[int] = EOS_ID,
+    pad_token_id: int = 1
+) -> torch.Tensor:
+  """Greedy decoding with the exported graphs, matches greedy `UnifiedIOModel.generate`
+
+  Args:
+    encoder: exported encoder, such as the `.module()` of `export_encoder`
+    decoder_step: exported decoding step, such as the `.module()` of `export_decoder_step`
+    batch: batch of pre-processed features
+    config: config of the model
+    max_new_tokens: number of tokens to generate, 1024 for images and 512 for audio
+    cache_length: number of cached positions the decoding step was exported with, defaults to
+                  `max_new_tokens`
+    eos_token_id: token that ends a sequence, later tokens of the sequence are `pad_token_id`
+    pad_token_id: token to use after the end of a sequence
+
+  Returns: [batch, 1 + n_generated] tokens starting with BOS, like the tokens `generate` returns
+           for text
+  """
+  cache_length = max_new_tokens if cache_length is None else cache_length
+  with torch.no_grad():
+    encoder_outputs = encoder(unflatten_dict(batch)["inputs"])
+    bs = encoder_outputs[0].shape[0]
+    device = encoder_outputs[0].device
+    tokens = torch.full((bs, 1), BOS_ID, dtype=torch.long, device=device)
+    step_inputs = list(get_step_inputs(config, tokens, 0, encoder_outputs, cache_length))
+    keys, values = step_inputs[3], step_inputs[4]
+    done = torch.zeros(bs, dtype=torch.bool, device=device)
+    for position in range(max_new_tokens):
+      step_inputs[0] = tokens[:, -1:]
+      step_inputs[1] = torch.tensor([position], device=device)
+      logits, new_keys, new_values = decoder_step(*step_inputs)
+      keys.index_copy_(-2, step_inputs[1], new_keys)
+      values.index_copy_(-2, step_inputs[1], new_values)
+
+      next_tokens = torch.argmax(logits, -1)
+      next_tokens = torch.where(done, pad_token_id, next_tokens)
+      tokens = torch.cat([tokens, next_tokens[:, None]], 1)
+      if eos_token_id is not None:
+        done |= next_tokens == eos_token_id
+        if done.all():
+          break
+  return tokens
@@ -43,12 +43,13 @@ class MultiHeadDotProductAttention(nn.Module):
     self.dropout_rate = dropout_rate
     self.float32_logits = float32_logits
 
-    self.query_in_proj_weight = nn.Parameter(torch.randn(emb_dim, emb_dim) * self.scale)
-    self.query_in_proj_bias = nn.Parameter(torch.zeros(emb_dim))
-    self.key_in_proj_weight = nn.Parameter(torch.randn(emb_dim, emb_dim) * self.scale)
-    self.key_in_proj_bias = nn.Parameter(torch.zeros(emb_dim))
-    self.value_in_proj_weight = nn.Parameter(torch.randn(emb_dim, emb_dim) * self.scale)
-    self.value_in_proj_bias = nn.Parameter(torch.zeros(emb_dim))
+    # Built from `torch.empty` so `checkpoint_utils.init_empty_parameters` can skip them
+    self.query_in_proj_weight = nn.Parameter(torch.empty(emb_dim, emb_dim).normal_(std=self.scale))
+    self.query_in_proj_bias = nn.Parameter(torch.empty(emb_dim).zero_())
+    self.key_in_proj_weight = nn.Parameter(torch.empty(emb_dim, emb_dim).normal_(std=self.scale))
+    self.key_in_proj_bias = nn.Parameter(torch.empty(emb_dim).zero_())
+    self.value_in_proj_weight = nn.Parameter(torch.empty(emb_dim, emb_dim).normal_(std=self.scale))
+    self.value_in_proj_bias = nn.Parameter(torch.empty(emb_dim).zero_())
 
     self.attn_drop = layers.Dropout(dropout_rate, broadcast_dims=(-2, ))
     self.out_proj = nn.Linear(emb_dim, emb_dim, bias=True)
@@ -154,8 +155,9 @@ class VisionTransformer(nn.Module):
     input_dim = config.patch_size * config.patch_size * 3
     self.embedding = nn.Linear(input_dim, config.emb_dim, bias=False)
     scale = config.emb_dim
-    self.class_embedding = nn.Parameter(scale * torch.randn(config.emb_dim))
-    self.positional_embedding = nn.Parameter(scale * torch.randn(config.num_pos, config.emb_dim))
+    self.class_embedding = nn.Parameter(torch.empty(config.emb_dim).normal_(std=scale))
+    self.positional_embedding = nn.Parameter(
+      torch.empty(config.num_pos, config.emb_dim).normal_(std=scale))
     self.pre_ln = nn.LayerNorm(config.emb_dim, eps=1e-5)
     self.transformer = Transformer(config)
 
@@ -49,15 +49,17 @@ class InputTextEmbedder(nn.Module):
     self.config = config
     cfg = config
 
-    self.register_buffer(
-      'pos_emb_cache',
-      layers.get_1d_position_embedding(
-        cfg.text_pos_emb, cfg.encoder_max_text_length, cfg.emb_dim, cfg.head_dim, True, 1),
-      persistent=False)
+    # Set to the start of this embedder's table in the model's `layers.RotaryTable`
+    self.rope_offset = 0
     if "llama_rope" in cfg.text_pos_emb:
       self.modality_embedding = nn.Parameter(torch.empty(cfg.emb_dim).normal_(std=0.02))
 
-  def forward(self, tokens, shared_embed, mask=None, pos_ids=None):
+  def get_rope_cache(self):
+    cfg = self.config
+    return layers.get_1d_position_embedding(
+      cfg.text_pos_emb, cfg.encoder_max_text_length, cfg.emb_dim, cfg.head_dim, True, 1)
+
+  def forward(self, tokens, shared_embed, mask=None, pos_ids=None, example_ids=None):
 
     cfg = self.config
     bs, seq_len = tokens.shape
@@ -70,12 +72,12 @@ class InputTextEmbedder(nn.Module):
 
     x = shared_embed(tokens.to(torch.int32))
 
-    pos_emb = self.pos_emb_cache[pos_ids]
+    pos_ids = pos_ids + self.rope_offset
 
     if "llama_rope" in cfg.text_pos_emb:
       x += self.modality_embedding[None, None, :].to(x.dtype)
 
-    return InputSequence(embed=x, mask=mask, position_embed=pos_emb)
+    return InputSequence(embed=x, mask=mask, position_ids=pos_ids, segment_ids=example_ids)
 
 
 class InputTextEncoder(ModalityEncoder):
@@ -123,6 +125,8 @@ class ViTImageEmbedder(nn.Module):
       patch_size = cfg.image_patch_size if self.modality == "image" else cfg.audio_patch_size
       default_size = cfg.default_image_size if self.modality == "image" else cfg.default_audio_size
 
+    self.patch_size = patch_size
+    self.default_size = default_size
     self.patch_num = [i // patch_size for i in default_size]
 
     pos_emb_type = cfg.image_pos_emb if "image" in self.modality else cfg.audio_pos_emb
@@ -134,24 +138,38 @@ class ViTImageEmbedder(nn.Module):
     self.projection = nn.Linear(in_dim, cfg.emb_dim, bias=False)
     nn.init.trunc_normal_(self.projection.weight, std=math.sqrt(1 / in_dim), a=-2.0, b=2.0)
 
+    # Set to the start of this embedder's table in the model's `layers.RotaryTable`
+    self.rope_offset = 0
+
+    if "llama_rope" in pos_emb_type:
+      self.modality_embedding = nn.Parameter(torch.empty(cfg.emb_dim).normal_(std=0.02))
+
+  def get_rope_cache(self):
+    cfg = self.t5_config
+    pos_emb_type = cfg.image_pos_emb if "image" in self.modality else cfg.audio_pos_emb
     scale = math.sqrt(cfg.decoder_max_image_length / cfg.encoder_max_image_length)
-    self.register_buffer('pos_emb_cache', layers.get_2d_position_embedding(
+    return layers.get_2d_position_embedding(
         pos_emb_type, 
-        default_size, 
-        patch_size, 
+        self.default_size, 
+        self.patch_size, 
         cfg.emb_dim, 
         cfg.head_dim, 
         self.modality_idx, 
-        scale), persistent=False)
-    
-    if "llama_rope" in pos_emb_type:
-      self.modality_embedding = nn.Parameter(torch.empty(cfg.emb_dim).normal_(std=0.02))
+        scale)
     
-  def forward(self, input, pos_ids, mask, shared_embed, use_constraints=True):
+  def forward(self, input, pos_ids, mask, shared_embed, use_constraints=True, example_ids=None):
     cfg = self.t5_config
     bs = input.shape[0]
     pos_emb_type = cfg.image_pos_emb if "image" in self.modality else cfg.audio_pos_emb
-    
+
+    packed = len(input.shape) == 4
+    if packed:
+      # Packed examples, [batch, n_images, n_patches, patch_dim], the ViT encodes each image
+      # on its own and the patches of all images are then concatenated
+      input = input.reshape(-1, *input.shape[2:])
+      mask = mask.reshape(-1, mask.shape[-1])
+      pos_ids = pos_ids.reshape(-1, pos_ids.shape[-1])
+
     if self.use_vit:
       # get image feature from the encoder
       x, x1 = self.image_encoder(input, mask, pos_ids, patch_num = self.patch_num)
@@ -166,12 +184,18 @@ class ViTImageEmbedder(nn.Module):
     x = x.to(self.projection.weight.dtype)
     x = self.projection(x)
 
-    pos_emb = self.pos_emb_cache[pos_ids]
+    if packed:
+      x = x.reshape(bs, -1, x.shape[-1])
+      mask = mask.reshape(bs, -1)
+      pos_ids = pos_ids.reshape(bs, -1)
+      example_ids = example_ids.reshape(bs, -1) if example_ids is not None else None
+
+    pos_ids = pos_ids + self.rope_offset
 
     if "llama_rope" in pos_emb_type:
       x += self.modality_embedding[None, None, :]
 
-    return InputSequence(x, mask, position_embed = pos_emb)
+    return InputSequence(x, mask, position_ids=pos_ids, segment_ids=example_ids)
 
 
 class InputImageViTEncoder(ModalityEncoder):
@@ -297,16 +321,22 @@ class ViTHistoryEmbedder(nn.Module):
     self.post_projection = nn.Linear(self.resampler_config.emb_dim, cfg.emb_dim, bias=False)
     nn.init.trunc_normal_(self.post_projection.weight, std=math.sqrt(1 / self.resampler_config.emb_dim), a=-2.0, b=2.0)
  
-    self.register_buffer('pos_emb_cache', layers.get_2d_position_embedding(
-      pos_emb_type, (self.resampler_config.max_frames, self.resampler_config.latents_size),
-      (1, 1), cfg.emb_dim, cfg.head_dim, self.modality_idx).reshape(
-      self.resampler_config.max_frames, self.resampler_config.latents_size, -1),
-      persistent=False)
+    # Set to the start of this embedder's table in the model's `layers.RotaryTable`
+    self.rope_offset = 0
 
     if "llama_rope" in pos_emb_type:
       self.modality_embedding = nn.Parameter(torch.empty(cfg.emb_dim).normal_(std=0.02))
 
-  def forward(self, input, pos_ids, mask, *, shared_embed=None, use_constraints=True):
+  def get_rope_cache(self):
+    """Returns the [max_frames * latents_size, head_dim] RoPE cache of the resampled frames"""
+    cfg = self.config
+    pos_emb_type = cfg.image_history_pos_emb if "image" in self.modality else cfg.audio_history_pos_emb
+    return layers.get_2d_position_embedding(
+      pos_emb_type, (self.resampler_config.max_frames, self.resampler_config.latents_size),
+      (1, 1), cfg.emb_dim, cfg.head_dim, self.modality_idx)
+
+  def forward(self, input, pos_ids, mask, *, shared_embed=None, use_constraints=True,
+              example_ids=None):
     cfg = self.config
 
     pos_emb_type = cfg.image_history_pos_emb if "image" in self.modality else cfg.audio_history_pos_emb
@@ -357,19 +387,23 @@ class ViTHistoryEmbedder(nn.Module):
     video_mask = torch.any(compressed_mask > 0, -1, keepdim=True).expand(
       -1, -1, self.resampler_config.latents_size).to(torch.int32)
     
-    video_pos_emb = self.pos_emb_cache[:frames].reshape(-1, self.pos_emb_cache.shape[-1])
-    video_pos_emb = video_pos_emb[None, :, :].expand(batch, -1, -1)
+    latents_size = self.resampler_config.latents_size
+    video_pos_ids = torch.arange(frames*latents_size, device=input.device) + self.rope_offset
+    video_pos_ids = video_pos_ids[None, :].expand(batch, -1)
 
     if "llama_rope" in pos_emb_type:
       video_features += self.modality_embedding[None, None, None, :].to(video_features.dtype)
 
-    latents_size = self.resampler_config.latents_size
-    
     video_features = torch.reshape(video_features, (batch, frames*latents_size, video_features.shape[-1]))
     video_mask = torch.reshape(video_mask, (batch, frames*latents_size))
-    video_pos_emb = torch.reshape(video_pos_emb, (batch, frames*latents_size, video_pos_emb.shape[-1]))
-    
-    return InputSequence(video_features, mask=video_mask, position_embed=video_pos_emb)
+
+    if example_ids is not None:
+      # [batch, frames, patches] -> [batch, frames*latents_size]
+      example_ids = torch.amax(example_ids, -1)
+      example_ids = torch.repeat_interleave(example_ids, latents_size, dim=1)
+
+    return InputSequence(video_features, mask=video_mask, position_ids=video_pos_ids,
+                         segment_ids=example_ids)
 
 
 class InputImageHistoryViTEncoder(ModalityEncoder):
@@ -2,19 +2,21 @@
 
 Many of these are ports
 """
-import functools
-import operator
 import math
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 from torch.nn import functional as F
-from typing import Any, Callable, Iterable, Optional, Sequence, Tuple, Union, List
+from typing import Any, Callable, Dict, Iterable, Optional, Sequence, Tuple, Union, List
 import einops
 
 from transformers import DynamicCache
 
+from uio2.quantization import Int8Linear
+from uio2.seq_features import PatternMask
+
 
 def space_to_depth(
     frames: torch.Tensor,
@@ -132,32 +134,69 @@ def get_rotary_coordinates(seq_len, center_origin=True, llama=False):
   return offset + torch.arange(seq_len, dtype=torch.float32)
 
 
-def apply_rotary(x, rope_cache):
+class RotaryTable(nn.Module):
+  """RoPE sinusoids of every modality in one table that is indexed by position ids
+
+  Embedders output position ids offset into this table, so sequences only carry [batch, length]
+  ids, and the encoder and decoder look the sinusoids up once per forward pass.
+
+  Attributes:
+    offsets: start of the table of each name in the full table
+    use_complex: return complex factors, otherwise return their real and imaginary parts so
+                 RoPE is applied with real arithmetic, as needed by exporters such as ONNX
+  """
+
+  def __init__(self, rope_caches: Dict[str, torch.Tensor]):
+    """
+    Args:
+      rope_caches: name to [n_positions, head_dim] RoPE cache, in the interleaved cos/sin layout
+                   of `build_llama_rope_cache_1d`
+    """
+    super().__init__()
+    self.offsets = {}
+    caches, on = [], 0
+    for name, cache in rope_caches.items():
+      # Modalities with identical tables share them
+      self.offsets[name] = next(
+        (self.offsets[k] for k, v in rope_caches.items() if k in self.offsets and
+         v.shape == cache.shape and torch.equal(v, cache)), on)
+      if self.offsets[name] == on:
+        caches.append(cache)
+        on += cache.shape[0]
+    self.register_buffer("cache", torch.cat(caches), persistent=False)
+    self.use_complex = True
+
+  def forward(self, position_ids: torch.Tensor) -> torch.Tensor:
+    """Returns the complex64 [batch, length, head_dim/2] cos(m*theta) + i*sin(m*theta) factors
+    of `position_ids`, or the float32 [batch, length, head_dim/2, 2] (cos, sin) pairs if
+    `use_complex` is False"""
+    sinusoids = self.cache[position_ids].to(torch.float32).unflatten(-1, (-1, 2))
+    return torch.view_as_complex(sinusoids) if self.use_complex else sinusoids
+
+
+def apply_rotary(x, sinusoids):
   """
   Apply rotary embeddings to the input tensor using the given frequency tensor.
 
   Args:
-    x (torch.Tensor): Input tensor to apply rotary embeddings.
-    rope_cache (torch.Tensor): Precomputed rotary matrices elements.
+    x (torch.Tensor): [batch, length, num_heads, head_dim] input tensor to apply rotary embeddings.
+    sinusoids (torch.Tensor): [batch, length, head_dim/2] complex factors, or
+      [batch, length, head_dim/2, 2] (cos, sin) pairs, from `RotaryTable`.
   
   Returns:
     torch.Tensor: Modfied input tensor with rotary embeddings.
   """
-  # Group two consecutive numbers forming a single complex number.
-  # [batch, length, num_heads, n x rotary_hsize, 2] where n: 1(d) or 2(d)
-  xshaped = x.to(torch.float32).reshape(*x.shape[:-1], -1, 2)
-  # [batch, length, 1, n x rotary_hsize, 2] where n: 1(d) or 2(d)
-  rope_cache = rope_cache.reshape(xshaped.shape[0], xshaped.shape[1], 1, xshaped.shape[3], 2).to(torch.float32)
-  # Apply rotary matrices to the input tensor.
-  x_out2 = torch.stack(
-    [
-      xshaped[..., 0] * rope_cache[..., 0] - xshaped[..., 1] * rope_cache[..., 1], # real(x_m) * cos(m*theta_j) - imag(x_m) * sin(m*theta_j)
-      xshaped[..., 1] * rope_cache[..., 0] + xshaped[..., 0] * rope_cache[..., 1], # real(x_m) * sin(m*theta_j) + imag(x_m) * cos(m*theta_j)
-    ],
-    -1,
-  )
-  x_out2 = torch.reshape(x_out2, x_out2.shape[:3] + (-1, ))
-  return x_out2.to(x.dtype)
+  # Group two consecutive numbers forming a single complex number, rotating them is then a
+  # single complex multiplication:
+  # real(x_m) * cos(m*theta_j) - imag(x_m) * sin(m*theta_j) +
+  # i * (imag(x_m) * cos(m*theta_j) + real(x_m) * sin(m*theta_j))
+  if not sinusoids.is_complex():
+    real, imag = x.to(torch.float32).unflatten(-1, (-1, 2)).unbind(-1)
+    cos, sin = sinusoids[:, :, None].unbind(-1)
+    out = torch.stack([real * cos - imag * sin, imag * cos + real * sin], -1)
+    return out.flatten(-2).to(x.dtype)
+  xc = torch.view_as_complex(x.to(torch.float32).unflatten(-1, (-1, 2)))
+  return torch.view_as_real(xc * sinusoids[:, :, None]).flatten(-2).to(x.dtype)
 
 
 def get_2d_sincos_pos_embed(emb_dim, image_size, image_patch_size, class_token=False, temperature=10000.):
@@ -263,6 +302,33 @@ class Dropout(nn.Dropout):
     return x
 
 
+def checkpoint_layer_ixs(n_layers: int, every_n: int = 1,
+                         memory_budget: Optional[float] = None) -> List[int]:
+  """Returns which of `n_layers` layers to use activation checkpointing on
+
+  Args:
+    n_layers: number of layers in the stack
+    every_n: checkpoint every `every_n`-th layer, starting from the first
+    memory_budget: if set, the fraction of layers to not checkpoint, the checkpointed
+                   layers are spread evenly through the stack, overrides `every_n`
+  """
+  if memory_budget is not None:
+    n_checkpointed = n_layers - int(round(memory_budget * n_layers))
+    return [i * n_layers // n_checkpointed for i in range(n_checkpointed)]
+  return list(range(0, n_layers, every_n))
+
+
+def maybe_checkpoint(enabled: bool, fn: Callable, *args, **kwargs):
+  """Calls `fn` with activation checkpointing if `enabled` and gradients are enabled
+
+  The RNG state is restored for the re-computation, so dropout and drop path make the same
+  choices in both passes.
+  """
+  if enabled and torch.is_grad_enabled():
+    return torch.utils.checkpoint.checkpoint(fn, *args, use_reentrant=False, **kwargs)
+  return fn(*args, **kwargs)
+
+
 def drop_path(x, drop_prob: float = 0., training: bool = False, scale_by_keep: bool = True):
   """Drop paths (Stochastic Depth) per sample (when applied in main path of residual blocks).
 
@@ -305,6 +371,29 @@ class QuickGELU(nn.Module):
     return x * torch.sigmoid(1.702 * x)
     
 
+def _rms_norm_reference(x: torch.Tensor, scale: torch.Tensor, eps: float, dim: int = -1):
+  orig_type = x.dtype
+  x = x.to(torch.float32)
+  norm_x = torch.mean(x * x, dim=dim, keepdim=True)
+  x_normed = x * torch.rsqrt(norm_x + eps)
+  return scale.to(orig_type) * x_normed.to(orig_type)
+
+
+def rms_norm(x: torch.Tensor, scale: torch.Tensor, eps: float, dim: int = -1) -> torch.Tensor:
+  """Normalization of `UIOLayerNorm`, computed in float32 and returned in `x`'s dtype
+
+  Uses the fused `torch.rms_norm` when it is available, which gives the same results.
+  """
+  if not hasattr(torch, "rms_norm") or dim not in (-1, x.ndim - 1):
+    return _rms_norm_reference(x, scale, eps, dim)
+  if x.dtype == torch.float32 and scale.dtype == torch.float32 and scale.shape == x.shape[-1:]:
+    return torch.rms_norm(x, x.shape[-1:], scale, eps)
+  # Lower precision inputs are normalized in float32 and then scaled in their own dtype
+  orig_type = x.dtype
+  x_normed = torch.rms_norm(x.to(torch.float32), x.shape[-1:], eps=eps)
+  return scale.to(orig_type) * x_normed.to(orig_type)
+
+
 class UIOLayerNorm(nn.Module):
   """Layer norm used in the UIO2 Trasnformers, follows T5 and has no bias or mean subtraction"""
 
@@ -315,11 +404,7 @@ class UIOLayerNorm(nn.Module):
     self.dim = dim
 
   def forward(self, x: torch.Tensor) -> torch.Tensor:
-    orig_type = x.dtype
-    x = x.to(torch.float32)
-    norm_x = torch.mean(x * x, dim=self.dim, keepdim=True)
-    x_normed = x * torch.rsqrt(norm_x + self.eps)
-    return self.scale.to(orig_type) * x_normed.to(orig_type)
+    return rms_norm(x, self.scale, self.eps, self.dim)
 
 
 #------------------------------------------------------------------------------
@@ -501,6 +586,220 @@ def dot_product_attention(query: torch.Tensor,
   return torch.einsum('bhqk,bkhd->bqhd', attn_weights, value)
 
 
+def _slice_queries(x: Optional[torch.Tensor], start, end):
+  """Slices a tensor that is broadcastable to `[batch, num_heads, q_length, kv_length]`"""
+  if x is None or x.shape[-2] == 1:
+    return x
+  return x[..., start:end, :]
+
+
+def get_attention_bias(
+    mask: Optional[torch.Tensor], bias: Optional[torch.Tensor], abs_bias: Optional[torch.Tensor],
+    attn_pattern_mask: Optional[Union[torch.Tensor, PatternMask]], dtype, q_start=0, q_end=None):
+  """Builds the attention bias for queries `q_start` to `q_end` from the attention inputs
+
+  Args:
+    mask: 0/1 attention mask broadcastable to `[batch, num_heads, q_length, kv_length]`
+    bias: attention bias broadcastable to `[batch, num_heads, q_length, kv_length]`
+    abs_bias: absolute position bias, only used if `bias` is given
+    attn_pattern_mask: pattern mask, only used if `bias` is given
+    dtype: dtype of the bias
+    q_start: first query to build the bias for
+    q_end: end of the queries to build the bias for, defaults to all queries
+  """
+  if q_end is not None:
+    mask, bias, abs_bias = [_slice_queries(x, q_start, q_end) for x in [mask, bias, abs_bias]]
+
+  # Convert the 0/1 attention mask to an attention bias.
+  if mask is not None:
+    attention_bias = torch.zeros_like(mask, dtype=dtype)
+    attention_bias.masked_fill_(~(mask > 0), -1e10)
+  else:
+    attention_bias = None
+
+  # Add provided bias term (e.g. relative position embedding).
+  if bias is not None:
+    # The pattern mask is only used alongside a bias, so only build it in that case
+    if attn_pattern_mask is not None:
+      if isinstance(attn_pattern_mask, PatternMask):
+        attn_pattern_mask = attn_pattern_mask.materialize(q_start, q_end)
+      elif q_end is not None:
+        attn_pattern_mask = _slice_queries(attn_pattern_mask, q_start, q_end)
+      pattern_bias = torch.zeros_like(attn_pattern_mask, dtype=dtype)
+      pattern_bias.masked_fill_(~(attn_pattern_mask > 0), -1e10)
+    else:
+      pattern_bias = None
+    attention_bias = combine_biases(attention_bias, pattern_bias, bias, abs_bias)
+  return attention_bias
+
+
+def chunked_dot_product_attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    chunk_size: int,
+    mask: Optional[torch.Tensor] = None,
+    bias: Optional[torch.Tensor] = None,
+    abs_bias: Optional[torch.Tensor] = None,
+    attn_pattern_mask: Optional[Union[torch.Tensor, PatternMask]] = None,
+    **kwargs):
+  """Computes `dot_product_attention` for `chunk_size` queries at a time
+
+  Each chunk attends to all the keys, so the output matches `dot_product_attention`, but the
+  attention weights and biases are only built for one chunk of queries at a time. This caps
+  the memory of the `[batch, num_heads, q_length, kv_length]` intermediates to
+  `[batch, num_heads, chunk_size, kv_length]`.
+
+  Args:
+    query: queries of shape `[batch, q_length, num_heads, qk_depth_per_head]`
+    key: keys of shape `[batch, kv_length, num_heads, qk_depth_per_head]`
+    value: values of shape `[batch, kv_length, num_heads, v_depth_per_head]`
+    chunk_size: number of queries to compute at a time
+    mask: see `get_attention_bias`
+    bias: see `get_attention_bias`
+    abs_bias: see `get_attention_bias`
+    attn_pattern_mask: see `get_attention_bias`
+    **kwargs: passed to `dot_product_attention`
+
+  Returns:
+    Output of shape `[batch, q_length, num_heads, v_depth_per_head]`.
+  """
+  q_len = query.shape[1]
+  out = []
+  for start in range(0, q_len, chunk_size):
+    end = min(start + chunk_size, q_len)
+    chunk_bias = get_attention_bias(
+      mask, bias, abs_bias, attn_pattern_mask, query.dtype, start, end)
+    out.append(dot_product_attention(
+      query[:, start:end], key, value, bias=chunk_bias, **kwargs))
+  return torch.cat(out, 1)
+
+
+def _output_logits(hidden, weight):
+  logits = F.linear(hidden, weight)
+  return (logits / math.sqrt(hidden.shape[-1])).to(torch.float32)
+
+
+class _ChunkedCrossEntropy(torch.autograd.Function):
+  """Cross-entropy of output logits that only builds `chunk_size` rows of logits at a time
+
+  The backward pass re-computes each chunk's logits and computes their gradient directly, so no
+  logits are stored between the passes.
+  """
+
+  @staticmethod
+  def forward(ctx, hidden, weight, targets, chunk_size):
+    losses, log_z = [], []
+    for start in range(0, hidden.shape[0], chunk_size):
+      logits = _output_logits(hidden[start:start+chunk_size], weight)
+      chunk_log_z = torch.logsumexp(logits, -1)
+      target_logits = torch.gather(logits, -1, targets[start:start+chunk_size, None])[:, 0]
+      losses.append(chunk_log_z - target_logits)
+      log_z.append(chunk_log_z)
+    losses = torch.cat(losses) if losses else hidden.new_zeros((0,), dtype=torch.float32)
+    log_z = torch.cat(log_z) if log_z else hidden.new_zeros((0,), dtype=torch.float32)
+    ctx.save_for_backward(hidden, weight, targets, log_z)
+    ctx.chunk_size = chunk_size
+    return losses, log_z
+
+  @staticmethod
+  def backward(ctx, grad_losses, grad_log_z):
+    hidden, weight, targets, log_z = ctx.saved_tensors
+    chunk_size = ctx.chunk_size
+    scale = 1.0 / math.sqrt(hidden.shape[-1])
+    if grad_losses is None:
+      grad_losses = torch.zeros_like(log_z)
+    if grad_log_z is None:
+      grad_log_z = torch.zeros_like(log_z)
+    grad_hidden = torch.empty_like(hidden) if ctx.needs_input_grad[0] else None
+    grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) \
+      if ctx.needs_input_grad[1] else None
+    for start in range(0, hidden.shape[0], chunk_size):
+      end = start + chunk_size
+      chunk_hidden = hidden[start:end]
+      # d/d_logits of loss = log_z - logits[target] is softmax - one_hot(target)
+      grad_logits = torch.exp_(_output_logits(chunk_hidden, weight) - log_z[start:end, None])
+      grad_logits.mul_((grad_losses[start:end] + grad_log_z[start:end])[:, None])
+      rows = torch.arange(grad_logits.shape[0], device=grad_logits.device)
+      grad_logits[rows, targets[start:end]] -= grad_losses[start:end]
+      grad_logits = (grad_logits * scale).to(hidden.dtype)
+      if grad_hidden is not None:
+        grad_hidden[start:end] = grad_logits @ weight
+      if grad_weight is not None:
+        grad_weight += (grad_logits.T @ chunk_hidden).to(torch.float32)
+    if grad_weight is not None:
+      grad_weight = grad_weight.to(weight.dtype)
+    return grad_hidden, grad_weight, None, None
+
+
+def chunked_cross_entropy(hidden: torch.Tensor, weight: torch.Tensor, targets: torch.Tensor,
+                          chunk_size: int = 1024) -> Tuple[torch.Tensor, torch.Tensor]:
+  """Cross-entropy of the output logits, computed `chunk_size` tokens at a time
+
+  Logits are `hidden @ weight.T / sqrt(emb_dim)` as in `UnifiedIOModel.forward`, computed in
+  float32. Neither pass holds more than `[chunk_size, vocab_size]` logits at a time, the
+  backward pass re-computes them instead of storing them.
+
+  Args:
+    hidden: [n, emb_dim] hidden states
+    weight: [vocab_size, emb_dim] output embedding
+    targets: [n] target token ids
+    chunk_size: number of tokens to compute logits for at a time
+
+  Returns:
+    [n] per-token cross-entropy and [n] log-partition function of the logits
+  """
+  return _ChunkedCrossEntropy.apply(hidden, weight, targets.to(torch.long), chunk_size)
+
+
+def concat_linears(linears: List[nn.Module]) -> nn.Module:
+  """Returns one linear layer that computes the concatenated outputs of `linears`"""
+  if all(isinstance(x, Int8Linear) for x in linears):
+    bias = None if linears[0].bias is None else torch.cat([x.bias for x in linears])
+    return Int8Linear(
+      torch.cat([x.qweight for x in linears]), torch.cat([x.scale for x in linears]), bias)
+  if not all(type(x) is nn.Linear for x in linears):
+    raise NotImplementedError(f"Cannot concatenate {[type(x).__name__ for x in linears]}")
+  weight = torch.cat([x.weight for x in linears])
+  out = nn.Linear(weight.shape[1], weight.shape[0], bias=linears[0].bias is not None,
+                  device="meta")
+  out.weight = nn.Parameter(weight, requires_grad=linears[0].weight.requires_grad)
+  if out.bias is not None:
+    out.bias = nn.Parameter(torch.cat([x.bias for x in linears]),
+                            requires_grad=linears[0].bias.requires_grad)
+  return out
+
+
+def all_reduce_shards(x: torch.Tensor, process_group) -> torch.Tensor:
+  """Sums the partial outputs of a row-parallel projection over `process_group`, if set"""
+  if process_group is None:
+    return x
+  torch.distributed.all_reduce(x, group=process_group)
+  return x
+
+
+def split_packed_state_dict(state_dict, prefix: str, packed: str, names: List[str]):
+  """Replaces the tensors of the `packed` module in `state_dict` with tensors for `names`
+
+  Used so modules with projections packed by `concat_linears` save the same names and shapes
+  as the separate projections.
+  """
+  for key in [k for k in state_dict if k.startswith(f"{prefix}{packed}.")]:
+    tensor_name = key[len(f"{prefix}{packed}."):]
+    # Cloned so the tensors do not share memory, which safetensors does not allow
+    for name, part in zip(names, state_dict.pop(key).chunk(len(names))):
+      state_dict[f"{prefix}{name}.{tensor_name}"] = part.clone()
+
+
+def pack_state_dict(state_dict, prefix: str, packed: str, names: List[str]):
+  """Inverse of `split_packed_state_dict`, concatenates the tensors of `names` in-place"""
+  first = f"{prefix}{names[0]}."
+  for key in [k for k in state_dict if k.startswith(first)]:
+    tensor_name = key[len(first):]
+    state_dict[f"{prefix}{packed}.{tensor_name}"] = torch.cat(
+      [state_dict.pop(f"{prefix}{name}.{tensor_name}") for name in names])
+
+
 class MultiHeadDotProductAttention(nn.Module):
   """Multi-head dot-product attention.
 
@@ -512,6 +811,10 @@ class MultiHeadDotProductAttention(nn.Module):
       dropout_rate: dropout rate
       float32_logits: bool, if True then compute logits in float32 to avoid
         numerical issues with bfloat16.
+      chunk_size: if set, compute attention for this many queries at a time to
+        reduce memory, see `chunked_dot_product_attention`.
+      qkv, kv: packed query/key/value or key/value projections, see `fuse_projections`.
+      process_group: group the heads are sharded over, see `parallel.shard_model`.
   """
 
   def __init__(
@@ -528,10 +831,12 @@ class MultiHeadDotProductAttention(nn.Module):
       depth_normalize: bool = True,
       clip_attn_logit: Any = None,
       scaled_cosine: bool = False,
-      layer_idx: int=None
+      layer_idx: int=None,
+      chunk_size: Optional[int] = None
   ):
     super().__init__()
     self.num_heads = num_heads
+    self.chunk_size = chunk_size
     self.head_dim = head_dim
     assert emb_dim == num_heads * head_dim, "embed_dim must be divisible by num_heads"
     self.dropout_rate = dropout_rate
@@ -579,6 +884,89 @@ class MultiHeadDotProductAttention(nn.Module):
     if use_bias:
       nn.init.zeros_(self.out.bias)
 
+    # Set by `fuse_projections`
+    self.qkv = None
+    self.kv = None
+    # Set by `parallel.shard_model`
+    self.process_group = None
+    self._register_state_dict_hook(MultiHeadDotProductAttention._split_fused_state_dict)
+    self._register_load_state_dict_pre_hook(
+      MultiHeadDotProductAttention._fuse_state_dict, with_module=True)
+
+  def _fused_names(self):
+    if self.qkv is not None:
+      return "qkv", ["query", "key", "value"]
+    if self.kv is not None:
+      return "kv", ["key", "value"]
+    return None, None
+
+  @staticmethod
+  def _split_fused_state_dict(module, state_dict, prefix, local_metadata):
+    fused, names = module._fused_names()
+    if fused is not None:
+      split_packed_state_dict(state_dict, prefix, fused, names)
+
+  def _fuse_state_dict(self, state_dict, prefix, *args):
+    fused, names = self._fused_names()
+    if fused is not None:
+      pack_state_dict(state_dict, prefix, fused, names)
+
+  def fuse_projections(self, self_attention: bool = True):
+    """Packs the query, key and value projections into one `qkv` projection
+
+    Self-attention then projects its input with one matmul, and applies qk-norm and RoPE to
+    the queries and keys together. If `self_attention` is False, only the key and value
+    projections are packed into a `kv` projection so queries can have different inputs.
+    The state dict keeps the layout of the separate projections, so checkpoints are unchanged.
+    """
+    if self.qkv is not None or self.kv is not None:
+      return
+    if self_attention:
+      self.qkv = concat_linears([self.query, self.key, self.value])
+      del self.query
+    else:
+      self.kv = concat_linears([self.key, self.value])
+    del self.key
+    del self.value
+
+  def project_key_value(self, inputs_kv: torch.Tensor, k_sinusoids: Optional[torch.Tensor] = None):
+    """Returns the [batch, kv_length, num_heads, head_dim] keys and values of `inputs_kv`
+
+    Keys have qk-norm and RoPE applied, so they can be computed once and passed as `key_value`
+    for cross-attention to the same inputs.
+    """
+    bs, kv_len = inputs_kv.shape[:2]
+    if self.qkv is not None:
+      raise ValueError("Keys and values are packed with the queries for self-attention")
+    if self.kv is not None:
+      key, value = self.kv(inputs_kv).reshape(
+        bs, kv_len, 2, self.num_heads, self.head_dim).unbind(2)
+    else:
+      key = self.key(inputs_kv).reshape(bs, kv_len, self.num_heads, self.head_dim)
+      value = self.value(inputs_kv).reshape(bs, kv_len, self.num_heads, self.head_dim)
+    if self.qk_norm:
+      key = self.key_norm(key)
+    if k_sinusoids is not None:
+      key = apply_rotary(key, k_sinusoids)
+    return key, value
+
+  def _qk_norm_and_rotary(self, qk, q_sinusoids, k_sinusoids):
+    """Applies qk-norm and RoPE to [batch, length, 2, num_heads, head_dim] queries and keys"""
+    bs, seq_len = qk.shape[:2]
+    if self.qk_norm:
+      assert self.query_norm.eps == self.key_norm.eps
+      scale = torch.stack([self.query_norm.scale, self.key_norm.scale])[:, None]
+      qk = rms_norm(qk, scale, self.query_norm.eps)
+    if q_sinusoids is not None and q_sinusoids is k_sinusoids:
+      qk = apply_rotary(qk.reshape(bs, seq_len, 2*self.num_heads, self.head_dim), q_sinusoids)
+      qk = qk.reshape(bs, seq_len, 2, self.num_heads, self.head_dim)
+    query, key = qk.unbind(2)
+    if q_sinusoids is not None and q_sinusoids is not k_sinusoids:
+      query = apply_rotary(query, q_sinusoids)
+    if k_sinusoids is not None and q_sinusoids is not k_sinusoids:
+      key = apply_rotary(key, k_sinusoids)
+    return query, key
+
   def forward(
       self,
       inputs_q: torch.Tensor,
@@ -588,9 +976,10 @@ class MultiHeadDotProductAttention(nn.Module):
       abs_bias: Optional[torch.Tensor] = None,
       q_sinusoids: Optional[torch.Tensor] = None,
       k_sinusoids: Optional[torch.Tensor] = None,
-      attn_pattern_mask: Optional[torch.Tensor] = None,
+      attn_pattern_mask: Optional[Union[torch.Tensor, PatternMask]] = None,
       *,
       past_key_values: Optional[DynamicCache]=None,
+      key_value: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
       decode: bool = False) -> torch.Tensor:
     """Applies multi-head dot product attention on the input data.
 
@@ -606,45 +995,35 @@ class MultiHeadDotProductAttention(nn.Module):
         `[batch, q_length, n * 2 (cos then sin) * rotary_hsize <= size_per_head]` where n: 1(d) or 2(d).
       k_sinusoids: sinusoidal values for the block diagonal matrix of key RoPE.
         `[batch, kv_length, 2 (cos then sin) * rotary_hsize <= size_per_head]` where n: 1(d) or 2(d).
+      attn_pattern_mask: attention pattern mask of shape `[batch, 1, q_length, kv_length]`,
+        only applied if `bias` is given.
+      key_value: keys and values from `project_key_value` to use instead of projecting
+        `inputs_kv`, which can then be None.
       decode: Whether to prepare and use an autoregressive cache.
 
     Returns:
       output of shape `[batch, length, q_features]`.
     """
     bs, q_len, emb_dim = inputs_q.shape
-    kv_len = inputs_kv.shape[1]
     # Project inputs_q/inputs_kv to multi-headed q/k/v
     # dimensions are then [batch, length, num_heads, head_dim]
-    query = self.query(inputs_q).reshape(bs, q_len, self.num_heads, self.head_dim)
-    key = self.key(inputs_kv).reshape(bs, kv_len, self.num_heads, self.head_dim)
-    value = self.value(inputs_kv).reshape(bs, kv_len, self.num_heads, self.head_dim)
-
-    if self.qk_norm:
-      query = self.query_norm(query)
-      key = self.key_norm(key)
-    
-    if q_sinusoids is not None:
-      query = apply_rotary(query, q_sinusoids)
-    if k_sinusoids is not None:
-      key = apply_rotary(key, k_sinusoids)
-    
-    # Convert the 0/1 attention mask to an attention bias.
-    if mask is not None:
-      attention_bias = torch.zeros_like(mask, dtype=query.dtype)
-      attention_bias.masked_fill_(~(mask > 0), -1e10)
+    if self.qkv is not None:
+      if inputs_q is not inputs_kv:
+        raise ValueError("Packed query/key/value projections can only be used for self-attention")
+      qkv = self.qkv(inputs_q).reshape(bs, q_len, 3, self.num_heads, self.head_dim)
+      value = qkv[:, :, 2]
+      query, key = self._qk_norm_and_rotary(qkv[:, :, :2], q_sinusoids, k_sinusoids)
     else:
-      attention_bias = None
-    
-    if attn_pattern_mask is not None:
-      pattern_bias = torch.zeros_like(attn_pattern_mask, dtype=query.dtype)
-      pattern_bias.masked_fill_(~(attn_pattern_mask > 0), -1e10)
-    else:
-      pattern_bias = None
-    
-    # Add provided bias term (e.g. relative position embedding).
-    if bias is not None:
-      attention_bias = combine_biases(attention_bias, pattern_bias, bias, abs_bias)
-    
+      query = self.query(inputs_q).reshape(bs, q_len, self.num_heads, self.head_dim)
+      if self.qk_norm:
+        query = self.query_norm(query)
+      if q_sinusoids is not None:
+        query = apply_rotary(query, q_sinusoids)
+      if key_value is None:
+        key, value = self.project_key_value(inputs_kv, k_sinusoids)
+      else:
+        key, value = key_value
+
     if self.scaled_cosine:
       logit_scale = self.logit_scale.reshape(1, self.num_heads, 1, 1)
     else:
@@ -654,32 +1033,37 @@ class MultiHeadDotProductAttention(nn.Module):
       # The cache expects seq_dim to be the second-to-last-dim
       key = torch.transpose(key, 1, 2)
       value = torch.transpose(value, 1, 2)
-      past_key_values.update(key, value, self.layer_idx)
-      key, value = past_key_values[self.layer_idx]
+      key, value = past_key_values.update(key, value, self.layer_idx)
       key = torch.transpose(key, 1, 2)
       value = torch.transpose(value, 1, 2)
-      assert attention_bias is None
+      # A mask is only allowed if it covers the cached keys, which happens when
+      # several new tokens are decoded in one step
+      assert mask is None or mask.shape[-1] == key.shape[1]
 
     # Apply attention.
-    x = dot_product_attention(
-        query,
-        key,
-        value,
-        bias=attention_bias,
+    attention_kwargs = dict(
         dropout_fn=self.attn_drop,
         depth_normalize=self.depth_normalize,
         clip_attn_logit=self.clip_attn_logit,
-        float32_logits=self.float32_logits, 
+        float32_logits=self.float32_logits,
         logit_scale=logit_scale)
+    if self.chunk_size is not None and q_len > self.chunk_size:
+      x = chunked_dot_product_attention(
+        query, key, value, self.chunk_size, mask, bias, abs_bias, attn_pattern_mask,
+        **attention_kwargs)
+    else:
+      attention_bias = get_attention_bias(mask, bias, abs_bias, attn_pattern_mask, query.dtype)
+      x = dot_product_attention(query, key, value, bias=attention_bias, **attention_kwargs)
 
     if self.use_head_scale:
       head_scale = self.head_scale.reshape(1, 1, self.num_heads, 1)
       x = x * head_scale
     
-    x = x.reshape(bs, q_len, emb_dim)
+    # Heads are split across processes if this layer is sharded
+    x = x.reshape(bs, q_len, self.num_heads * self.head_dim)
     # Back to the original inputs dimensions.
     out = self.out(x)
-    return out
+    return all_reduce_shards(out, self.process_group)
 
 
 def identity(x):
@@ -710,6 +1094,9 @@ class MlpBlock(nn.Module):
       'linear', a string function name in torch.nn.functional, or a function.
     intermediate_dropout_rate: Dropout rate used after the intermediate layers.
     dropout_braodcast_dims:
+    wi_packed: packed `wi_{idx}` projections, see `fuse_projections`.
+    process_group: group the intermediate features are sharded over, see
+      `parallel.shard_model`.
   """
   def __init__(
       self,
@@ -722,6 +1109,7 @@ class MlpBlock(nn.Module):
   ):
     super().__init__()
     self.activations = activations
+    self.activation_fns = [_convert_to_activation_function(x) for x in activations]
     if len(activations) == 1:
       self.wi = nn.Linear(emb_dim, intermediate_dim, bias=use_bias)
     else:
@@ -729,21 +1117,57 @@ class MlpBlock(nn.Module):
         self.add_module(f"wi_{idx}", nn.Linear(emb_dim, intermediate_dim, bias=use_bias))
     self.dropout = Dropout(intermediate_dropout_rate, broadcast_dims=dropout_broadcast_dims)
     self.wo = nn.Linear(intermediate_dim, emb_dim, bias=use_bias)
-  
+
+    # Set by `fuse_projections`
+    self.wi_packed = None
+    # Set by `parallel.shard_model`
+    self.process_group = None
+    self._register_state_dict_hook(MlpBlock._split_packed_state_dict)
+    self._register_load_state_dict_pre_hook(MlpBlock._pack_state_dict, with_module=True)
+
+  def _packed_names(self):
+    return [f"wi_{idx}" for idx in range(len(self.activations))]
+
+  @staticmethod
+  def _split_packed_state_dict(module, state_dict, prefix, local_metadata):
+    if module.wi_packed is not None:
+      split_packed_state_dict(state_dict, prefix, "wi_packed", module._packed_names())
+
+  def _pack_state_dict(self, state_dict, prefix, *args):
+    if self.wi_packed is not None:
+      pack_state_dict(state_dict, prefix, "wi_packed", self._packed_names())
+
+  def fuse_projections(self):
+    """Packs the `wi_{idx}` projections of gated MLPs into one `wi_packed` projection
+
+    The input is then projected with one matmul, the state dict keeps the layout of the
+    separate projections so checkpoints are unchanged.
+    """
+    if len(self.activations) == 1 or self.wi_packed is not None:
+      return
+    names = self._packed_names()
+    self.wi_packed = concat_linears([getattr(self, name) for name in names])
+    for name in names:
+      delattr(self, name)
+
   def forward(self, inputs):
     """Applies Transformer MlpBlock module."""
-    activations = []
-    for idx, act_fn in enumerate(self.activations):
-      dense_name = 'wi' if len(self.activations) == 1 else f'wi_{idx}'
-      x = getattr(self, dense_name)(inputs)
-      x = _convert_to_activation_function(act_fn)(x)
-      activations.append(x)
-    # Take elementwise product of above intermediate activations.
-    x = functools.reduce(operator.mul, activations)
+    if len(self.activations) == 1:
+      x = self.activation_fns[0](self.wi(inputs))
+    else:
+      if self.wi_packed is not None:
+        hidden = self.wi_packed(inputs).chunk(len(self.activations), dim=-1)
+      else:
+        hidden = [getattr(self, name)(inputs) for name in self._packed_names()]
+      # Take elementwise product of above intermediate activations, in-place if there
+      # is no backward pass so no other intermediate tensors are allocated
+      x = self.activation_fns[0](hidden[0])
+      for act_fn, h in zip(self.activation_fns[1:], hidden[1:]):
+        x = x * act_fn(h) if torch.is_grad_enabled() else x.mul_(act_fn(h))
     # Apply dropout and final dense output projection.
     x = self.dropout(x)
     output = self.wo(x)
-    return output
+    return all_reduce_shards(output, self.process_group)
 
 
 class VectorQuantizer(nn.Module):
@@ -1,3 +1,4 @@
+import contextlib
 import copy
 import json
 import math
@@ -12,11 +13,16 @@ from transformers import GenerationMixin, DynamicCache, GenerationConfig
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.utils import ModelOutput, CONFIG_NAME
 
-from uio2.config import Config, T5Config
-from uio2 import seq_features, layers
+from uio2.config import Config, T5Config, BOS_ID, EOS_ID
+from uio2 import seq_features, layers, quantization, compilation, parallel
+from uio2.answer_options import AnswerOptions, OptionTrie
+from uio2.checkpoint_utils import SafetensorsCheckpoint, load_safetensors_checkpoint, \
+  init_empty_parameters, get_missing, materialize_missing
 from uio2.get_modality_processor import get_input_modalities, get_target_modalities
+from uio2.perceiver import PerceiverResampler, Attention as PerceiverAttention, \
+  CrossAttention as PerceiverCrossAttention
 from uio2.runner import ClfFreeGuidanceProcessor
-from uio2.seq_features import InputSequence
+from uio2.seq_features import InputSequence, select_pattern
 from uio2.utils import unflatten_dict, pad_and_cat
 
 
@@ -33,11 +39,14 @@ class EncoderLayer(nn.Module):
       dropout_rate=config.dropout_rate,
       float32_logits=config.float32_attention_logits,
       qk_norm=config.qk_norm,
+      chunk_size=config.attention_chunk_size,
     )
     self.pre_mlp_norm = layers.UIOLayerNorm(dim)
     self.drop = layers.Dropout(config.dropout_rate, broadcast_dims=(-2, ))
     self.mlp = layers.MlpBlock(dim, config.mlp_dim, config.mlp_activations,
                                intermediate_dropout_rate=config.dropout_rate)
+    # Activation checkpointing policy, see `UnifiedIOModel.set_gradient_checkpointing`
+    self.checkpoint = None
 
   def forward(self, inputs, encoder_mask=None, abs_bias=None, sinusoids=None):
     # Attention block.
@@ -45,7 +54,8 @@ class EncoderLayer(nn.Module):
     x = self.pre_attention_norm(inputs)
 
     # [batch, length, emb_dim] -> [batch, length, emb_dim]
-    x = self.attention(
+    x = layers.maybe_checkpoint(
+      self.checkpoint == "attention", self.attention,
       x, x, encoder_mask, None, abs_bias=abs_bias,
       q_sinusoids=sinusoids, k_sinusoids=sinusoids)
 
@@ -66,8 +76,9 @@ class EncoderLayer(nn.Module):
 
 class Encoder(nn.Module):
   """A stack of encoder layers."""
-  def __init__(self, config: T5Config):
+  def __init__(self, config: T5Config, rotary: layers.RotaryTable):
     super().__init__()
+    self.rotary = rotary
     self.drop = layers.Dropout(config.dropout_rate, broadcast_dims=(-2, ))
     for lyr in range(config.num_encoder_layers):
       self.add_module(f'layers_{lyr}', EncoderLayer(config))
@@ -83,11 +94,13 @@ class Encoder(nn.Module):
       # Only attend between items belonging to the same segment
       mask = mask * torch.unsqueeze(seq.segment_ids[:, :, None] == seq.segment_ids[:, None, :], 1)
     mask = mask.to(embed.dtype)
-    pos_emb = seq.position_embed
-    sinusoids = pos_emb if (pos_emb is not None and pos_emb.shape[-1] != embed.shape[-1]) else None
+    # Looked up once and shared by all the layers
+    sinusoids = None if seq.position_ids is None else self.rotary(seq.position_ids)
 
     for lyr in range(self.config.num_encoder_layers):
-      embed = getattr(self, f'layers_{lyr}')(embed, mask, sinusoids=sinusoids)
+      layer: EncoderLayer = getattr(self, f'layers_{lyr}')
+      embed = layers.maybe_checkpoint(
+        layer.checkpoint == "layer", layer, embed, mask, sinusoids=sinusoids)
 
     embed = self.encoder_norm(embed)
     embed = self.drop(embed)
@@ -107,17 +120,21 @@ class DecoderLayer(nn.Module):
     self.pre_self_attention_norm = layers.UIOLayerNorm(dim)
     self.self_attention = layers.MultiHeadDotProductAttention(
       dim, config.num_heads, config.head_dim, qk_norm=config.qk_norm,
-      float32_logits=config.float32_attention_logits, layer_idx=layer_idx)
+      float32_logits=config.float32_attention_logits, layer_idx=layer_idx,
+      chunk_size=config.attention_chunk_size)
 
     if enable_xattention:
       self.pre_cross_attention_norm = layers.UIOLayerNorm(dim)
       self.encoder_decoder_attention = layers.MultiHeadDotProductAttention(
-        dim, config.num_heads, config.head_dim, dropout_rate=config.dropout_rate, float32_logits=config.float32_attention_logits, qk_norm=config.qk_norm)
+        dim, config.num_heads, config.head_dim, dropout_rate=config.dropout_rate, float32_logits=config.float32_attention_logits, qk_norm=config.qk_norm,
+        chunk_size=config.attention_chunk_size)
 
     self.pre_mlp_norm = layers.UIOLayerNorm(dim)
     self.drop = layers.Dropout(config.dropout_rate, broadcast_dims=(-2, ))
     self.mlp = layers.MlpBlock(dim, config.mlp_dim, config.mlp_activations,
                                intermediate_dropout_rate=config.dropout_rate)
+    # Activation checkpointing policy, see `UnifiedIOModel.set_gradient_checkpointing`
+    self.checkpoint = None
 
   def forward(self,
               inputs,
@@ -129,13 +146,18 @@ class DecoderLayer(nn.Module):
               decoder_sinusoids=None,
               encoder_sinusoids=None,
               attn_pattern_mask=None,
-              past_key_values: Optional[DynamicCache]=None
+              past_key_values: Optional[DynamicCache]=None,
+              cross_key_value=None
               ):
     # inputs: embedded inputs to the decoder with shape [batch, length, emb_dim]
     x = self.pre_self_attention_norm(inputs)
 
-    # Self-attention block
-    x = self.self_attention(
+    # Self-attention block, not checkpointed when using a cache since the re-computation
+    # would update the cache a second time
+    checkpoint_attention = self.checkpoint == "attention"
+    x = layers.maybe_checkpoint(
+      checkpoint_attention and past_key_values is None,
+      self.self_attention,
       x,
       x,
       decoder_mask,
@@ -154,13 +176,16 @@ class DecoderLayer(nn.Module):
       # Encoder-Decoder block.
       y = self.pre_cross_attention_norm(x)
 
-      y = self.encoder_decoder_attention(
+      y = layers.maybe_checkpoint(
+        checkpoint_attention,
+        self.encoder_decoder_attention,
         y,
         encoded,
         encoder_decoder_mask,
         cross_abs_pos_bias,
         q_sinusoids=decoder_sinusoids,
-        k_sinusoids=encoder_sinusoids)
+        k_sinusoids=encoder_sinusoids,
+        key_value=cross_key_value)
 
       y = self.drop(y)
 
@@ -180,9 +205,12 @@ class Decoder(nn.Module, GenerationMixin):
   """A stack of decoder layers"""
 
   main_input_name = "input_ids"
+  # Allows passing a `Cache`, such as `Int8DynamicCache`, as `past_key_values` to `generate`
+  _supports_cache_class = True
 
-  def __init__(self, config: T5Config):
+  def __init__(self, config: T5Config, rotary: layers.RotaryTable):
     super().__init__()
+    self.rotary = rotary
     self.config = copy.deepcopy(config)
     self.config.is_encoder_decoder = False
     n = config.num_decoder_layers
@@ -195,14 +223,17 @@ class Decoder(nn.Module, GenerationMixin):
 
     self.decoder_norm = layers.UIOLayerNorm(config.emb_dim)
     self.drop = layers.Dropout(p=config.dropout_rate, broadcast_dims=(-2,))
+    # Compiled `forward` used for decoding steps with a `StaticCache`, see
+    # `UnifiedIOModel.compile_generation`
+    self.compiled_step = None
 
   def forward(
     self,
     encoded=None,
     decoder_embedding=None,
-    decoder_pos_emb=None,
+    decoder_position_ids=None,
     decoder_attn_mask=None,
-    encoder_pos_emb=None,
+    encoder_position_ids=None,
     encoder_decoder_mask=None,
     decoder_bias=None,
     attn_pattern_mask=None,
@@ -210,6 +241,8 @@ class Decoder(nn.Module, GenerationMixin):
     # Used for inference
     input_ids=None,
     past_key_values: Optional[DynamicCache] = None,
+    # Keys and values of each layer's cross-attention, see `project_cross_key_values`
+    cross_key_values=None,
     return_dict=False,
     output_attentions=False,
     output_hidden_states=False,
@@ -218,6 +251,14 @@ class Decoder(nn.Module, GenerationMixin):
     if output_attentions or output_hidden_states:
       raise NotImplementedError()
 
+    if (self.compiled_step is not None and isinstance(past_key_values, compilation.StaticCache)
+        and not torch.compiler.is_compiling()):
+      return self.compiled_step(
+        encoded, decoder_embedding, decoder_position_ids, decoder_attn_mask,
+        encoder_position_ids, encoder_decoder_mask, decoder_bias, attn_pattern_mask,
+        past_key_values=past_key_values, cross_key_values=cross_key_values,
+        return_dict=return_dict, logit_weights=logit_weights)
+
     cfg = self.config
     assert decoder_embedding.ndim == 3  # [batch, len]
 
@@ -226,13 +267,12 @@ class Decoder(nn.Module, GenerationMixin):
     y = self.drop(y)
 
     cross_abs_pos_bias = None
-    use_rope = (
-        encoder_pos_emb is not None and decoder_pos_emb is not None and
-        decoder_embedding.shape[-1] != decoder_pos_emb.shape[-1] and
-        decoder_pos_emb.shape[-1] == encoder_pos_emb.shape[-1]
-    )
-    encoder_sinusoids = encoder_pos_emb if use_rope else None
-    decoder_sinusoids = decoder_pos_emb if use_rope else None
+    # Looked up once and shared by all the layers
+    encoder_sinusoids, decoder_sinusoids = None, None
+    if encoder_position_ids is not None:
+      encoder_sinusoids = self.rotary(encoder_position_ids)
+    if decoder_position_ids is not None:
+      decoder_sinusoids = self.rotary(decoder_position_ids)
 
     return_kv_cache = []
     hidden_state = []
@@ -241,16 +281,18 @@ class Decoder(nn.Module, GenerationMixin):
 
       if attn_pattern_mask is not None:
         if lyr_ix == cfg.num_decoder_layers - 1:
-          attn_pattern_lyr = attn_pattern_mask[:,2:3]
+          attn_pattern_lyr = select_pattern(attn_pattern_mask, 2)
         elif (lyr_ix - 1) % 4 == 0:
-          attn_pattern_lyr = attn_pattern_mask[:,1:2]
+          attn_pattern_lyr = select_pattern(attn_pattern_mask, 1)
         else:
-          attn_pattern_lyr = attn_pattern_mask[:,0:1]
+          attn_pattern_lyr = select_pattern(attn_pattern_mask, 0)
       else:
         attn_pattern_lyr = None
 
       lyr: DecoderLayer = self.get_submodule(f'layers_{lyr_ix}')
-      y = lyr(
+      y = layers.maybe_checkpoint(
+        lyr.checkpoint == "layer" and past_key_values is None,
+        lyr,
         y,
         encoded,
         decoder_mask=decoder_attn_mask,
@@ -260,7 +302,8 @@ class Decoder(nn.Module, GenerationMixin):
         decoder_sinusoids=decoder_sinusoids,
         encoder_sinusoids=encoder_sinusoids,
         attn_pattern_mask=attn_pattern_lyr,
-        past_key_values=past_key_values
+        past_key_values=past_key_values,
+        cross_key_value=None if cross_key_values is None else cross_key_values[lyr_ix]
       )
 
     y = self.decoder_norm(y)
@@ -276,6 +319,24 @@ class Decoder(nn.Module, GenerationMixin):
     else:
       return y
 
+  def project_cross_key_values(self, encoded, encoder_position_ids=None):
+    """Returns the cross-attention keys and values of each layer for `cross_key_values`
+
+    Layers without cross-attention get None.
+    """
+    encoder_sinusoids = None
+    if encoder_position_ids is not None:
+      encoder_sinusoids = self.rotary(encoder_position_ids)
+    key_values = []
+    for lyr_ix in range(self.config.num_decoder_layers):
+      lyr: DecoderLayer = self.get_submodule(f'layers_{lyr_ix}')
+      if lyr.enable_xattention:
+        key_values.append(lyr.encoder_decoder_attention.project_key_value(
+          encoded, encoder_sinusoids))
+      else:
+        key_values.append(None)
+    return key_values
+
   def _expand_inputs_for_generation(
       self,
       expand_size: int = 1,
@@ -290,7 +351,7 @@ class Decoder(nn.Module, GenerationMixin):
     return ix, args
 
   def prepare_inputs_for_generation(
-      self, input_ids, encoder_pos_emb, encoded, encoder_mask, modality, use_cache,
+      self, input_ids, encoder_position_ids, encoded, encoder_mask, modality, use_cache,
       embed_token_id, logit_weights, past_key_values=None, attention_mask=None,
       _clf_free_guidance=False
   ):
@@ -323,6 +384,16 @@ class Decoder(nn.Module, GenerationMixin):
     if use_cache:
       if past_key_values is None:
         past_key_values = DynamicCache()
+      elif isinstance(past_key_values, compilation.StaticCache):
+        # Attend to the positions written so far, so every step has the same shapes
+        past_key_values.set_position(cur_index, device)
+        if not past_key_values.key_cache:
+          # The heads can be sharded across processes, see `parallel.shard_model`
+          num_heads = self.get_submodule("layers_0").self_attention.num_heads
+          past_key_values.allocate(
+            cfg.num_decoder_layers, input_ids.shape[0], num_heads, cfg.head_dim,
+            seq.input_embedding.dtype, device)
+        decoder_attn_mask = past_key_values.get_mask(input_ids.shape[0], device)
     else:
       past_key_values = None
 
@@ -330,9 +401,9 @@ class Decoder(nn.Module, GenerationMixin):
       past_key_values=past_key_values,
       encoded=encoded,
       decoder_embedding=seq.input_embedding,
-      decoder_pos_emb=seq.position_embed,
+      decoder_position_ids=seq.position_ids,
       decoder_attn_mask=decoder_attn_mask,
-      encoder_pos_emb=encoder_pos_emb,
+      encoder_position_ids=encoder_position_ids,
       encoder_decoder_mask=encoder_decoder_mask,
       attn_pattern_mask=seq.attn_pattern_mask,
       logit_weights=logit_weights,
@@ -388,20 +459,37 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
         num_embeddings=cfg.audio_vocab_size,
         embedding_dim=cfg.emb_dim)
 
-    self.shared_embedding = {
-      'text': self.text_token_embedder,
-      'image': self.image_token_embedder,
-      'audio': self.audio_token_embedder,
-    }
-
     # Encode input modalities
     self.input_embedders = nn.ModuleDict(input_encoders)
 
     # Encode target modalities
     self.target_embedders = nn.ModuleDict(target_encoders)
 
-    self.encoder = Encoder(cfg)
-    self.decoder = Decoder(cfg)
+    # RoPE sinusoids of all the modalities, embedders output position ids into this table
+    rope_caches = {}
+    for prefix, embedders in [("inputs", input_encoders), ("targets", target_encoders)]:
+      for name, embedder in embedders.items():
+        rope_caches[f"{prefix}/{name}"] = embedder.get_rope_cache()
+    self.rotary = layers.RotaryTable(rope_caches)
+    for name, offset in self.rotary.offsets.items():
+      prefix, name = name.split("/")
+      embedders = self.input_embedders if prefix == "inputs" else self.target_embedders
+      embedders[name].rope_offset = offset
+
+    self.encoder = Encoder(cfg, self.rotary)
+    self.decoder = Decoder(cfg, self.rotary)
+
+    # Set by `compile_generation`
+    self.length_buckets = None
+    self.compiled_encoder = None
+
+  @property
+  def shared_embedding(self):
+    return {
+      'text': self.text_token_embedder,
+      'image': self.image_token_embedder,
+      'audio': self.audio_token_embedder,
+    }
 
   def set_modalities(
       self,
@@ -419,38 +507,292 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
 
   @property
   def device(self):
-    return self.text_token_embedder.weight.device
+    return self.decoder.decoder_norm.scale.device
+
+  @staticmethod
+  def get_param_dtype(name, dtype, vit_dtype, vqgan_dtype):
+    """Returns the dtype parameter `name` should have if the ViTs are in `vit_dtype`, the
+    VQGANs in `vqgan_dtype` and the everything else is in `dtype`"""
+    parts = name.split(".")
+    if len(parts) > 2 and parts[1] in ["audio", "image"]:
+      if parts[0] == "target_embedders" and parts[2] == "vqgan":
+        return vqgan_dtype
+      if parts[0] == "input_embedders" and parts[2] == "image_encoder":
+        return vit_dtype
+    return dtype
 
   def to_dtype(self, dtype, vit_dtype, vqgan_dtype):
     param_to_dtype = dict()  # works because torch tensors are hashed by identify
-    for k in ["audio", "image"]:
-      if k in self.target_embedders:
-        for param in self.target_embedders[k].vqgan.parameters():
-          param_to_dtype[param] = vit_dtype
-      if k in self.input_embedders:
-        for param in self.input_embedders[k].image_encoder.parameters():
-          param_to_dtype[param] = vqgan_dtype
+    for name, param in self.named_parameters():
+      param_to_dtype[param] = self.get_param_dtype(name, dtype, vit_dtype, vqgan_dtype)
 
     def _convert(t):
       _dtype = param_to_dtype.get(t, dtype)
-      return t.to(_dtype)
+      # Keep integer tensors, such as quantized weights, as they are
+      return t if (_dtype is None or not t.is_floating_point()) else t.to(_dtype)
 
     self._apply(_convert)
 
+  def set_attention_chunk_size(self, chunk_size: Optional[int]):
+    """Compute encoder and decoder attention `chunk_size` queries at a time, or all at
+    once if None, see `layers.chunked_dot_product_attention`"""
+    self.config.attention_chunk_size = chunk_size
+    for module in list(self.encoder.modules()) + list(self.decoder.modules()):
+      if isinstance(module, layers.MultiHeadDotProductAttention):
+        module.chunk_size = chunk_size
+
+  def set_gradient_checkpointing(self, policy: Optional[str] = "layer", every_n: int = 1,
+                                 memory_budget: Optional[float] = None):
+    """Use activation checkpointing in the encoder, decoder and perceiver resampler layers
+
+    Checkpointed activations are re-computed in the backward pass instead of being stored,
+    trading compute for memory when training.
+
+    Args:
+      policy: "layer" to checkpoint whole layers, "attention" to only checkpoint the
+              attention blocks, or None to turn checkpointing off
+      every_n: checkpoint every `every_n`-th layer of each stack
+      memory_budget: fraction of the layers in each stack to not checkpoint, overrides
+                     `every_n` if set
+    """
+    if policy not in [None, "layer", "attention"]:
+      raise ValueError(f"Unknown checkpointing policy {policy}")
+    stacks = [
+      [self.encoder.get_submodule(f"layers_{i}") for i in range(self.config.num_encoder_layers)],
+      [self.decoder.get_submodule(f"layers_{i}") for i in range(self.config.num_decoder_layers)],
+    ]
+    for module in self.modules():
+      if isinstance(module, PerceiverResampler):
+        stacks.append([module.get_submodule(f"layers_{i}")
+                       for i in range(module.config.num_layers)])
+    for stack in stacks:
+      ixs = set(layers.checkpoint_layer_ixs(len(stack), every_n, memory_budget))
+      for ix, layer in enumerate(stack):
+        layer.checkpoint = policy if ix in ixs else None
+
+  def fuse_attention_projections(self):
+    """Packs the query/key/value projections of the encoder, decoder and perceiver resampler
+    attention layers so they are computed with one matmul
+
+    Cross-attention layers only pack their key/value projections. State dicts keep the
+    original layout, see `layers.MultiHeadDotProductAttention.fuse_projections`.
+    """
+    for module in self.modules():
+      if isinstance(module, EncoderLayer):
+        module.attention.fuse_projections()
+      elif isinstance(module, DecoderLayer):
+        module.self_attention.fuse_projections()
+        if module.enable_xattention:
+          module.encoder_decoder_attention.fuse_projections(self_attention=False)
+      elif isinstance(module, PerceiverAttention):
+        module.attention.fuse_projections()
+      elif isinstance(module, PerceiverCrossAttention):
+        module.xattention.fuse_projections(self_attention=False)
+
+  def fuse_mlp_projections(self):
+    """Packs the gated input projections of the encoder, decoder and perceiver resampler MLPs
+    so they are computed with one matmul
+
+    State dicts keep the original layout, see `layers.MlpBlock.fuse_projections`.
+    """
+    for module in self.modules():
+      if isinstance(module, layers.MlpBlock):
+        module.fuse_projections()
+
+  def compile_generation(self, length_buckets=compilation.DEFAULT_LENGTH_BUCKETS,
+                         **compile_kwargs):
+    """Compiles the encoder and the decoding steps used by `generate` with `torch.compile`
+
+    Encoder inputs are padded to the smallest of `length_buckets` that fits them, and decoding
+    steps use a `compilation.StaticCache`, so graphs are only re-compiled for new batch sizes,
+    buckets or target modalities. See `warmup_generation` to compile them ahead of time.
+
+    Args:
+      length_buckets: lengths to pad the encoder inputs to
+      **compile_kwargs: arguments for `torch.compile`, defaults to `fullgraph=True` and
+                        `dynamic=False`
+    """
+    compile_kwargs.setdefault("fullgraph", True)
+    compile_kwargs.setdefault("dynamic", False)
+    self.length_buckets = tuple(sorted(length_buckets))
+    self.compiled_encoder = torch.compile(self.encoder.forward, **compile_kwargs)
+    self.decoder.compiled_step = torch.compile(self.decoder.forward, **compile_kwargs)
+
+  def warmup_generation(self, batch_sizes=(1,), modalities=("text",), encoder_lengths=None,
+                        max_new_tokens=512):
+    """Compiles the graphs `generate` uses for these batch sizes and modalities
+
+    Args:
+      batch_sizes: batch sizes to compile for, classifier-free guidance doubles the batch size
+      modalities: target modalities to compile the decoding steps of
+      encoder_lengths: encoder lengths to compile for, defaults to all the `length_buckets`
+      max_new_tokens: `max_new_tokens` that will be used for text generation
+    """
+    if self.length_buckets is None:
+      raise ValueError("Call `compile_generation` first")
+    if encoder_lengths is None:
+      encoder_lengths = self.length_buckets
+    device = self.device
+    with torch.no_grad():
+      for bs in batch_sizes:
+        # Embeds one token and pads it to each length, padding gives every input modality the
+        # same dtypes so this covers all of them
+        tokens = torch.ones((bs, 1), dtype=torch.int32, device=device)
+        seq = self.encode_batch({"text": dict(tokens=tokens)})
+        for length in encoder_lengths:
+          input_seq, encoded = self._encode_for_generation(
+            seq, compilation.get_bucket(length, self.length_buckets))
+          for modality in modalities:
+            cache = compilation.StaticCache(self._get_cache_length(modality, max_new_tokens))
+            inputs = self.decoder.prepare_inputs_for_generation(
+              input_ids=torch.zeros((bs, 2), dtype=torch.long, device=device),
+              encoder_position_ids=input_seq.position_ids, encoded=encoded,
+              encoder_mask=input_seq.mask, modality=modality, use_cache=True,
+              embed_token_id=self._get_token_embedder(modality),
+              logit_weights=self.shared_embedding[modality].weight, past_key_values=cache)
+            self.decoder(**inputs, return_dict=True)
+
+  def _encode_for_generation(self, input_seq: InputSequence, length=None):
+    """Returns the input sequence, padded if the encoder is compiled, and its encoding"""
+    if self.compiled_encoder is None:
+      return input_seq, self.encoder(input_seq)
+    if length is None:
+      length = compilation.get_bucket(input_seq.seq_len, self.length_buckets)
+    input_seq = compilation.pad_input_sequence(input_seq, length)
+    return input_seq, self.compiled_encoder(input_seq)
+
+  def _get_cache_length(self, modality, max_new_tokens):
+    """Returns the `StaticCache` length to generate `max_new_tokens` of `modality`"""
+    if modality == "image":
+      return 1024
+    elif modality == "audio":
+      return 512
+    # The last generated token is never fed to the decoder
+    return compilation.get_bucket(max_new_tokens, self.length_buckets)
+
+  def _get_token_embedder(self, modality):
+    def embed_token_id(input_id, mask, cur_index=None):
+      # Turn a generated input id into an embedding
+      return self.target_embedders[modality](
+          input_id, mask=mask, cur_index=cur_index, shared_embed=self.shared_embedding[modality])
+    return embed_token_id
+
+  def quantize(self, include_embeddings=False, include_vit=False, include_vqgan=False) -> List[str]:
+    """Converts the linear layers to weight-only int8 with per-channel scales for inference
+
+    See `uio2.quantization`. Quantized models can be saved and loaded with
+    `save_pretrained`/`from_pretrained`.
+
+    Args:
+      include_embeddings: also quantize the shared text/image/audio embeddings, which are
+                          de-quantized when used as the output layer
+      include_vit: also quantize the linear layers of the ViTs
+      include_vqgan: also quantize the linear layers of the VQGANs
+
+    Returns:
+      The names of the quantized modules
+    """
+    def _should_quantize(name, module):
+      if isinstance(module, nn.Embedding):
+        return include_embeddings and name in [
+          "text_token_embedder", "image_token_embedder", "audio_token_embedder"]
+      group = self.get_param_dtype(name + ".weight", "transformer", "vit", "vqgan")
+      return (group == "transformer" or (group == "vit" and include_vit) or
+              (group == "vqgan" and include_vqgan))
+    return quantization.quantize_modules(self, _should_quantize)
+
   @torch.no_grad()
   def score_answer_options(
-      self, batch, options, option_batch_size=None, average_loss=True):
-    """Scores multiple answers options for one set of inputs
+      self, batch, options, option_batch_size=None, average_loss=True, prune_margin=None):
+    """Scores multiple answers options for a batch of inputs
+
+    The inputs are encoded together, then (example, option) pairs are decoded in batches with
+    the encoder states of each pair's example.
 
     Args:
-      batch: batch of inputs with batch size 1, targets in this batch are ignored
-      options: Tensor of tokenized text answer options, includes EOS but not BOS and padded with 0
-      option_batch_size: Compute answers for batches of options at a time to reduce memory
+      batch: batch of inputs, targets in this batch are ignored
+      options: Answer options to score for every example, or a list with the options to score
+               for each example. Options are either a tensor of tokenized text answer options,
+               includes EOS but not BOS and padded with 0, or `AnswerOptions`, in which case
+               shared option prefixes are only decoded once
+      option_batch_size: Compute answers for batches of (example, option) pairs at a time to
+                         reduce memory
       average_loss: Do average loss per token instead of total loss
+      prune_margin: If set, options are scored one token position at a time and options whose
+                    partial loss exceeds the best partial loss of their example by more than
+                    this margin are dropped. Pruned options get an infinite score. This is a
+                    heuristic, an option can be pruned even if its total loss would have been
+                    the lowest, so the best option may differ from exact scoring. Requires
+                    `average_loss=False`, and shared prefixes of `AnswerOptions` are not reused.
 
     Returns:
-      The scores of each answer option
+      If `options` is a list, a list with the scores of each example's options. Otherwise the
+      [batch, n_options] scores of the options, or [n_options] scores if the batch size is 1.
+      If `prune_margin` is set, also returns boolean masks of the pruned options in the same
+      format.
     """
+    batch = unflatten_dict(batch)
+    input_seq = self.encode_batch(batch["inputs"])
+    encoder_hidden = self.encoder(input_seq)
+    n_examples = encoder_hidden.shape[0]
+    if isinstance(options, (list, tuple)):
+      if len(options) != n_examples:
+        raise ValueError(f"Got {len(options)} option lists for {n_examples} examples")
+      example_options = list(options)
+    else:
+      example_options = [options] * n_examples
+
+    if prune_margin is not None:
+      if average_loss:
+        # Partial average losses can go down as more tokens are scored, so comparing them
+        # would prune options that could still win
+        raise ValueError("Pruning is only supported with average_loss=False")
+      scores, pruned = self._score_options_pruned(
+        example_options, input_seq, encoder_hidden, option_batch_size, prune_margin)
+      if isinstance(options, (list, tuple)):
+        return scores, pruned
+      scores, pruned = torch.stack(scores), torch.stack(pruned)
+      return (scores[0], pruned[0]) if n_examples == 1 else (scores, pruned)
+
+    tensor_options = [(ix, x) for ix, x in enumerate(example_options)
+                      if not isinstance(x, AnswerOptions)]
+    trie_options = [(ix, x) for ix, x in enumerate(example_options)
+                    if isinstance(x, AnswerOptions)]
+    losses = [None] * n_examples
+    if tensor_options:
+      for (ix, _), loss in zip(tensor_options, self._score_option_tensors(
+          tensor_options, input_seq, encoder_hidden, option_batch_size)):
+        losses[ix] = loss
+    if trie_options:
+      for (ix, _), loss in zip(trie_options, self._score_option_tries(
+          trie_options, input_seq, encoder_hidden, option_batch_size)):
+        losses[ix] = loss
+
+    scores = []
+    for opts, loss in zip(example_options, losses):
+      tokens = opts.tokens if isinstance(opts, AnswerOptions) else opts
+      loss = loss.sum(-1)
+      if average_loss:
+        loss /= (tokens > 0).sum(-1).to(loss.device)
+      scores.append(loss)
+    if isinstance(options, (list, tuple)):
+      return scores
+    scores = torch.stack(scores)
+    return scores[0] if n_examples == 1 else scores
+
+  def _gather_encoder(self, input_seq, encoder_hidden, example_ixs):
+    """Returns encoder states, encoder position ids and masks for `example_ixs`"""
+    pos_ids = input_seq.position_ids.expand(encoder_hidden.shape[0], -1)
+    return encoder_hidden[example_ixs], pos_ids[example_ixs], input_seq.mask[example_ixs]
+
+  def _score_option_tensors(self, example_options, input_seq, encoder_hidden, option_batch_size):
+    """Returns [n_options, len] per-token losses for each (example_ix, options tensor) pair"""
+    device = encoder_hidden.device
+    max_len = max(x.shape[1] for _, x in example_options)
+    options = torch.cat([F.pad(x.to(device), (0, max_len - x.shape[1]))
+                         for _, x in example_options])
+    example_ixs = torch.cat([torch.full((len(x),), ix, device=device)
+                             for ix, x in example_options])
     if option_batch_size is None:
       option_batch_size = len(options)
       n_batches = 1
@@ -466,13 +808,6 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
     target_seq: seq_features.TargetSequence = self.target_embedders["text"](
       input_tokens, mask=options > 0, shared_embed=self.text_token_embedder)
 
-    batch = unflatten_dict(batch)
-    input_seq = self.encode_batch(batch["inputs"])
-    if input_seq.batch_size != 1:
-      raise NotImplementedError("Only batch 1 supported")
-    encoder_hidden = self.encoder(input_seq)
-    encoder_decoder_mask = layers.make_attention_mask(
-      target_seq.mask, input_seq.mask).to(encoder_hidden.dtype)
     options = options.to(torch.long)  # for cross entropy
     decoder_attn_mask = layers.make_decoder_mask(target_seq.mask)
 
@@ -481,28 +816,158 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
       sl = slice(batch_i * option_batch_size, (batch_i + 1) * option_batch_size)
       mask = target_seq.mask[sl]
       bs = mask.shape[0]
+      encoded, encoder_position_ids, encoder_mask = self._gather_encoder(
+        input_seq, encoder_hidden, example_ixs[sl])
+      encoder_decoder_mask = layers.make_attention_mask(
+        mask, encoder_mask).to(encoder_hidden.dtype)
       out_hidden = self.decoder(
-        encoded=encoder_hidden.expand(bs, -1, -1),
-        decoder_pos_emb=target_seq.position_embed[sl],
+        encoded=encoded,
+        decoder_position_ids=target_seq.position_ids[sl],
         decoder_embedding=target_seq.input_embedding[sl],
         decoder_attn_mask=decoder_attn_mask[sl],
-        encoder_pos_emb=input_seq.position_embed.expand(bs, -1, -1),
-        encoder_decoder_mask=encoder_decoder_mask[sl],
+        encoder_position_ids=encoder_position_ids,
+        encoder_decoder_mask=encoder_decoder_mask,
         decoder_bias=None,
-        attn_pattern_mask=target_seq.attn_pattern_mask[sl]
+        attn_pattern_mask=target_seq.attn_pattern_mask.batch_slice(sl)
       )
-      embed = self.shared_embedding["text"]
-      logits = F.linear(out_hidden, embed.weight)
-      logits = logits / math.sqrt(out_hidden.shape[-1])
-      losses = F.cross_entropy(
-        logits.view(-1, logits.shape[-1]),
-        options[sl].view(-1), reduction="none")
-      losses = losses.view(bs, target_seq.seq_len) * mask
-      losses = losses.sum(-1)
-      if average_loss:
-        losses /= mask.sum(-1)
+      valid = mask > 0
+      losses = torch.zeros((bs, target_seq.seq_len), device=device, dtype=torch.float32)
+      losses[valid] = layers.chunked_cross_entropy(
+        out_hidden[valid], self.shared_embedding["text"].weight, options[sl][valid])[0]
       all_loses.append(losses)
-    return torch.cat(all_loses)
+    all_loses = torch.cat(all_loses).split([len(x) for _, x in example_options])
+    return [loss[:, :x.shape[1]] for loss, (_, x) in zip(all_loses, example_options)]
+
+  def _score_options_pruned(self, example_options, input_seq, encoder_hidden, option_batch_size,
+                            prune_margin):
+    """Scores options one token position at a time, pruning options that fall behind
+
+    Options are decoded independently, so shared prefixes of `AnswerOptions` are decoded once
+    per option.
+
+    Returns the total losses and pruned masks of each example's options
+    """
+    device = encoder_hidden.device
+    tokens = [x.tokens if isinstance(x, AnswerOptions) else x for x in example_options]
+    max_len = max(x.shape[1] for x in tokens)
+    options = torch.cat([F.pad(x.to(device), (0, max_len - x.shape[1])) for x in tokens]).long()
+    example_ixs = torch.cat([torch.full((len(x),), ix, device=device)
+                             for ix, x in enumerate(tokens)])
+    n = len(options)
+    lengths = (options > 0).sum(-1)
+    losses = torch.zeros(n, dtype=torch.float32, device=device)
+    pruned = torch.zeros(n, dtype=torch.bool, device=device)
+    if option_batch_size is None:
+      option_batch_size = n
+    # Rows of each batch of options still being decoded, and the KV cache of those rows
+    chunks = [(torch.arange(i, min(i+option_batch_size, n), device=device), DynamicCache())
+              for i in range(0, n, option_batch_size)]
+    bos = torch.full((n, 1), BOS_ID, dtype=torch.long, device=device)
+    weight = self.shared_embedding["text"].weight
+    for pos in range(max_len):
+      for rows, cache in chunks:
+        if len(rows) == 0:
+          continue
+        encoded, encoder_position_ids, encoder_mask = self._gather_encoder(
+          input_seq, encoder_hidden, example_ixs[rows])
+        history = torch.cat([bos[rows], options[rows, :pos]], 1)
+        hidden = self._decode_uncached_text(
+          history, encoded, encoder_position_ids, encoder_mask, cache)[:, -1]
+        logits = F.linear(hidden, weight) / math.sqrt(hidden.shape[-1])
+        log_probs = F.log_softmax(logits.float(), -1)
+        losses[rows] -= log_probs.gather(1, options[rows, pos:pos+1])[:, 0]
+
+      # Prune options that are behind the best option of their example so far
+      best = torch.full((len(tokens),), float("inf"), device=device).scatter_reduce(
+        0, example_ixs[~pruned], losses[~pruned], "amin")
+      pruned |= losses > best[example_ixs] + prune_margin
+
+      for ix, (rows, cache) in enumerate(chunks):
+        keep = ~pruned[rows] & (lengths[rows] > pos + 1)
+        if not torch.all(keep):
+          keep = torch.nonzero(keep)[:, 0]
+          cache.reorder_cache(keep)
+          chunks[ix] = (rows[keep], cache)
+
+    losses = losses.masked_fill(pruned, float("inf"))
+    sizes = [len(x) for x in tokens]
+    return list(losses.split(sizes)), list(pruned.split(sizes))
+
+  def _score_option_tries(self, example_options, input_seq, encoder_hidden, option_batch_size):
+    """Returns [n_options, len] per-token losses for each (example_ix, `AnswerOptions`) pair
+
+    Each example's options are split into tries, and (example, trie) rows are decoded in
+    batches of at most `option_batch_size` options, unless a single trie is larger.
+    """
+    device = encoder_hidden.device
+    rows = []
+    losses = []
+    for ix, opts in example_options:
+      tokens = opts.tokens.to(device=device, dtype=torch.long)
+      losses.append(torch.zeros(tokens.shape, dtype=torch.float32, device=device))
+      for trie in opts.get_tries(option_batch_size):
+        rows.append((ix, len(losses) - 1, trie, tokens[torch.as_tensor(trie.option_ixs)]))
+
+    groups = [[]]
+    for row in rows:
+      if (option_batch_size is not None and groups[-1] and
+          sum(len(x[2].option_ixs) for x in groups[-1]) + len(row[2].option_ixs) > option_batch_size):
+        groups.append([])
+      groups[-1].append(row)
+
+    for group in groups:
+      group_losses = self._score_option_trie_batch(
+        [x[2] for x in group], [x[3] for x in group],
+        torch.as_tensor([x[0] for x in group], device=device), input_seq, encoder_hidden)
+      for (_, loss_ix, trie, _), loss in zip(group, group_losses):
+        losses[loss_ix][torch.as_tensor(trie.option_ixs, device=device)] = loss
+    return losses
+
+  def _score_option_trie_batch(self, tries: List[OptionTrie], tokens, example_ixs,
+                               input_seq, encoder_hidden):
+    """Returns the [n_options, len] per-token losses of the options in each trie
+
+    Each trie is decoded as one sequence where each node attends to its ancestors, which gives
+    each node the same hidden state it would have when decoding any option that contains it.
+    """
+    device = encoder_hidden.device
+    n_nodes = max(len(trie.node_tokens) for trie in tries)
+    node_tokens = torch.zeros((len(tries), n_nodes), dtype=torch.long, device=device)
+    node_pos = torch.zeros((len(tries), n_nodes), dtype=torch.int32, device=device)
+    node_valid = torch.zeros((len(tries), n_nodes), dtype=torch.int32, device=device)
+    # Padding nodes attend to themselves
+    decoder_attn_mask = torch.eye(n_nodes, dtype=torch.bool, device=device).repeat(len(tries), 1, 1)
+    for row, trie in enumerate(tries):
+      n = len(trie.node_tokens)
+      node_tokens[row, :n] = torch.as_tensor(trie.node_tokens)
+      node_pos[row, :n] = torch.as_tensor(trie.node_pos, dtype=torch.int32)
+      node_valid[row, :n] = 1
+      decoder_attn_mask[row, :n, :n] = torch.as_tensor(trie.node_mask)
+
+    seq = self.target_embedders["text"](
+      node_tokens, mask=node_valid, pos_ids=node_pos, shared_embed=self.shared_embedding["text"])
+    encoded, encoder_position_ids, encoder_mask = self._gather_encoder(
+      input_seq, encoder_hidden, example_ixs)
+    encoder_decoder_mask = layers.make_attention_mask(
+      seq.mask, encoder_mask).to(encoder_hidden.dtype)
+    out_hidden = self.decoder(
+      encoded=encoded,
+      decoder_position_ids=seq.position_ids,
+      decoder_embedding=seq.input_embedding,
+      decoder_attn_mask=decoder_attn_mask[:, None, :, :],
+      encoder_position_ids=encoder_position_ids,
+      encoder_decoder_mask=encoder_decoder_mask,
+      decoder_bias=None,
+      attn_pattern_mask=seq.attn_pattern_mask
+    )
+    logits = F.linear(out_hidden, self.shared_embedding["text"].weight)
+    logits = logits / math.sqrt(out_hidden.shape[-1])
+    log_probs = F.log_softmax(logits.float(), -1)
+    out = []
+    for row, (trie, row_tokens) in enumerate(zip(tries, tokens)):
+      option_nodes = torch.as_tensor(trie.option_nodes, device=device)
+      out.append(-log_probs[row, option_nodes, row_tokens] * (row_tokens > 0))
+    return out
 
   @torch.no_grad()
   def generate(
@@ -512,6 +977,8 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
       modality="text",
       negative_prompt=None,
       guidance_scale=10,
+      constraint=None,
+      quantize_kv_cache=False,
       **kwargs,
   ):
     """Generate outputs
@@ -522,11 +989,27 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
       modality: text, image, or audio, modality to encode
       negative_prompt: batch to use for classifier free guidance
       guidance_scale: scale of classifier free guidance
+      constraint: `TokenAutomaton` to constrain text generation with, see
+                  `uio2.constrained_decoding`. If set, we use greedy decoding with
+                  `generate_constrained` and only `max_new_tokens` and `logits_processor` can
+                  be passed in `kwargs`
+      quantize_kv_cache: store the decoder's KV cache as int8, see
+                         `quantization.Int8DynamicCache`
       **kwargs: Most other parameters for `GenerationMixin.generate` should work, but fair warning
                 we haven't tested everything and some will not be supported
 
     Returns: text tokens, an image, or a spectrogram depending on `modality`
     """
+    if constraint is not None:
+      if modality != "text" or negative_prompt is not None:
+        raise ValueError("Constraints are only supported for text generation without guidance")
+      kwargs.pop("use_cache", None)  # We always use the cache
+      unsupported = set(kwargs).difference(["max_new_tokens", "logits_processor"])
+      if unsupported:
+        raise ValueError(f"Arguments {unsupported} not supported when using a constraint")
+      return self.generate_constrained(
+        batch, constraint, quantize_kv_cache=quantize_kv_cache, **kwargs)
+
     if generation_config is None:
       # Build default config
       generation_config = GenerationConfig(
@@ -590,16 +1073,19 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
     batch = unflatten_dict(batch)
     input_seq = self.encode_batch(batch["inputs"])
 
-    encoder_hidden = self.encoder(input_seq)
-    mask, pos = input_seq.mask, input_seq.position_embed
+    input_seq, encoder_hidden = self._encode_for_generation(input_seq)
+    mask, pos = input_seq.mask, input_seq.position_ids
 
     bs = mask.shape[0]
     input_ids = torch.zeros((bs, 1), dtype=torch.long, device=input_seq.embed.device)
 
-    def embed_token_id(input_id, mask, cur_index=None):
-      # Turn a generated input id into an embedding
-      return self.target_embedders[modality](
-          input_id, mask=mask, cur_index=cur_index, shared_embed=self.shared_embedding[modality])
+    if quantize_kv_cache:
+      kwargs["past_key_values"] = quantization.Int8DynamicCache()
+    elif self.decoder.compiled_step is not None and "past_key_values" not in kwargs:
+      max_new_tokens = kwargs.get("max_new_tokens", generation_config.max_new_tokens)
+      if max_new_tokens is not None:
+        kwargs["past_key_values"] = compilation.StaticCache(
+          self._get_cache_length(modality, max_new_tokens))
 
     out = self.decoder.generate(
       **kwargs,
@@ -607,8 +1093,8 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
       modality=modality,
       input_ids=input_ids,
       logit_weights=self.shared_embedding[modality].weight,
-      embed_token_id=embed_token_id,
-      encoder_pos_emb=pos,
+      embed_token_id=self._get_token_embedder(modality),
+      encoder_position_ids=pos,
       encoded=encoder_hidden,
       encoder_mask=mask,
     )
@@ -660,6 +1146,133 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
     else:
       return tokens
 
+  def _decode_uncached_text(self, tokens, encoded, encoder_position_ids, encoder_mask,
+                            past_key_values):
+    """Runs the decoder over the text tokens that are not yet in `past_key_values`
+
+    All uncached tokens are decoded in a single step, they attend to the cached tokens and
+    causally to each other. Returns the hidden states of the uncached tokens.
+    """
+    n_cached = past_key_values.get_seq_length()
+    bs, seq_len = tokens.shape
+    device = tokens.device
+    new_tokens = tokens[:, n_cached:]
+    pos_ids = torch.arange(n_cached, seq_len, dtype=torch.int32, device=device)
+    pos_ids = pos_ids[None, :].expand(bs, -1)
+    seq = self.target_embedders["text"](
+      new_tokens, mask=torch.ones_like(new_tokens, dtype=torch.int32), pos_ids=pos_ids,
+      shared_embed=self.shared_embedding["text"])
+
+    # [1, 1, n_new, seq_len] mask over the cached and new tokens
+    key_ixs = torch.arange(seq_len, device=device)
+    decoder_attn_mask = key_ixs[None, :] <= key_ixs[n_cached:, None]
+    decoder_attn_mask = decoder_attn_mask[None, None, :, :]
+    encoder_decoder_mask = layers.make_attention_mask(
+      seq.mask, encoder_mask).to(encoded.dtype)
+    return self.decoder(
+      encoded=encoded,
+      decoder_position_ids=seq.position_ids,
+      decoder_embedding=seq.input_embedding,
+      decoder_attn_mask=decoder_attn_mask,
+      encoder_position_ids=encoder_position_ids,
+      encoder_decoder_mask=encoder_decoder_mask,
+      past_key_values=past_key_values,
+    )
+
+  @torch.no_grad()
+  def generate_constrained(self, batch, constraint, max_new_tokens=512, logits_processor=None,
+                           quantize_kv_cache=False):
+    """Greedy text generation constrained by a `TokenAutomaton`
+
+    Only tokens allowed by `constraint` are generated. Tokens that are forced by the automaton
+    for every unfinished example are appended without running the decoder, and are prefilled
+    into the KV cache, together with the preceding generated token, by the next multi-token
+    decoder step. So forced spans (e.g., keypoint part names) do not cost decoder steps.
+
+    When the unfinished examples allow less than half the vocabulary, logits are only computed
+    for the allowed tokens (e.g., the location tokens and EOS when decoding boxes).
+
+    Args:
+      batch: batch of pre-preprocessed data, target features are ignored
+      constraint: `TokenAutomaton` to constrain the output with
+      max_new_tokens: max number of tokens to generate
+      logits_processor: `LogitsProcessor`s to apply, they get scores for the full vocabulary
+                        where the tokens the constraint does not allow are -inf
+      quantize_kv_cache: store the decoder's KV cache as int8
+
+    Returns: generated text tokens, including the BOS token
+    """
+    batch = unflatten_dict(batch)
+    input_seq = self.encode_batch(batch["inputs"])
+    encoder_hidden = self.encoder(input_seq)
+    bs = encoder_hidden.shape[0]
+    device = encoder_hidden.device
+
+    tokens = torch.full((bs, 1), BOS_ID, dtype=torch.long, device=device)
+    states = [constraint.start] * bs
+    done = [False] * bs
+    past_key_values = quantization.Int8DynamicCache() if quantize_kv_cache else DynamicCache()
+    while not all(done):
+      n_generated = tokens.shape[1] - 1
+      if n_generated >= max_new_tokens:
+        break
+      spans = [constraint.forced_span(state)[0] for state, d in zip(states, done) if not d]
+      n_forced = min(min(len(x) for x in spans), max_new_tokens - n_generated)
+      if n_forced > 0:
+        forced = []
+        for ix, state in enumerate(states):
+          if done[ix]:
+            forced.append([EOS_ID]*n_forced)
+          else:
+            forced.append(constraint.forced_span(state)[0][:n_forced])
+            for token in forced[-1]:
+              states[ix] = constraint.step(states[ix], token)
+            done[ix] = forced[-1][-1] == EOS_ID
+        forced = torch.as_tensor(forced, dtype=torch.long, device=device)
+        tokens = torch.cat([tokens, forced], 1)
+        n_generated = tokens.shape[1] - 1
+
+      if n_generated >= max_new_tokens or all(done):
+        break
+
+      hidden = self._decode_uncached_text(
+        tokens, encoder_hidden, input_seq.position_ids, input_seq.mask, past_key_values)
+      hidden = hidden[:, -1]
+      weight = self.shared_embedding["text"].weight
+      allowed = constraint.get_masks(states, device)
+      token_ids = constraint.get_token_ids(
+        [state for state, d in zip(states, done) if not d], device)
+      if len(token_ids)*2 > weight.shape[0]:
+        token_ids = None
+
+      if token_ids is not None:
+        logits = F.linear(hidden, weight[token_ids]) / math.sqrt(hidden.shape[-1])
+        logits = logits.masked_fill(~allowed[:, token_ids], -float("inf"))
+        if logits_processor:
+          # Processors expect scores for the full vocabulary, so scatter the allowed tokens
+          scores = torch.full(allowed.shape, -float("inf"), dtype=logits.dtype, device=device)
+          scores[:, token_ids] = logits
+          for processor in logits_processor:
+            scores = processor(tokens, scores)
+          logits = scores[:, token_ids].masked_fill(~allowed[:, token_ids], -float("inf"))
+        next_token = token_ids[torch.argmax(logits, -1)]
+      else:
+        logits = F.linear(hidden, weight) / math.sqrt(hidden.shape[-1])
+        logits = logits.masked_fill(~allowed, -float("inf"))
+        if logits_processor:
+          for processor in logits_processor:
+            logits = processor(tokens, logits)
+          logits = logits.masked_fill(~allowed, -float("inf"))
+        next_token = torch.argmax(logits, -1)
+      for ix, token in enumerate(next_token.tolist()):
+        if done[ix]:
+          next_token[ix] = EOS_ID
+        else:
+          states[ix] = constraint.step(states[ix], token)
+          done[ix] = token == EOS_ID
+      tokens = torch.cat([tokens, next_token[:, None]], 1)
+    return tokens
+
   def encode_batch(self, input_features) -> seq_features.InputSequence:
     input_parts: List[InputSequence] = []
     for k, v in self.input_embedders.items():
@@ -668,27 +1281,19 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
     input_seq = seq_features.concat_sequences(input_parts)
     return input_seq
 
-  def forward(
-      self,
-      batch,
-  ) -> Dict[str, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
-    """Compute the logits of the examples in `batch`
-
-    Args:
-      batch: batch of pre-processed inputs
-
-    Returns: dictionary of (logits, targets, masks) for each modaltiy in the batch
-    """
-    cfg = self.config
+  def _decode_targets(self, batch) -> List[Tuple[str, torch.Tensor, torch.Tensor, torch.Tensor]]:
+    """Returns the (modality, hidden states, targets, loss mask) of each modality in `batch`"""
     features = unflatten_dict(batch, sep="/")
 
     input_seq = self.encode_batch(features["inputs"])
     encoder_hidden = self.encoder(input_seq)
 
+    names = []
     target_parts = []
     target_features = features["targets"]
     for k, v in self.target_embedders.items():
       if target_features.get(k) is not None:
+        names.append(k)
         target_parts.append(v(**target_features[k], shared_embed=self.shared_embedding.get(k)))
 
     target_tokens = [k.target_tokens for k in target_parts]
@@ -714,10 +1319,10 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
     # Do the decoding and output the feature vector for transformers.
     hidden_state = self.decoder(
       encoded=encoder_hidden,
-      decoder_pos_emb=target_seq.position_embed,
+      decoder_position_ids=target_seq.position_ids,
       decoder_embedding=target_seq.input_embedding,
       decoder_attn_mask=decoder_attn_mask,
-      encoder_pos_emb=input_seq.position_embed,
+      encoder_position_ids=input_seq.position_ids,
       encoder_decoder_mask=encoder_decoder_mask,
       decoder_bias=None,
       attn_pattern_mask=target_seq.attn_pattern_mask,
@@ -726,10 +1331,21 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
     # per-modality hidden states
     embedding_parts = torch.split(
       hidden_state, [x.seq_len for x in target_parts], dim=1)
+    return list(zip(names, embedding_parts, target_tokens, loss_masks))
+
+  def forward(
+      self,
+      batch,
+  ) -> Dict[str, Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+    """Compute the logits of the examples in `batch`
 
+    Args:
+      batch: batch of pre-processed inputs
+
+    Returns: dictionary of (logits, targets, masks) for each modaltiy in the batch
+    """
     logits = {}
-    for name, state, targets, mask in zip(
-        self.target_embedders, embedding_parts, target_tokens, loss_masks):
+    for name, state, targets, mask in self._decode_targets(batch):
       embed = self.shared_embedding[name]
       modality_logits = F.linear(state, embed.weight)
       modality_logits = modality_logits / math.sqrt(state.shape[-1])
@@ -737,6 +1353,121 @@ class UnifiedIOModel(nn.Module, GenerationMixin, PyTorchModelHubMixin):
 
     return logits
 
+  def compute_loss(self, batch, chunk_size=1024, z_loss=0.0) -> Dict[str, torch.Tensor]:
+    """Compute the losses of the examples in `batch` without building the full logits
+
+    Logits are computed `chunk_size` target tokens at a time, and only for tokens in the loss
+    mask. When gradients are enabled, each chunk's logits are re-computed during the backward
+    pass instead of being stored, so peak memory is `[chunk_size, vocab_size]` instead of
+    `[batch, seq_len, vocab_size]` for each modality.
+
+    Args:
+      batch: batch of pre-processed inputs
+      chunk_size: number of target tokens to compute logits for at a time
+      z_loss: weight of the z-loss, the squared log-partition function of the logits
+
+    Returns: dictionary of the mean cross-entropy loss for each modality in the batch, and the
+             z-loss of each modality as "{modality}/z_loss" if `z_loss` is set. The total loss
+             is the sum of the values.
+    """
+    losses = {}
+    for name, state, targets, mask in self._decode_targets(batch):
+      valid = mask > 0
+      weights = mask[valid].to(torch.float32)
+      token_losses, log_z = layers.chunked_cross_entropy(
+        state[valid], self.shared_embedding[name].weight, targets[valid], chunk_size)
+      denom = torch.clamp(weights.sum(), min=1)
+      losses[name] = (token_losses * weights).sum() / denom
+      if z_loss:
+        losses[f"{name}/z_loss"] = z_loss * (torch.square(log_z) * weights).sum() / denom
+    return losses
+
+  @classmethod
+  def _from_pretrained(
+      cls,
+      *,
+      model_id,
+      revision=None,
+      cache_dir=None,
+      force_download=False,
+      proxies=None,
+      resume_download=None,
+      local_files_only=False,
+      token=None,
+      map_location="cpu",
+      strict=False,
+      dtype=None,
+      vit_dtype=None,
+      vqgan_dtype=None,
+      input_modalities=None,
+      target_modalities=None,
+      tensor_parallel_group=None,
+      **model_kwargs
+  ):
+    """Loads the model for `PyTorchModelHubMixin.from_pretrained`
+
+    Safetensors checkpoints are memory-mapped and each tensor is converted to its target
+    dtype as it is assigned into the model, so a second copy of the model is never built.
+    The model is built without allocating or initializing its parameters, only parameters
+    that are missing from the checkpoint are initialized.
+    Tensors of modalities removed by `input_modalities`/`target_modalities` are not read.
+    Modules that were quantized with `quantize` when saved are quantized again before loading.
+
+    Args:
+      dtype: dtype to load the model in, defaults to the checkpoint's dtype
+      vit_dtype: dtype of the ViTs, defaults to `dtype`
+      vqgan_dtype: dtype of the VQGANs, defaults to `dtype`
+      input_modalities: input modalities to keep, see `set_modalities`
+      target_modalities: target modalities to keep, see `set_modalities`
+      tensor_parallel_group: `torch.distributed` group to shard the encoder and decoder over,
+                             each process only reads its shards from safetensors
+                             checkpoints, see `parallel.shard_model`. The model's state
+                             dict then only has the shards of this process
+    """
+    vit_dtype = dtype if vit_dtype is None else vit_dtype
+    vqgan_dtype = dtype if vqgan_dtype is None else vqgan_dtype
+    hub_kwargs = dict(
+      revision=revision, cache_dir=cache_dir, force_download=force_download, proxies=proxies,
+      resume_download=resume_download, local_files_only=local_files_only, token=token)
+    checkpoint = SafetensorsCheckpoint.from_pretrained(model_id, **hub_kwargs)
+    if checkpoint is None:
+      # Older pickled checkpoints, load in full and then convert
+      model = super()._from_pretrained(
+        model_id=model_id, map_location=map_location, strict=strict, **hub_kwargs, **model_kwargs)
+      model.set_modalities(input_modalities, target_modalities)
+      if dtype is not None or vit_dtype is not None or vqgan_dtype is not None:
+        model.to_dtype(dtype, vit_dtype, vqgan_dtype)
+      if tensor_parallel_group is not None:
+        parallel.shard_model(model, tensor_parallel_group)
+      return model
+
+    quantized = set(quantization.get_quantized_names(checkpoint.weight_map))
+
+    def _build(empty):
+      with init_empty_parameters() if empty else contextlib.nullcontext():
+        model = cls(**model_kwargs)
+      model.set_modalities(input_modalities, target_modalities)
+      if quantized:
+        quantization.quantize_modules(model, lambda name, _: name in quantized)
+      shards = None
+      if tensor_parallel_group is not None:
+        shards = parallel.shard_model(model, tensor_parallel_group)
+      return model, shards
+
+    # Skip initializing the parameters since they are about to be overwritten, parameters that
+    # are not in the checkpoint are initialized afterward
+    model, shards = _build(True)
+    if get_missing(model, checkpoint) and not strict:
+      if not materialize_missing(model, checkpoint, map_location):
+        model, shards = _build(False)
+    load_safetensors_checkpoint(
+      model, checkpoint, lambda name: cls.get_param_dtype(name, dtype, vit_dtype, vqgan_dtype),
+      map_location, strict, shards)
+    if quantized:
+      quantization.align_quantized_weights(model)
+    # Moves the buffers that are not in the checkpoint
+    return model.to(map_location)
+
   def _save_pretrained(self, save_directory) -> None:
     if self.full_config is None:
       raise ValueError("Must be built from Config to be saved")
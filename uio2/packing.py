@@ -0,0 +1,131 @@
+"""Packs multiple pre-processed examples into one example to reduce padding
+
+Packed examples can be batched with `build_batch` and trained on like normal examples. Each
+modality of a packed example gets an `example_ids` feature, which the embedders turn into the
+`segment_ids` of the input and target sequences so examples only attend to themselves.
+Position ids are kept per-example, so each example keeps the RoPE positions it would have
+unpacked.
+"""
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Modalities with patches of a fixed size, multiple images are stacked into
+# [n_images, n_patches, ...] arrays so the embedders can encode each image on its own
+STACKED_MODALITIES = ["inputs/image", "inputs/audio"]
+
+# Modalities that only one example per packed example can have
+SINGLE_EXAMPLE_MODALITIES = [
+  "inputs/image_history", "inputs/audio_history", "targets/image", "targets/audio"]
+
+# Concatenated modalities that need position ids that restart for each example, the embedders
+# otherwise number the tokens of the whole packed example
+TEXT_MODALITIES = ["inputs/text", "targets/text"]
+
+
+def _get_modalities(example: Dict[str, np.ndarray]) -> Dict[str, Dict[str, np.ndarray]]:
+  modalities = {}
+  for key, val in example.items():
+    # Keys from `UnifiedIOPreprocessor` start with a "/"
+    parts = key.lstrip("/").split("/")
+    if parts[0] not in ["inputs", "targets"]:
+      continue
+    modalities.setdefault("/".join(parts[:2]), {})[parts[2]] = val
+  return modalities
+
+
+def _with_pos_ids(features: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+  if "pos_ids" in features:
+    return features
+  return dict(features, pos_ids=np.arange(np.size(features["mask"]), dtype=np.int32))
+
+
+def get_example_lengths(example: Dict[str, np.ndarray]) -> Tuple[int, int]:
+  """Returns the number of input and target tokens of a pre-processed example
+
+  History inputs are counted by their number of patches, which is an upper bound on the number
+  of tokens they are resampled into.
+  """
+  lengths = {"inputs": 0, "targets": 0}
+  for name, features in _get_modalities(example).items():
+    lengths[name.split("/")[0]] += int(np.size(features["mask"]))
+  return lengths["inputs"], lengths["targets"]
+
+
+def pack_examples(examples: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+  """Packs pre-processed examples into one example
+
+  Text features are concatenated, image and audio inputs are stacked, and only one of the
+  examples can have history inputs or image/audio targets. "meta" features and other
+  non-input/target features are not kept.
+
+  Args:
+    examples: examples from `UnifiedIOPreprocessor`
+
+  Returns:
+    A pre-processed example with the features of `examples` and an `example_ids` feature for
+    each modality, example ids start from 1 so padding gets an id of 0. Text modalities also
+    get `pos_ids` that start from 0 for each example. Keys start with a "/" like the keys of
+    `UnifiedIOPreprocessor` examples.
+  """
+  by_modality: Dict[str, List[Tuple[int, Dict[str, np.ndarray]]]] = {}
+  for example_id, example in enumerate(examples, start=1):
+    for name, features in _get_modalities(example).items():
+      by_modality.setdefault(name, []).append((example_id, features))
+
+  out = {}
+  for name, parts in by_modality.items():
+    if name in SINGLE_EXAMPLE_MODALITIES and len(parts) > 1:
+      raise ValueError(f"Only one packed example can have {name}")
+    example_ids = [np.full(np.shape(features["mask"]), example_id, dtype=np.int32)
+                   for example_id, features in parts]
+    if name in TEXT_MODALITIES:
+      parts = [(example_id, _with_pos_ids(features)) for example_id, features in parts]
+    features = {k: [x[k] for _, x in parts] for k in parts[0][1]}
+    features["example_ids"] = example_ids
+    for key, values in features.items():
+      if name in STACKED_MODALITIES:
+        out[f"/{name}/{key}"] = np.stack(values)
+      else:
+        out[f"/{name}/{key}"] = np.concatenate(values)
+  return out
+
+
+def pack_greedy(
+    examples: List[Dict[str, np.ndarray]],
+    max_input_len: int,
+    max_target_len: int,
+    max_examples: Optional[int] = None
+) -> List[Dict[str, np.ndarray]]:
+  """Packs examples in order, starting a new packed example when the next one does not fit
+
+  Args:
+    examples: examples from `UnifiedIOPreprocessor`
+    max_input_len: max input tokens in a packed example
+    max_target_len: max target tokens in a packed example
+    max_examples: max number of examples in a packed example
+
+  Returns:
+    packed examples from `pack_examples`, examples that exceed the lengths on their own are
+    packed by themselves
+  """
+  packed = []
+  cur, cur_input_len, cur_target_len, cur_single = [], 0, 0, set()
+  for example in examples:
+    input_len, target_len = get_example_lengths(example)
+    single = set(_get_modalities(example)).intersection(SINGLE_EXAMPLE_MODALITIES)
+    if cur and (
+        cur_input_len + input_len > max_input_len or
+        cur_target_len + target_len > max_target_len or
+        (max_examples is not None and len(cur) >= max_examples) or
+        cur_single.intersection(single)
+    ):
+      packed.append(pack_examples(cur))
+      cur, cur_input_len, cur_target_len, cur_single = [], 0, 0, set()
+    cur.append(example)
+    cur_input_len += input_len
+    cur_target_len += target_len
+    cur_single.update(single)
+  if cur:
+    packed.append(pack_examples(cur))
+  return packed
@@ -0,0 +1,140 @@
+"""Tensor-parallel sharding of the encoder and decoder across processes
+
+Each process of a `torch.distributed` group, such as one using the gloo backend on CPU,
+keeps a slice of the attention heads and MLP intermediate features of every encoder and
+decoder layer. The query/key/value and MLP input projections are split by output features
+(column-parallel), the output projections are split by input features (row-parallel) and their
+partial outputs are summed with an all-reduce. All processes need to run the model on the same
+inputs, and they then get the same outputs. The embeddings, ViTs, VQGANs and perceiver
+resamplers are not sharded.
+
+This is meant for inference, the all-reduce does not support backpropagation.
+"""
+from typing import Dict, Tuple
+
+import torch.distributed as dist
+from torch import nn
+
+from uio2 import layers
+from uio2.quantization import Int8Linear
+
+
+def get_shard_range(size: int, rank: int, world_size: int) -> Tuple[int, int]:
+  """Returns the start and end of the `rank`-th of `world_size` equal shards of `size`"""
+  if size % world_size != 0:
+    raise ValueError(f"Cannot split {size} into {world_size} shards")
+  shard_size = size // world_size
+  return rank * shard_size, (rank + 1) * shard_size
+
+
+def _narrow(module: nn.Module, name: str, dim: int, start: int, end: int):
+  tensor = getattr(module, name)
+  sliced = tensor.detach().narrow(dim, start, end - start).clone()
+  if name in module._parameters:
+    module._parameters[name] = nn.Parameter(sliced, requires_grad=tensor.requires_grad)
+  else:
+    module._buffers[name] = sliced
+
+
+def shard_linear(linear: nn.Module, dim: int, start: int,
+                 end: int) -> Dict[str, Tuple[int, int, int]]:
+  """Keeps `start:end` of the output (`dim=0`) or input (`dim=1`) features of `linear`
+
+  Args:
+    linear: `nn.Linear` or `Int8Linear` to slice in-place
+
+  Returns: the (dim, start, end) slice of each tensor in the state dict of `linear`
+  """
+  shards = {}
+  if isinstance(linear, Int8Linear):
+    shards["qweight"] = (dim, start, end)
+    if dim == 0:
+      shards["scale"] = (0, start, end)
+  elif type(linear) == nn.Linear:
+    shards["weight"] = (dim, start, end)
+  else:
+    raise NotImplementedError(f"Cannot shard {type(linear)}")
+  if linear.bias is not None:
+    if dim == 1:
+      raise NotImplementedError("Row-parallel layers with biases are not supported")
+    shards["bias"] = (0, start, end)
+
+  for name, shard in shards.items():
+    _narrow(linear, name, *shard)
+  if dim == 0:
+    linear.out_features = end - start
+  else:
+    linear.in_features = end - start
+  return shards
+
+
+def shard_attention(attention: layers.MultiHeadDotProductAttention, rank: int, world_size: int,
+                    process_group=None) -> Dict[str, Tuple[int, int, int]]:
+  """Keeps the `rank`-th shard of the heads of `attention`, see `shard_linear`"""
+  if attention.qkv is not None or attention.kv is not None:
+    raise ValueError("Shard attention layers before fusing their projections")
+  start, end = get_shard_range(attention.num_heads, rank, world_size)
+  feature_start, feature_end = start * attention.head_dim, end * attention.head_dim
+  shards = {}
+  for name in ["query", "key", "value"]:
+    linear_shards = shard_linear(getattr(attention, name), 0, feature_start, feature_end)
+    shards.update({f"{name}.{k}": v for k, v in linear_shards.items()})
+  linear_shards = shard_linear(attention.out, 1, feature_start, feature_end)
+  shards.update({f"out.{k}": v for k, v in linear_shards.items()})
+  for name in ["logit_scale", "head_scale"]:
+    if getattr(attention, name, None) is not None:
+      _narrow(attention, name, 0, start, end)
+      shards[name] = (0, start, end)
+  attention.num_heads = end - start
+  attention.process_group = process_group
+  return shards
+
+
+def shard_mlp(mlp: layers.MlpBlock, rank: int, world_size: int,
+              process_group=None) -> Dict[str, Tuple[int, int, int]]:
+  """Keeps the `rank`-th shard of the intermediate features of `mlp`, see `shard_linear`"""
+  if mlp.wi_packed is not None:
+    raise ValueError("Shard MLPs before fusing their projections")
+  names = ["wi"] if len(mlp.activations) == 1 else mlp._packed_names()
+  start, end = get_shard_range(getattr(mlp, names[0]).out_features, rank, world_size)
+  shards = {}
+  for name in names:
+    linear_shards = shard_linear(getattr(mlp, name), 0, start, end)
+    shards.update({f"{name}.{k}": v for k, v in linear_shards.items()})
+  linear_shards = shard_linear(mlp.wo, 1, start, end)
+  shards.update({f"wo.{k}": v for k, v in linear_shards.items()})
+  mlp.process_group = process_group
+  return shards
+
+
+def shard_model(model: nn.Module, process_group=None) -> Dict[str, Tuple[int, int, int]]:
+  """Shards the attention and MLP layers of the encoder and decoder of a `UnifiedIOModel`
+
+  Should be called before `fuse_attention_projections` and `fuse_mlp_projections`. Models built
+  with `checkpoint_utils.init_empty_parameters` can be sharded before loading their parameters,
+  the returned slices can then be passed to `checkpoint_utils.load_safetensors_checkpoint` so
+  each process only reads its own shards. The state dict of a sharded model only has the
+  shards of the current process, so `save_pretrained` does not save the full model.
+
+  Args:
+    model: model to shard in-place
+    process_group: group to shard the model over, defaults to the default group
+
+  Returns: the (dim, start, end) slice of the full tensor of each sharded tensor in the model's
+           state dict
+  """
+  if process_group is None:
+    process_group = dist.group.WORLD
+  rank = dist.get_rank(process_group)
+  world_size = dist.get_world_size(process_group)
+  shards = {}
+  for stack in ["encoder", "decoder"]:
+    for name, module in getattr(model, stack).named_modules():
+      if isinstance(module, layers.MultiHeadDotProductAttention):
+        module_shards = shard_attention(module, rank, world_size, process_group)
+      elif isinstance(module, layers.MlpBlock):
+        module_shards = shard_mlp(module, rank, world_size, process_group)
+      else:
+        continue
+      shards.update({f"{stack}.{name}.{k}": v for k, v in module_shards.items()})
+  return shards
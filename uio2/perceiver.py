@@ -37,6 +37,8 @@ class CrossAttention(nn.Module):
       dropout_broadcast_dims=config.dropout_broadcast_dims,
     )
     self.post_mlp_droppath = layers.DropPath(droppath_rate)
+    # Activation checkpointing policy, see `UnifiedIOModel.set_gradient_checkpointing`
+    self.checkpoint = None
 
   def forward(self, latents, context, mask=None):
     # Cross attention block.
@@ -52,7 +54,8 @@ class CrossAttention(nn.Module):
     # Cross-attention
     # [batch, latent_length, emb_dim] x [batch, context_length, emb_dim]
     # => [batch, latent_length, emb_dim]
-    x = self.xattention(inputs_q, inputs_kv, mask=mask)
+    x = layers.maybe_checkpoint(
+      self.checkpoint == "attention", self.xattention, inputs_q, inputs_kv, mask=mask)
     
     x = self.dropout(x)
 
@@ -96,6 +99,8 @@ class Attention(nn.Module):
       dropout_broadcast_dims=config.dropout_broadcast_dims,
     )
     self.post_mlp_droppath = layers.DropPath(droppath_rate)
+    # Activation checkpointing policy, see `UnifiedIOModel.set_gradient_checkpointing`
+    self.checkpoint = None
 
   def forward(self, latents, mask=None):
     # Self-attention block.
@@ -106,7 +111,7 @@ class Attention(nn.Module):
     # Self-attention
     # [batch, latent_length, emb_dim]
     # => [batch, latent_length, emb_dim]
-    x = self.attention(x, x, mask=mask)
+    x = layers.maybe_checkpoint(self.checkpoint == "attention", self.attention, x, x, mask=mask)
 
     x = self.dropout(x)
 
@@ -157,10 +162,13 @@ class PerceiverResampler(nn.Module):
     attention_mask = layers.make_attention_mask(query_mask, query_mask).to(embed.dtype)
 
     for lyr in range(self.config.num_layers):
+      layer = getattr(self, f'layers_{lyr}')
       if lyr in self.config.xattention_index:
-        latents = getattr(self, f'layers_{lyr}')(latents, embed, xattention_mask)
+        latents = layers.maybe_checkpoint(
+          layer.checkpoint == "layer", layer, latents, embed, xattention_mask)
       else:
-        latents = getattr(self, f'layers_{lyr}')(latents, attention_mask)
+        latents = layers.maybe_checkpoint(
+          layer.checkpoint == "layer", layer, latents, attention_mask)
     
     latents = self.perceiver_norm(latents)
     
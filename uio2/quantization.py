@@ -0,0 +1,319 @@
+"""Int8 quantization for inference
+
+Weights are stored as int8 with a float scale per output channel (per row for embeddings),
+activations stay in floating point. On CPU, matmuls with few rows, such as decoding steps,
+use `torch.ops.aten._weight_int8pack_mm` which reads the int8 weights directly, otherwise the
+weights are converted back to the activation's dtype before the matmul.
+
+`Int8DynamicCache` similarly stores the decoder's cached keys and values as int8, and
+`benchmark_kv_cache` compares it to the default cache.
+"""
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+from transformers import DynamicCache
+
+# `_weight_int8pack_mm` is only faster than a dense matmul for a few rows, and gives wrong
+# results or crashes if the input dimension is not a multiple of 16 or the weights or inputs
+# are not 64-byte aligned
+INT8_MM_MAX_ROWS = 32
+INT8_MM_ALIGNMENT = 16
+INT8_MM_BYTE_ALIGNMENT = 64
+
+
+def quantize_weight(weight: torch.Tensor):
+  """Returns the int8 weights and per-row scales of `weight` with symmetric quantization"""
+  weight = weight.detach().to(torch.float32)
+  scale = torch.clamp(weight.abs().amax(dim=-1) / 127.0, min=1e-8)
+  qweight = torch.clamp(torch.round(weight / scale[:, None]), -127, 127).to(torch.int8)
+  return qweight, scale
+
+
+def _aligned(x: torch.Tensor) -> torch.Tensor:
+  x = x.contiguous()
+  return x if x.data_ptr() % INT8_MM_BYTE_ALIGNMENT == 0 else x.clone()
+
+
+class Int8Linear(nn.Module):
+  """Linear layer with int8 weights and per-output-channel scales"""
+
+  def __init__(self, qweight: torch.Tensor, scale: torch.Tensor, bias=None):
+    super().__init__()
+    self.out_features, self.in_features = qweight.shape
+    self.register_buffer("qweight", qweight)
+    self.register_buffer("scale", scale)
+    self.register_buffer("bias", bias)
+
+  @staticmethod
+  def from_linear(linear: nn.Linear) -> 'Int8Linear':
+    qweight, scale = quantize_weight(linear.weight)
+    scale = scale.to(linear.weight.dtype)
+    bias = None if linear.bias is None else linear.bias.detach()
+    return Int8Linear(qweight, scale, bias)
+
+  @property
+  def weight(self) -> torch.Tensor:
+    """De-quantized weights"""
+    return self.qweight.to(self.scale.dtype) * self.scale[:, None]
+
+  def _use_int8_mm(self, x: torch.Tensor) -> bool:
+    return (
+      # The alignment checks cannot be traced, so compiled graphs de-quantize the weights
+      not torch.compiler.is_compiling() and
+      x.device.type == "cpu" and
+      hasattr(torch.ops.aten, "_weight_int8pack_mm") and
+      self.in_features % INT8_MM_ALIGNMENT == 0 and
+      self.qweight.data_ptr() % INT8_MM_BYTE_ALIGNMENT == 0 and
+      x.numel() // self.in_features <= INT8_MM_MAX_ROWS
+    )
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    if self._use_int8_mm(x):
+      # This kernel only supports bfloat16 activations
+      out = torch.ops.aten._weight_int8pack_mm(
+        _aligned(x.reshape(-1, self.in_features).to(torch.bfloat16)),
+        self.qweight, self.scale.to(torch.bfloat16))
+      out = out.reshape(x.shape[:-1] + (self.out_features,)).to(x.dtype)
+    else:
+      out = F.linear(x, self.qweight.to(x.dtype)) * self.scale.to(x.dtype)
+    if self.bias is not None:
+      out = out + self.bias.to(x.dtype)
+    return out
+
+  def extra_repr(self) -> str:
+    return f"in_features={self.in_features}, out_features={self.out_features}, " \
+           f"bias={self.bias is not None}"
+
+
+class Int8Embedding(nn.Module):
+  """Embedding with int8 weights and per-embedding scales
+
+  `weight` returns the de-quantized weights so the embedding can still be used as the output
+  layer, lookups only de-quantize the selected rows.
+  """
+
+  def __init__(self, qweight: torch.Tensor, scale: torch.Tensor):
+    super().__init__()
+    self.num_embeddings, self.embedding_dim = qweight.shape
+    self.register_buffer("qweight", qweight)
+    self.register_buffer("scale", scale)
+
+  @staticmethod
+  def from_embedding(embedding: nn.Embedding) -> 'Int8Embedding':
+    qweight, scale = quantize_weight(embedding.weight)
+    return Int8Embedding(qweight, scale.to(embedding.weight.dtype))
+
+  @property
+  def weight(self) -> torch.Tensor:
+    """De-quantized weights"""
+    return self.qweight.to(self.scale.dtype) * self.scale[:, None]
+
+  def forward(self, ids: torch.Tensor) -> torch.Tensor:
+    return F.embedding(ids, self.qweight).to(self.scale.dtype) * self.scale[ids][..., None]
+
+  def extra_repr(self) -> str:
+    return f"{self.num_embeddings}, {self.embedding_dim}"
+
+
+def quantize_modules(module: nn.Module, should_quantize: Callable[[str, nn.Module], bool]):
+  """Replaces the `nn.Linear` and `nn.Embedding` sub-modules of `module` with int8 versions
+
+  Args:
+    module: module to quantize in-place
+    should_quantize: function of the sub-module name and sub-module that returns if it should
+                     be quantized
+
+  Returns:
+    The names of the quantized sub-modules
+  """
+  quantized = []
+  for name, child in list(module.named_modules()):
+    # Sub-classes, such as the output layer of `nn.MultiheadAttention`, might read the weights
+    # directly so only exact matches are converted
+    if type(child) not in (nn.Linear, nn.Embedding) or not should_quantize(name, child):
+      continue
+    if isinstance(child, nn.Linear):
+      new = Int8Linear.from_linear(child)
+    else:
+      new = Int8Embedding.from_embedding(child)
+    parent_name, _, child_name = name.rpartition(".")
+    setattr(module.get_submodule(parent_name), child_name, new)
+    quantized.append(name)
+  return quantized
+
+
+def get_quantized_names(tensor_names: Iterable[str]):
+  """Returns the names of the quantized modules in a state dict or checkpoint"""
+  return sorted(name[:-len(".qweight")] for name in tensor_names if name.endswith(".qweight"))
+
+
+def align_quantized_weights(module: nn.Module):
+  """Copies int8 weights that are not aligned for `_weight_int8pack_mm`
+
+  Tensors memory-mapped from a safetensors file are only aligned to their element size.
+  """
+  for child in module.modules():
+    if isinstance(child, Int8Linear) and child.qweight.data_ptr() % INT8_MM_BYTE_ALIGNMENT:
+      child.qweight = child.qweight.clone()
+
+
+def benchmark(model: nn.Module, quantized: nn.Module, batches: Iterable[Dict[str, torch.Tensor]],
+              max_new_tokens: int = 32, modality: str = "text") -> Dict[str, float]:
+  """Compares the accuracy and speed of a quantized `UnifiedIOModel` to the original model
+
+  Args:
+    model: the original model
+    quantized: the same model after `UnifiedIOModel.quantize`
+    batches: batches of pre-processed examples, batches with targets are also used to compare
+             the losses
+    max_new_tokens: tokens to generate for each batch
+    modality: modality to generate
+
+  Returns:
+    Mean absolute loss difference, the fraction of generated tokens that match, and the mean
+    generation time in seconds of both models
+  """
+  loss_diffs, matches, n_tokens = [], 0, 0
+  times = {"model": 0.0, "quantized": 0.0}
+  n_batches = 0
+  with torch.no_grad():
+    for batch in batches:
+      n_batches += 1
+      # Keys from `UnifiedIOPreprocessor` start with a "/"
+      if any(k.lstrip("/").startswith("targets/") for k in batch):
+        losses = model.compute_loss(batch)
+        quantized_losses = quantized.compute_loss(batch)
+        loss_diffs += [abs(losses[k].item() - quantized_losses[k].item()) for k in losses]
+      out = {}
+      for name, m in [("model", model), ("quantized", quantized)]:
+        t0 = time.perf_counter()
+        out[name] = m.generate(
+          batch, modality=modality, max_new_tokens=max_new_tokens, do_sample=False)
+        times[name] += time.perf_counter() - t0
+      length = min(out["model"].shape[1], out["quantized"].shape[1])
+      matches += (out["model"][:, :length] == out["quantized"][:, :length]).sum().item()
+      n_tokens += out["model"][:, :length].numel()
+  return dict(
+    loss_diff=sum(loss_diffs) / max(len(loss_diffs), 1),
+    token_agreement=matches / max(n_tokens, 1),
+    seconds=times["model"] / max(n_batches, 1),
+    quantized_seconds=times["quantized"] / max(n_batches, 1),
+  )
+
+
+def quantize_per_head(x: torch.Tensor):
+  """Returns int8 values and scales of `x` with a scale for each vector in its last dimension"""
+  scale = torch.clamp(x.abs().amax(dim=-1, keepdim=True).to(torch.float32) / 127.0, min=1e-8)
+  qx = torch.clamp(torch.round(x / scale), -127, 127).to(torch.int8)
+  return qx, scale.to(x.dtype)
+
+
+class Int8DynamicCache(DynamicCache):
+  """`DynamicCache` that stores keys and values as int8
+
+  Each cached key and value has a scale for each token and head, they are de-quantized to the
+  dtype of the model when the attention layers read them.
+  """
+
+  def __init__(self) -> None:
+    super().__init__()
+    self.key_scale: List[torch.Tensor] = []
+    self.value_scale: List[torch.Tensor] = []
+
+  def __getitem__(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    if layer_idx >= len(self):
+      raise KeyError(f"Cache only has {len(self)} layers, attempted to access layer {layer_idx}")
+    return (
+      self.key_cache[layer_idx].to(self.key_scale[layer_idx].dtype) * self.key_scale[layer_idx],
+      self.value_cache[layer_idx].to(self.value_scale[layer_idx].dtype) * self.value_scale[layer_idx]
+    )
+
+  def __iter__(self):
+    for layer_idx in range(len(self)):
+      yield self[layer_idx]
+
+  def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int,
+             cache_kwargs=None) -> Tuple[torch.Tensor, torch.Tensor]:
+    if layer_idx == 0:
+      self.seen_tokens += key_states.shape[-2]
+    key, key_scale = quantize_per_head(key_states)
+    value, value_scale = quantize_per_head(value_states)
+    if len(self.key_cache) <= layer_idx:
+      self.key_cache.append(key)
+      self.value_cache.append(value)
+      self.key_scale.append(key_scale)
+      self.value_scale.append(value_scale)
+    else:
+      self.key_cache[layer_idx] = torch.cat([self.key_cache[layer_idx], key], dim=-2)
+      self.value_cache[layer_idx] = torch.cat([self.value_cache[layer_idx], value], dim=-2)
+      self.key_scale[layer_idx] = torch.cat([self.key_scale[layer_idx], key_scale], dim=-2)
+      self.value_scale[layer_idx] = torch.cat([self.value_scale[layer_idx], value_scale], dim=-2)
+    return self[layer_idx]
+
+  def reorder_cache(self, beam_idx: torch.LongTensor):
+    super().reorder_cache(beam_idx)
+    for layer_idx in range(len(self)):
+      beam_idx = beam_idx.to(self.key_scale[layer_idx].device)
+      self.key_scale[layer_idx] = self.key_scale[layer_idx].index_select(0, beam_idx)
+      self.value_scale[layer_idx] = self.value_scale[layer_idx].index_select(0, beam_idx)
+
+  def to_legacy_cache(self):
+    return tuple(self)
+
+  def get_num_bytes(self) -> int:
+    """Returns the number of bytes used by the cached keys, values, and scales"""
+    return sum(x.numel() * x.element_size() for x in
+               self.key_cache + self.value_cache + self.key_scale + self.value_scale)
+
+
+def get_cache_num_bytes(cache: DynamicCache) -> int:
+  """Returns the number of bytes used by a `DynamicCache` or `Int8DynamicCache`"""
+  if isinstance(cache, Int8DynamicCache):
+    return cache.get_num_bytes()
+  return sum(x.numel() * x.element_size() for x in cache.key_cache + cache.value_cache)
+
+
+def benchmark_kv_cache(model: nn.Module, batches: Iterable[Dict[str, torch.Tensor]],
+                       modality: str = "image", seed: int = 0, **kwargs) -> Dict[str, float]:
+  """Compares generation of a `UnifiedIOModel` with and without `quantize_kv_cache=True`
+
+  Args:
+    model: the model
+    batches: batches of pre-processed examples
+    modality: modality to generate
+    seed: seed set before each generation, so sampled tokens can be compared
+    **kwargs: other arguments for `UnifiedIOModel.generate`, such as `negative_prompt`
+
+  Returns:
+    Mean cache size in bytes and generation time in seconds with both caches, and the fraction
+    of generated tokens that match
+  """
+  matches, n_tokens, n_batches = 0, 0, 0
+  num_bytes = {"cache": 0, "quantized_cache": 0}
+  times = {"cache": 0.0, "quantized_cache": 0.0}
+  with torch.no_grad():
+    for batch in batches:
+      n_batches += 1
+      out = {}
+      for name, cache in [("cache", DynamicCache()), ("quantized_cache", Int8DynamicCache())]:
+        torch.manual_seed(seed)
+        t0 = time.perf_counter()
+        out[name] = model.generate(
+          batch, modality=modality, past_key_values=cache, return_dict_in_generate=True,
+          **kwargs).sequences
+        times[name] += time.perf_counter() - t0
+        num_bytes[name] += get_cache_num_bytes(cache)
+      length = min(out["cache"].shape[1], out["quantized_cache"].shape[1])
+      matches += (out["cache"][:, :length] == out["quantized_cache"][:, :length]).sum().item()
+      n_tokens += out["cache"][:, :length].numel()
+  n_batches = max(n_batches, 1)
+  return dict(
+    cache_bytes=num_bytes["cache"] / n_batches,
+    quantized_cache_bytes=num_bytes["quantized_cache"] / n_batches,
+    token_agreement=matches / max(n_tokens, 1),
+    seconds=times["cache"] / n_batches,
+    quantized_seconds=times["quantized_cache"] / n_batches,
+  )
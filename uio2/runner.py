@@ -1,4 +1,5 @@
 """Runner to use the model for specific tasks"""
+import functools
 import json
 import logging
 import re
@@ -6,18 +7,20 @@ from os.path import join, dirname
 
 import numpy as np
 import tensorflow as tf
-from typing import List
+from typing import List, Tuple
 
 import torch
 from PIL import Image
 from transformers import LogitsProcessor
 
 from uio2 import config
+from uio2.answer_options import AnswerOptions
+from uio2.constrained_decoding import BoxAutomaton, KeypointAutomaton
 from uio2.hifigan.models import Generator as HifiganGenerator
 from uio2.preprocessing import UnifiedIOPreprocessor
 from uio2.prompt import Prompt
-from uio2.utils import flatten_dict, pad_and_stack, token_to_float, undo_box_preprocessing, \
-  extra_id_to_float, extract_locations_from_token_ids, undo_image_preprocessing
+from uio2.utils import flatten_dict, undo_box_preprocessing, \
+  extra_id_to_float, undo_image_preprocessing
 
 HUMAN_POSE_PART = [
   "nose", "left eye", "right eye", "left ear", "right ear", "left shoulder",
@@ -117,11 +120,16 @@ def extract_keypoints(text, image_info):
     else:
       output_points[ix] = point
       output_labels[ix] = 2
-  points, labels = output_points, output_labels
+  return postprocess_keypoints(output_points, output_labels, image_info), invalid
 
+
+def postprocess_keypoints(points, labels, image_info):
+  """Converts [17, 2] yx keypoints in the preprocessed image, and [17] labels that are non-zero
+  for predicted points, into [17, 3] (x, y, label) keypoints in the original image, or None if
+  no point was predicted"""
   if np.sum(labels) == 0:
     # No visible points predicted
-    return None, invalid
+    return None
 
   if image_info is not None:
     points = undo_box_preprocessing(np.tile(points, [1, 2]), image_info)[:, :2]
@@ -134,7 +142,7 @@ def extract_keypoints(text, image_info):
 
   assert points.shape == (17, 2)
   points = np.concatenate([points, labels.astype(points.dtype)[:, None]], -1)
-  return points, invalid
+  return points
 
 
 class PredictBoxesPreprocessor(LogitsProcessor):
@@ -232,13 +240,16 @@ class TaskRunner:
   """
 
   def __init__(self, model, uio2_preprocessor: UnifiedIOPreprocessor, prompts=None,
-               use_hifigan_for_audio=True):
+               use_hifigan_for_audio=True, answer_options_cache_size=32):
     self.model = model
     self.uio2_preprocessor = uio2_preprocessor
     if prompts is None:
       prompts = Prompt()
     self.prompt = prompts
     self.spectogram_converter = SpectogramConverter(use_hifigan_for_audio)
+    self._keypoint_constraint = None
+    self._answer_options = functools.lru_cache(maxsize=answer_options_cache_size)(
+      self._build_answer_options)
 
   @property
   def tokenizer(self):
@@ -248,6 +259,15 @@ class TaskRunner:
   def device(self):
     return self.model.device
 
+  def _build_answer_options(self, answer_options: Tuple[str, ...], device) -> AnswerOptions:
+    return AnswerOptions.from_text(self.tokenizer, list(answer_options)).to(device)
+
+  def get_answer_options(self, answer_options: List[str]) -> AnswerOptions:
+    """Returns tokenized `answer_options`, the most recently used options are cached so
+    repeated calls with the same options do not need to re-tokenize them or rebuild their
+    prefix tries"""
+    return self._answer_options(tuple(answer_options), self.device)
+
   def singleton_batch(self, batch):
     return {k: torch.as_tensor(v, device=self.device)[None, ...] for k, v in batch.items()}
 
@@ -275,11 +295,11 @@ class TaskRunner:
     prompt = self.prompt.random_prompt("Refexp")
     prompt = prompt.replace("{}", expression)
     batch = self.uio2_preprocessor(text_inputs=prompt, image_inputs=image, target_modality="text")
-    tokens = self.predict_text(batch, max_tokens=6, detokenize=False)
-    if len(tokens) != 6 or (tokens[0] != 0) or (tokens[-1] != 1):
-      raise ValueError(f"Output not a bounding box {tokens}")
-    box = token_to_float(np.array(tokens[1:-1]))
-    box *= config.IMAGE_INPUT_SIZE[0]  # de-normalized w.r.t the preprocessed image
+    constraint = BoxAutomaton(min_boxes=1, max_boxes=1)
+    tokens = self.model.generate(
+      self.singleton_batch(batch), constraint=constraint, max_new_tokens=5)
+    boxes, _ = constraint.parse(tokens[0, 1:].cpu())
+    box = boxes[0] * config.IMAGE_INPUT_SIZE[0]  # de-normalized w.r.t the preprocessed image
     box = undo_box_preprocessing(box, batch["/meta/image_info"])  # -> coordinates for the input image
     box = box.tolist()
     box = [box[1], box[0], box[3], box[2]]  # yxyx to xyxy
@@ -300,45 +320,58 @@ class TaskRunner:
     out = self.predict_text(example, max_tokens=32)
     return out
 
-  def box_categorization(self, image, box, answer_options, batch_size=50):
+  def box_categorization(self, image, box, answer_options, batch_size=50, prune_margin=None):
     """Categorization the object in an image region
 
     Args:
       image: image to examine
       box: x1y1x2y2 region coordinates
       answer_options: possible classes
+      prune_margin: stop scoring classes whose total loss falls behind the best class by this
+                    margin, see `UnifiedIOModel.score_answer_options`. Classes are then ranked
+                    by total instead of per-token loss, and the result may differ from exact
+                    scoring
 
     Returns: the most probable class
     """
     if isinstance(answer_options, list):
-      tensors = pad_and_stack(
-        [self.tokenizer.encode(x) + [1] for x in answer_options], add_eos=True)
-      tensors = tensors.to(self.device)
+      options = self.get_answer_options(answer_options)
     else:
       # assume options are already in tensor form
-      tensors = answer_options
+      options = AnswerOptions(answer_options)
     prompt = self.prompt.random_prompt("Box_Classification_Scene")
     example = self.uio2_preprocessor(
       text_inputs=prompt, image_inputs=image, target_modality="text", box_inputs=box)
     batch = self.singleton_batch(example)
-    scores = self.model.score_answer_options(batch, tensors, batch_size)
+    if prune_margin is None:
+      scores = self.model.score_answer_options(batch, options, batch_size)
+    else:
+      scores = self.model.score_answer_options(
+        batch, options, batch_size, average_loss=False, prune_margin=prune_margin)[0]
     ix = torch.argmin(scores)
     if isinstance(answer_options, list):
       return answer_options[ix]
     else:
-      return self.tokenizer.decode(tensors[ix])
+      return self.tokenizer.decode(options.tokens[ix])
+
+  def categorization(self, image, answer_options, batch_size=50, prune_margin=None):
+    """Categorize the image, return a class in `answer_options`
 
-  def categorization(self, image, answer_options, batch_size=50):
-    """Categorize the image, return a class in `answer_options`"""
+    If `prune_margin` is set, classes whose total loss falls behind the best class by that margin
+    are not scored further, see `UnifiedIOModel.score_answer_options`. Classes are then ranked by
+    total instead of per-token loss, and the result may differ from exact scoring
+    """
     # imagenet prompt is generic, but using a prompt that give a better hint about what kind
     # of classes to consider can help
     prompt = self.prompt.random_prompt("image_tagging_imagenet2012")
     batch = self.uio2_preprocessor(text_inputs=prompt, image_inputs=image, target_modality="text")
     batch = self.singleton_batch(batch)
-    tensors = pad_and_stack(
-      [self.tokenizer.encode(x) + [1] for x in answer_options], add_eos=True)
-    tensors = tensors.to(self.device)
-    scores = self.model.score_answer_options(batch, tensors, batch_size)
+    options = self.get_answer_options(answer_options)
+    if prune_margin is None:
+      scores = self.model.score_answer_options(batch, options, batch_size)
+    else:
+      scores = self.model.score_answer_options(
+        batch, options, batch_size, average_loss=False, prune_margin=prune_margin)[0]
     ix = torch.argmin(scores)
     return answer_options[ix]
 
@@ -364,11 +397,12 @@ class TaskRunner:
     prompt = prompt.replace("{}", cls)
     batch = self.uio2_preprocessor(
       text_inputs=prompt, image_inputs=image, target_modality="text")
-    out = self.predict_text(
-      batch, max_tokens=256,
-      logits_processor=[PredictBoxesPreprocessor(thresh)],
-      detokenize=False)
-    boxes = extract_locations_from_token_ids(out)
+    # The model repeats `cls` after each box unless `no_cat` is set
+    constraint = BoxAutomaton(self.tokenizer, class_names=None if no_cat else [cls])
+    out = self.model.generate(
+      self.singleton_batch(batch), constraint=constraint, max_new_tokens=256,
+      logits_processor=[PredictBoxesPreprocessor(thresh)])
+    boxes, _ = constraint.parse(out[0, 1:].cpu())
     if len(boxes) > 0:
       boxes = boxes*config.IMAGE_INPUT_SIZE[0]
       boxes = undo_box_preprocessing(boxes, batch["/meta/image_info"])
@@ -403,11 +437,21 @@ class TaskRunner:
     batch = self.uio2_preprocessor(
       text_inputs=prompt, image_inputs=image, target_modality="text",
       box_inputs=target_box)
-    text = self.predict_text(
-      batch, max_tokens=128,
-      logits_processor=None if free_form else [ForceKeypointPrediction(self.tokenizer)])
-    kps, valid = extract_keypoints(text, batch["/meta/image_info"])
-    return kps, text
+    if free_form:
+      text = self.predict_text(batch, max_tokens=128)
+      kps, valid = extract_keypoints(text, batch["/meta/image_info"])
+      return kps, text
+
+    # The part names are forced, so `generate_constrained` jumps forward over them
+    if self._keypoint_constraint is None:
+      self._keypoint_constraint = KeypointAutomaton(self.tokenizer, HUMAN_POSE_PART)
+    constraint = self._keypoint_constraint
+    tokens = self.model.generate(
+      self.singleton_batch(batch), constraint=constraint, max_new_tokens=128)[0].cpu()
+    points, labels = constraint.parse(tokens[1:])
+    kps = postprocess_keypoints(
+      points*config.IMAGE_INPUT_SIZE[0], labels, batch["/meta/image_info"])
+    return kps, self.tokenizer.decode(tokens)
 
   def keypoint(self, image):
     """End-to-end keypoint, requires multiple rounds of generation
@@ -423,10 +467,13 @@ class TaskRunner:
       all_points.append(self.keypoint_box(image, box)[0])
     return all_points
 
-  def object_detection(self, image, coco_prompt=False, thresh=0.5, nms=0.8, max_tokens=256):
+  def object_detection(self, image, coco_prompt=False, thresh=0.5, nms=0.8, max_tokens=256,
+                       class_names=None):
     """Returns a list of x1 y2 x2 y2 boxes, and list string box labels
 
     note this task can be pretty unreliable for UIO2, particularly for crowded images
+
+    If `class_names` is given, the labels are constrained to be one of those names
     """
     if coco_prompt:
       # Prompt used for the COCO training data
@@ -435,9 +482,11 @@ class TaskRunner:
       # Prompt for other detection datasets, can result in detecting more classes
       prompt = self.prompt.random_prompt("Detection_Generic")
     batch = self.uio2_preprocessor(text_inputs=prompt, image_inputs=image, target_modality="text")
-    out = self.predict_text(
-      batch, max_tokens=max_tokens, logits_processor=[PredictBoxesPreprocessor(thresh)])
-    boxes, labels = extract_labelled_boxes(out)
+    constraint = BoxAutomaton(self.tokenizer, class_names=class_names, labelled=True)
+    out = self.model.generate(
+      self.singleton_batch(batch), constraint=constraint, max_new_tokens=max_tokens,
+      logits_processor=[PredictBoxesPreprocessor(thresh)])
+    boxes, labels = constraint.parse(out[0, 1:].cpu())
     if len(boxes) > 0:
       boxes = boxes*config.IMAGE_INPUT_SIZE[0]
       boxes = undo_box_preprocessing(boxes, batch["/meta/image_info"])
@@ -6,6 +6,112 @@ from torch.nn import functional as F
 import torch
 
 
+@dataclass
+class PatternMaskBlock:
+  """Pattern mask of one of the sequences in a `PatternMask`"""
+
+  length: int
+  """Number of tokens in the block"""
+
+  pattern: Optional[torch.Tensor] = None
+  """[n_patterns, length, length] pattern shared across the batch, None if all ones"""
+
+  token_mask: Optional[torch.Tensor] = None
+  """[batch, length] tokens with a 0 can only attend to, and be attended to by, themselves"""
+
+
+class PatternMask:
+  """Structured [batch, n_patterns, seq_len, seq_len] attention pattern mask
+
+  Concatenated sequences get a block-diagonal pattern mask, so the mask is stored as a list of
+  `PatternMaskBlock`, concatenated without building the full mask, and only materialized
+  when it is needed, optionally just for a range of queries.
+  """
+
+  def __init__(self, blocks: List[PatternMaskBlock], batch_size: int, n_patterns: int = 4,
+               pattern_ix: Optional[int] = None, device=None):
+    self.blocks = blocks
+    self.batch_size = batch_size
+    self.n_patterns = n_patterns
+    self.pattern_ix = pattern_ix
+    self.device = device
+
+  @staticmethod
+  def ones(batch_size, seq_len, n_patterns=4, device=None) -> 'PatternMask':
+    return PatternMask([PatternMaskBlock(seq_len)], batch_size, n_patterns, device=device)
+
+  @property
+  def seq_len(self):
+    return sum(block.length for block in self.blocks)
+
+  def select_pattern(self, pattern_ix) -> 'PatternMask':
+    """Returns the mask with only pattern `pattern_ix`"""
+    assert self.pattern_ix is None
+    return PatternMask(self.blocks, self.batch_size, self.n_patterns, pattern_ix, self.device)
+
+  def batch_slice(self, ix) -> 'PatternMask':
+    """Returns the mask of the examples in `ix`"""
+    batch_size = torch.arange(self.batch_size)[ix].numel()
+    blocks = [PatternMaskBlock(
+      x.length, x.pattern, None if x.token_mask is None else x.token_mask[ix])
+      for x in self.blocks]
+    return PatternMask(blocks, batch_size, self.n_patterns, self.pattern_ix, self.device)
+
+  def materialize(self, q_start=0, q_end=None) -> torch.Tensor:
+    """Returns the [batch, n_patterns, q_end-q_start, seq_len] boolean mask for the given
+    queries, n_patterns is 1 if a pattern was selected"""
+    seq_len = self.seq_len
+    q_end = seq_len if q_end is None else q_end
+    n_patterns = self.n_patterns if self.pattern_ix is None else 1
+    out = torch.zeros((self.batch_size, n_patterns, q_end - q_start, seq_len),
+                      dtype=torch.bool, device=self.device)
+    on = 0
+    for block in self.blocks:
+      start, end = max(q_start, on), min(q_end, on + block.length)
+      if start < end:
+        queries = slice(start - on, end - on)
+        if block.pattern is None:
+          part = torch.ones((1, 1, 1, 1), dtype=torch.bool, device=self.device)
+        else:
+          pattern = block.pattern
+          if self.pattern_ix is not None:
+            pattern = pattern[self.pattern_ix:self.pattern_ix+1]
+          part = (pattern[:, queries] > 0)[None, :, :, :]
+        if block.token_mask is not None:
+          token_mask = block.token_mask > 0
+          allowed = token_mask[:, queries, None] & token_mask[:, None, :]
+          query_ixs = torch.arange(start - on, end - on, device=self.device)
+          key_ixs = torch.arange(block.length, device=self.device)
+          allowed = allowed | (query_ixs[:, None] == key_ixs[None, :])
+          part = part & allowed[:, None, :, :]
+        out[:, :, start-q_start:end-q_start, on:on+block.length] = part
+      on += block.length
+    return out
+
+  @staticmethod
+  def concat(masks: List[Optional['PatternMask']], seq_lens: List[int]) -> 'PatternMask':
+    """Concatenates the masks into a block diagonal mask, None masks become all zeros"""
+    full = [x for x in masks if x is not None]
+    batch_size = max(x.batch_size for x in full)
+    n_patterns = full[0].n_patterns
+    blocks = []
+    for mask, seq_len in zip(masks, seq_lens):
+      if mask is None:
+        pattern = torch.zeros((1, 1, 1), dtype=torch.bool, device=full[0].device)
+        blocks.append(PatternMaskBlock(seq_len, pattern.expand(n_patterns, seq_len, seq_len)))
+      else:
+        assert mask.pattern_ix is None and mask.n_patterns == n_patterns
+        blocks += mask.blocks
+    return PatternMask(blocks, batch_size, n_patterns, device=full[0].device)
+
+
+def select_pattern(mask, pattern_ix):
+  """Selects one pattern of a `PatternMask` or [batch, n_patterns, seq_len, seq_len] mask"""
+  if isinstance(mask, PatternMask):
+    return mask.select_pattern(pattern_ix)
+  return mask[:, pattern_ix:pattern_ix+1]
+
+
 @dataclass
 class TargetSequence:
   """Target sequence we can train a decoder to predict"""
@@ -13,8 +119,8 @@ class TargetSequence:
   input_embedding: torch.Tensor
   """Input embeddings to the decoder"""
 
-  position_embed: torch.Tensor
-  """Int position ids or embedding"""
+  position_ids: torch.Tensor
+  """Position ids, indices into the model's `layers.RotaryTable`"""
 
   modality_id: torch.Tensor
   """Modality ids's of the tokens, can be a scalar if all the same"""
@@ -22,8 +128,8 @@ class TargetSequence:
   mask: Optional[torch.Tensor]
   """Mask of valid tokens"""
 
-  attn_pattern_mask: Optional[torch.Tensor] = None
-  """[batch, n_heads, seq_len, seq_len] of relative attention bias"""
+  attn_pattern_mask: Optional[PatternMask] = None
+  """[batch, n_patterns, seq_len, seq_len] attention pattern mask"""
 
   target_tokens: Optional[torch.Tensor] = None
   """Target tokens used to compute the loss"""
@@ -48,8 +154,8 @@ class TargetSequence:
   def __post_init__(self):
     bs, seq_len = self.input_embedding.shape[:2]
 
-    if self.position_embed is not None:
-      assert self.position_embed.shape[:2] in [(1, seq_len), (bs, seq_len)]
+    if self.position_ids is not None:
+      assert self.position_ids.shape in [(1, seq_len), (bs, seq_len)]
 
     assert self.modality_id.shape in [(), (1, seq_len), (bs, seq_len)]
     assert self.modality_id.dtype == torch.int32
@@ -63,7 +169,8 @@ class TargetSequence:
       assert self.mask.dtype == torch.int32 or self.mask.dtype == torch.bool
 
     if self.attn_pattern_mask is not None:
-      assert self.attn_pattern_mask.shape[0] in [1, bs]
+      assert self.attn_pattern_mask.batch_size in [1, bs]
+      assert self.attn_pattern_mask.seq_len == seq_len
 
     if self.subsegments is not None:
       assert self.subsegments.shape == (bs, seq_len)
@@ -100,8 +207,8 @@ class InputSequence:
   segment_ids: Optional[torch.Tensor]=None
   """If packed, an example id for each token"""
 
-  position_embed: Optional[torch.Tensor]=None
-  """Positional bias embedding"""
+  position_ids: Optional[torch.Tensor]=None
+  """Position ids, indices into the model's `layers.RotaryTable`"""
 
   @property
   def seq_len(self):
@@ -116,16 +223,15 @@ class InputSequence:
     return InputSequence(
       torch.zeros((bs, seq_len, cfg.emb_dim), dtype=cfg.dtype),
       torch.zeros((bs, seq_len), dtype=torch.int32),
-      position_embed=torch.zeros((bs, seq_len, cfg.emb_dim), dtype=cfg.dtype),
+      position_ids=torch.zeros((bs, seq_len), dtype=torch.int32),
     )
 
   def __post_init__(self):
     assert len(self.embed.shape) == 3
     bs, seq_len = self.embed.shape[:2]
 
-    if self.position_embed is not None:
-      assert len(self.position_embed.shape) == 3
-      assert self.position_embed.shape[:2] in [(bs, seq_len), (1, seq_len)]
+    if self.position_ids is not None:
+      assert self.position_ids.shape in [(bs, seq_len), (1, seq_len)]
     if self.mask is not None:
       assert self.mask.shape == (bs, seq_len)
     if self.segment_ids is not None:
@@ -159,6 +265,10 @@ def concat_sequences(seqs: List):
   out = {}
   for k in dataclasses.fields(seqs[0]):
     k = k.name
+    if k == "attn_pattern_mask":
+      masks = [seq.attn_pattern_mask for seq in seqs]
+      out[k] = None if all(x is None for x in masks) else PatternMask.concat(masks, seq_lens)
+      continue
     args = [expand_scalar(getattr(seq, k), seq.seq_len) for seq in seqs]
 
     if all(x is None for x in args):
@@ -1,4 +1,5 @@
 """Target modality processing"""
+import functools
 from typing import Dict, Optional
 
 import torch
@@ -8,7 +9,7 @@ import numpy as np
 from uio2.config import T5Config, VQGANConfig, AudioViTVQGANConfig
 from uio2.data_utils import make_autoregressive_inputs
 from uio2.input_modalities import ModalityEncoder
-from uio2.seq_features import TargetSequence
+from uio2.seq_features import TargetSequence, PatternMask, PatternMaskBlock
 from uio2.image_vqgan import VQGAN
 from uio2.audio_vqgan import ViTVQGAN
 from uio2 import layers, config
@@ -26,13 +27,18 @@ class TextEmbedder(nn.Module):
     self.config = config
 
     cfg = self.config
-    self.register_buffer("pos_emb_cache", layers.get_1d_position_embedding(
-      cfg.text_pos_emb, cfg.decoder_max_text_length, cfg.emb_dim, cfg.head_dim, True, 1), persistent=False)
+    # Set to the start of this embedder's table in the model's `layers.RotaryTable`
+    self.rope_offset = 0
     if "llama_rope" in cfg.text_pos_emb:
       self.modality_embedding = nn.Parameter(torch.empty(cfg.emb_dim).normal_(std=0.02))
+
+  def get_rope_cache(self):
+    cfg = self.config
+    return layers.get_1d_position_embedding(
+      cfg.text_pos_emb, cfg.decoder_max_text_length, cfg.emb_dim, cfg.head_dim, True, 1)
     
   def forward(self, inputs, shared_embed, mask=None, pos_ids=None, segment_ids=None,
-              targets=None, cur_index=None):
+              targets=None, cur_index=None, example_ids=None):
     cfg = self.config
     bs = inputs.shape[0]
 
@@ -45,17 +51,16 @@ class TextEmbedder(nn.Module):
 
     x = shared_embed(inputs)
 
-    pos_emb = self.pos_emb_cache[pos_ids]
+    pos_ids = pos_ids + self.rope_offset
 
     if "llama_rope" in cfg.text_pos_emb:
       x += self.modality_embedding[None, None, :].to(x.dtype)
 
-    attn_pattern_mask = torch.ones(
-      (bs, 4, x.shape[1], x.shape[1]), dtype=x.dtype, device=x.device)
+    attn_pattern_mask = PatternMask.ones(bs, x.shape[1], device=x.device)
     modality_id = torch.full((), TEXT_MODALITY_INDEX, device=x.device, dtype=torch.int32)
     return TargetSequence(
-      x, pos_emb, modality_id, mask, attn_pattern_mask=attn_pattern_mask,
-      subsegments=segment_ids, target_tokens=targets, loss_mask=mask
+      x, pos_ids, modality_id, mask, attn_pattern_mask=attn_pattern_mask,
+      subsegments=segment_ids, segment_ids=example_ids, target_tokens=targets, loss_mask=mask
     )
 
 
@@ -95,42 +100,83 @@ def _init_mask(height, width, is_bool_mask=False):
   return mask
 
 
+def _query_key_ixs(height, width):
+  ixs = torch.arange(height * width)
+  return ixs[:, None], ixs[None, :]
+
+
 def get_row_mask(height=32, width=32, is_bool_mask=False):
-  mask = _init_mask(height, width, is_bool_mask=is_bool_mask)
-  step = width + 1
-  for col in range(mask.shape[1]):
-      mask[col + step:, col] = False if is_bool_mask else 0.0
-  return mask  
+  # Causal mask limited to the previous `width` tokens
+  query, key = _query_key_ixs(height, width)
+  mask = (query >= key) & (query - key <= width)
+  return mask if is_bool_mask else mask.to(torch.float32)
 
 
 def get_col_mask(height=32, width=32, is_bool_mask=False):
-  mask = _init_mask(height, width, is_bool_mask=is_bool_mask)
-  step = width - 1
-  for col in range(mask.shape[1]):
-      for i in range(1, mask.shape[0], step+1):
-          mask[col + i: col + i + step, col] = False if is_bool_mask else 0.0
-  return mask
+  # Causal mask limited to tokens in the same column
+  query, key = _query_key_ixs(height, width)
+  mask = (query >= key) & ((query - key) % width == 0)
+  return mask if is_bool_mask else mask.to(torch.float32)
 
 
 def get_conv_mask(height=32, width=32, kernel=11, is_bool_mask=False, hf_version='v3'):
-  mask = _init_mask(height, width, is_bool_mask=is_bool_mask)
+  # Each token is attended to by itself and the later tokens in the `kernel` x `kernel` window
+  # around it, with window coordinates clipped to the grid
+  n = height * width
   shift = kernel // 2
-  for pos in range(mask.shape[1]):
-    mask[pos+1:, pos] = False if is_bool_mask else 0.0
-    img = torch.zeros([height, width])
-    pixel_id = pos
-    row = pixel_id // width
-    col = pixel_id % width
-    for r in range(-shift, shift+1):
-      for c in range(-shift, shift+1):
-        c_abs = max(min(c + col, width - 1), 0)
-        r_abs = max(min(r + row, height - 1), 0)
-        img[r_abs, c_abs] = 0.2
-        cell_id = r_abs * width + c_abs
-        if  cell_id > pos:
-          mask[cell_id, pos] = True if is_bool_mask else 1.0
-    img[row, col] = 1.0
-  return mask
+  pos = torch.arange(n)
+  offsets = torch.arange(-shift, shift+1)
+  rows = ((pos // width)[:, None, None] + offsets[None, :, None]).clamp(0, height - 1)
+  cols = ((pos % width)[:, None, None] + offsets[None, None, :]).clamp(0, width - 1)
+  query = (rows * width + cols).reshape(n, -1)
+  key = pos[:, None].expand_as(query)
+  is_later = query > key
+  mask = torch.eye(n, dtype=torch.bool)
+  mask[query[is_later], key[is_later]] = True
+  return mask if is_bool_mask else mask.to(torch.float32)
+
+
+@functools.lru_cache()
+def get_dalle_attn_mask(height=32, width=32, kernel=11, is_bool_mask=False):
+  """Returns the [4, height*width, height*width] row, column, conv and causal masks
+
+  The result is cached so modules with the same grid share one tensor, do not modify it in place
+  """
+  return torch.stack([
+    get_row_mask(height, width, is_bool_mask),
+    get_col_mask(height, width, is_bool_mask),
+    get_conv_mask(height, width, kernel, is_bool_mask),
+    _init_mask(height, width, is_bool_mask)
+  ], dim=0)
+
+
+def get_pattern_mask(attn_mask, cfg: T5Config, bs, seq_len, task_mask=None, cur_index=None):
+  """Returns the `PatternMask` of an image or audio target sequence
+
+  Args:
+    attn_mask: [4, n, n] DALL-E attention mask of the modality
+    cfg: model config
+    bs: batch size
+    seq_len: target sequence length
+    task_mask: [bs, seq_len] 1 if we should mask the corresponding token
+    cur_index: position of the token, if decoding one token at a time
+  """
+  if not cfg.dalle_attn_mask:
+    # use full mask if we are not using dalle attn mask.
+    attn_mask = attn_mask[-1:].expand(4, -1, -1)
+  if cur_index is not None:
+    pattern = attn_mask[:, cur_index:cur_index+seq_len, cur_index:cur_index+seq_len]
+  else:
+    pattern = attn_mask[:, :seq_len, :seq_len]
+
+  noise_mask = None
+  if cfg.dynamic_unk_mask and task_mask is not None:
+    noise_mask = 1 - task_mask
+    # shift the mask by 1, masked tokens can only attend to themselves
+    noise_mask = torch.cat([
+      torch.ones(noise_mask.shape[0], 1, dtype=noise_mask.dtype, device=noise_mask.device),
+      noise_mask[:, :-1]], dim=1)
+  return PatternMask([PatternMaskBlock(seq_len, pattern, noise_mask)], bs, device=attn_mask.device)
 
 
 class ImageVQGAN(nn.Module):
@@ -149,26 +195,26 @@ class ImageVQGAN(nn.Module):
     assert cfg.image_tokenizer_type == 'vqgan', "Only VQGAN is supported for image."
     self.vqgan = VQGAN(vqgan_config)
     
-    # construct the row, col and conv mask.
-    row_mask = get_row_mask(self.grid_size[0], self.grid_size[1])
-    col_mask = get_col_mask(self.grid_size[0], self.grid_size[1])
-    conv_mask = get_conv_mask(self.grid_size[0], self.grid_size[1])
-    full_mask = _init_mask(self.grid_size[0], self.grid_size[1])
-
+    # construct the row, col, conv and full mask.
     self.register_buffer(
-      "attn_mask", torch.stack([row_mask, col_mask, conv_mask, full_mask], dim=0), persistent=False)
+      "attn_mask", get_dalle_attn_mask(self.grid_size[0], self.grid_size[1]), persistent=False)
     
-    self.register_buffer("pos_emb_cache", layers.get_2d_position_embedding(
-        cfg.image_pos_emb,
-        vqgan_cfg.default_input_size,
-        vqgan_cfg.patch_size,
-        cfg.emb_dim,
-        cfg.head_dim,
-        2), persistent=False)
+    # Set to the start of this embedder's table in the model's `layers.RotaryTable`
+    self.rope_offset = 0
     
     if "llama_rope" in cfg.image_pos_emb:
       self.modality_embedding = nn.Parameter(torch.empty(cfg.emb_dim).normal_(std=0.02))
     
+  def get_rope_cache(self):
+    cfg = self.config
+    return layers.get_2d_position_embedding(
+        cfg.image_pos_emb,
+        self.vqgan_config.default_input_size,
+        self.vqgan_config.patch_size,
+        cfg.emb_dim,
+        cfg.head_dim,
+        2)
+
   def target_image_to_seq(self, image: torch.Tensor, loss_mask: torch.Tensor = None):
     cfg = self.config
     bs = image.shape[0]
@@ -190,18 +236,19 @@ class ImageVQGAN(nn.Module):
     return input_tokens, target_tokens, loss_mask
 
   def get_target_sequence(self, input_tokens, shared_embed, mask, target_tokens=None, task_mask=None,
-                          loss_mask=None, segment_ids=None, cur_index=None, pos_ids=None):
+                          loss_mask=None, segment_ids=None, cur_index=None, pos_ids=None,
+                          example_ids=None):
     cfg = self.config
     bs = input_tokens.shape[0]
 
     x = shared_embed(input_tokens)
 
     if cur_index is not None:
-      pos_emb = self.pos_emb_cache[cur_index:cur_index+1,:][None, :, :]
+      pos_ids = torch.full((1, 1), cur_index, device=x.device)
     else:
-      pos_emb = self.pos_emb_cache[:x.shape[1]][None, :, :]
+      pos_ids = torch.arange(x.shape[1], device=x.device)[None, :]
     
-    pos_emb = pos_emb.expand(bs, -1, -1)
+    pos_ids = (pos_ids + self.rope_offset).expand(bs, -1)
 
     if "llama_rope" in cfg.image_pos_emb:
       x += self.modality_embedding[None, None, :].to(x.dtype)
@@ -209,33 +256,19 @@ class ImageVQGAN(nn.Module):
     if mask is None:
       mask = torch.ones(x.shape[0], x.shape[1], dtype=torch.int32, device=x.device)
 
-    if cfg.dalle_attn_mask:
-      attn_pattern_mask = self.attn_mask[None,:,:,:].expand(x.shape[0], -1, -1, -1)
-    else:
-      # use full mask if we are not using dalle attn mask.
-      attn_pattern_mask = self.attn_mask[None,-1,:,:].expand(x.shape[0], 4, -1, -1)
-
-    # task_mask: 1 if we should mask the corresponding token
-    if cfg.dynamic_unk_mask and task_mask is not None:
-      noise_mask = 1 - task_mask
-      # shift the mask by 1
-      noise_mask = torch.cat([
-        torch.ones(noise_mask.shape[0], 1, dtype=noise_mask.dtype, device=noise_mask.device),
-        noise_mask[:, :-1]], dim=1)
-      dynamic_unk_mask = layers.make_attention_mask(noise_mask, noise_mask)
-      identity_mask = torch.eye(x.shape[1], dtype=dynamic_unk_mask.dtype, device=dynamic_unk_mask.device)
-      dynamic_unk_mask = torch.logical_or(dynamic_unk_mask, identity_mask)
-      attn_pattern_mask = layers.combine_masks(dynamic_unk_mask, attn_pattern_mask).to(attn_pattern_mask.dtype)
+    attn_pattern_mask = get_pattern_mask(
+      self.attn_mask, cfg, bs, x.shape[1], task_mask, cur_index)
 
     modality_id = torch.full((), IMAGE_MODALITY_INDEX, device=x.device, dtype=torch.int32)
     seq = TargetSequence(
-      x, pos_emb, modality_id, mask, attn_pattern_mask=attn_pattern_mask,
-      subsegments=segment_ids, target_tokens=target_tokens, loss_mask=loss_mask)
+      x, pos_ids, modality_id, mask, attn_pattern_mask=attn_pattern_mask,
+      subsegments=segment_ids, segment_ids=example_ids, target_tokens=target_tokens,
+      loss_mask=loss_mask)
     
     return seq
 
   def forward(self, image, shared_embed, mask=None, loss_mask=None, task_mask=None, segment_ids=None,
-              cur_index=None, pos_ids=None):
+              cur_index=None, pos_ids=None, example_ids=None):
     
     cfg = self.config
     if cur_index is not None:
@@ -244,7 +277,8 @@ class ImageVQGAN(nn.Module):
       input_tokens, target_tokens, loss_mask = self.target_image_to_seq(image, loss_mask)
 
       return self.get_target_sequence(input_tokens, shared_embed, mask, target_tokens, task_mask,
-                                      loss_mask, segment_ids, pos_ids=pos_ids)
+                                      loss_mask, segment_ids, pos_ids=pos_ids,
+                                      example_ids=example_ids)
 
 
 class TargetImageVQGANEmbedder(ModalityEncoder):
@@ -318,26 +352,26 @@ class AudioVQGAN(nn.Module):
 
     self.vqgan = ViTVQGAN(vqgan_config)
     
-    # construct the row, col and conv mask.
-    row_mask = get_row_mask(self.grid_size[0], self.grid_size[1])
-    col_mask = get_col_mask(self.grid_size[0], self.grid_size[1])
-    conv_mask = get_conv_mask(self.grid_size[0], self.grid_size[1])
-    full_mask = _init_mask(self.grid_size[0], self.grid_size[1])
-
+    # construct the row, col, conv and full mask.
     self.register_buffer(
-      "attn_mask", torch.stack([row_mask, col_mask, conv_mask, full_mask], dim=0), persistent=False)
+      "attn_mask", get_dalle_attn_mask(self.grid_size[0], self.grid_size[1]), persistent=False)
     
-    self.register_buffer("pos_emb_cache", layers.get_2d_position_embedding(
-        cfg.audio_pos_emb,
-        vqgan_cfg.default_input_size,
-        vqgan_cfg.patch_size,
-        cfg.emb_dim,
-        cfg.head_dim,
-        3), persistent=False)
+    # Set to the start of this embedder's table in the model's `layers.RotaryTable`
+    self.rope_offset = 0
     
     if "llama_rope" in cfg.image_pos_emb:
       self.modality_embedding = nn.Parameter(torch.empty(cfg.emb_dim).normal_(std=0.02))
     
+  def get_rope_cache(self):
+    cfg = self.config
+    return layers.get_2d_position_embedding(
+        cfg.audio_pos_emb,
+        self.vqgan_config.default_input_size,
+        self.vqgan_config.patch_size,
+        cfg.emb_dim,
+        cfg.head_dim,
+        3)
+
   def target_audio_to_seq(self, audio: torch.Tensor, loss_mask: torch.Tensor = None):
     # audio: (batch, height, width, channel)
     cfg = self.config
@@ -364,7 +398,7 @@ class AudioVQGAN(nn.Module):
     return input_tokens, target_tokens, loss_mask
 
   def get_target_sequence(self, input_tokens, shared_embed, mask, target_tokens=None, task_mask=None,
-                          loss_mask=None, segment_ids=None, cur_index=None):
+                          loss_mask=None, segment_ids=None, cur_index=None, example_ids=None):
     cfg = self.config
     vqgan_cfg = self.vqgan_config
     bs = input_tokens.shape[0]
@@ -372,11 +406,11 @@ class AudioVQGAN(nn.Module):
     x = shared_embed(input_tokens)
 
     if cur_index is not None:
-      pos_emb = self.pos_emb_cache[cur_index:cur_index+1,:][None, :, :]
+      pos_ids = torch.full((1, 1), cur_index, device=x.device)
     else:
-      pos_emb = self.pos_emb_cache[:x.shape[1]][None, :, :]
+      pos_ids = torch.arange(x.shape[1], device=x.device)[None, :]
     
-    pos_emb = pos_emb.expand(bs, -1, -1)
+    pos_ids = (pos_ids + self.rope_offset).expand(bs, -1)
 
     if "llama_rope" in cfg.image_pos_emb:
       x += self.modality_embedding[None, None, :].to(x.dtype)
@@ -384,33 +418,19 @@ class AudioVQGAN(nn.Module):
     if mask is None:
       mask = torch.ones(x.shape[0], x.shape[1], dtype=torch.int32, device=x.device)
 
-    if cfg.dalle_attn_mask:
-      attn_pattern_mask = self.attn_mask[None,:,:,:].expand(x.shape[0], -1, -1, -1)
-    else:
-      # use full mask if we are not using dalle attn mask.
-      attn_pattern_mask = self.attn_mask[None,-1,:,:].expand(x.shape[0], 4, -1, -1)
-
-    # task_mask: 1 if we should mask the corresponding token
-    if cfg.dynamic_unk_mask and task_mask is not None:
-      noise_mask = 1 - task_mask
-      # shift the mask by 1
-      noise_mask = torch.cat([
-        torch.ones(noise_mask.shape[0], 1, dtype=noise_mask.dtype, device=noise_mask.device),
-        noise_mask[:, :-1]], dim=1)
-      dynamic_unk_mask = layers.make_attention_mask(noise_mask, noise_mask)
-      identity_mask = torch.eye(x.shape[1], dtype=dynamic_unk_mask.dtype, device=dynamic_unk_mask.device)
-      dynamic_unk_mask = torch.logical_or(dynamic_unk_mask, identity_mask)
-      attn_pattern_mask = layers.combine_masks(dynamic_unk_mask, attn_pattern_mask).to(attn_pattern_mask.dtype)
+    attn_pattern_mask = get_pattern_mask(
+      self.attn_mask, cfg, bs, x.shape[1], task_mask, cur_index)
 
     modality_id = torch.full((), AUDIO_MODALITY_INDEX, device=x.device, dtype=torch.int32)
     seq = TargetSequence(
-      x, pos_emb, modality_id, mask, attn_pattern_mask=attn_pattern_mask,
-      subsegments=segment_ids, target_tokens=target_tokens, loss_mask=loss_mask)
+      x, pos_ids, modality_id, mask, attn_pattern_mask=attn_pattern_mask,
+      subsegments=segment_ids, segment_ids=example_ids, target_tokens=target_tokens,
+      loss_mask=loss_mask)
     
     return seq
 
   def forward(self, audio, shared_embed, mask=None, loss_mask=None, task_mask=None, segment_ids=None,
-              cur_index=None, pos_ids=None):
+              cur_index=None, pos_ids=None, example_ids=None):
     
     cfg = self.config
     if cur_index is not None:
@@ -419,7 +439,7 @@ class AudioVQGAN(nn.Module):
       input_tokens, target_tokens, loss_mask = self.target_audio_to_seq(audio, loss_mask)
 
       return self.get_target_sequence(input_tokens, shared_embed, mask, target_tokens, task_mask,
-                                      loss_mask, segment_ids)
+                                      loss_mask, segment_ids, example_ids=example_ids)
 
 
 class TargetAudioVQGANEmbedder(ModalityEncoder):